@@ -353,6 +353,78 @@ DELIMITER ;
 
 
 
+-- Rendition presets
+-- additional versions of a title to encode alongside its primary Plex version
+-- (e.g. an HEVC primary version plus a lower-bitrate H.264 copy for remote streaming)
+--
+-- all of a title's renditions are encoded from a single decode pass: the original is decoded,
+-- cropped, deinterlaced, and denoised once, and the filtered frames are fed to each rendition's encoder
+-- (the primary version is still encoded separately with HandBrake, so a title with renditions is decoded twice)
+--
+-- deleting a rendition removes its file from the Plex library the next time Queue.sh runs
+--
+-- renditions can be defined for an entire series (series_title) or for an individual title (plex_name);
+-- a title-level rendition overrides a series-level rendition with the same rendition_name
+--
+-- rendition_name			suffix appended to the Plex name for this rendition's file
+--							e.g. "720p" saves "Movie Title (2017) - 720p.m4v" alongside "Movie Title (2017).m4v"
+--
+-- series_title				tv show title this rendition applies to
+--
+-- plex_name				title this rendition applies to
+--
+-- mpeg_encoder				x264, x265
+--
+-- encoder_tune				tune option for the x264 encoder
+--							see handbrakecli --encoder-tune-list for --encoder-tune options available
+--
+-- quality					target CRF quality score
+--							if blank, the title's quality setting is used
+--
+-- max_height				maximum height of the rendition in pixels; taller sources are scaled down
+--							if blank, the rendition is scaled to a maximum of 1080 pixels
+--
+-- vbv_maxrate				average target bitrate for encoding
+--							capped at the title's vbv_maxrate; if blank, the title's vbv_maxrate is used
+--
+-- vbv_bufsize				2x vbv_maxrate
+--
+-- crf_max					max constant quality setting (lower numbers = higher quality)
+--							if blank, the title's crf_max is used
+--
+-- qpmax					quantizer value
+--							if blank, the title's qpmax is used
+--
+-- date_updated				date the settings were updated
+
+CREATE TABLE presets_renditions (
+	id						INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+	rendition_name			VARCHAR(64) NOT NULL,
+	series_title			VARCHAR(256),
+	plex_name				VARCHAR(256),
+	mpeg_encoder			VARCHAR(32) NOT NULL DEFAULT 'x264',
+	encoder_tune			VARCHAR(32),
+	quality					DECIMAL(3,1),
+	max_height				INT,
+	vbv_maxrate				INT,
+	vbv_bufsize				INT,
+	crf_max					INT,
+	qpmax					INT,
+	date_updated			DATETIME,
+
+	UNIQUE (series_title, rendition_name),
+	UNIQUE (plex_name, rendition_name),
+
+	FOREIGN KEY (series_title) REFERENCES presets_series(series_title) ON DELETE CASCADE ON UPDATE CASCADE,
+	FOREIGN KEY (plex_name) REFERENCES presets_titles(plex_name) ON DELETE CASCADE ON UPDATE CASCADE,
+	FOREIGN KEY (encoder_tune) REFERENCES ref_encoder_tune_opts(encoder_tune) ON DELETE RESTRICT ON UPDATE CASCADE
+);
+
+CREATE TRIGGER `trg_renditions_add_date` BEFORE INSERT ON `presets_renditions` FOR EACH ROW SET NEW.date_updated = CURRENT_TIMESTAMP, NEW.vbv_bufsize = NEW.vbv_maxrate * 2;
+CREATE TRIGGER `trg_renditions_update_date` BEFORE UPDATE ON `presets_renditions` FOR EACH ROW SET NEW.date_updated = CURRENT_TIMESTAMP, NEW.vbv_bufsize = NEW.vbv_maxrate * 2;
+
+
+
 -- File-level presets
 -- handy for creating a preset for a particular file
 -- items that apply to a specific file go in this table
@@ -403,7 +475,10 @@ DELIMITER ;
 --
 -- date_restore_requested		date the archived file was requested to be restored from S3 Glacier-class storage
 --
--- date_restore_available		the the archived file will be ready for re-download from S3 Glacier-class storage
+-- date_restore_available		date the archived file was found to be ready for re-download from S3 Glacier-class storage
+--								set by Restore.sh, which polls S3 for the actual restore status
+--
+-- date_restore_expires			date the restored copy of the archived file will expire from S3
 --
 -- date_earliest_purge			the earliest date that we can delete the file from S3 Glacier storage
 --
@@ -411,6 +486,9 @@ DELIMITER ;
 --
 -- file_duration				length of file in seconds
 --								will possibly use for evaluating which droplet type to use for encoding
+--
+-- remux_eligible				flag set by Import.sh if the file's video already meets our target profile (8-bit H.264 at no more than 1080p, progressive),
+--								so it can be remuxed with only its audio transcoded instead of being re-encoded
 
 CREATE TABLE files (
 	file_path				VARCHAR(1024) PRIMARY KEY,
@@ -433,8 +511,10 @@ CREATE TABLE files (
 	date_file_deleted		DATETIME,
 	date_restore_requested	DATETIME,
 	date_restore_available	DATETIME,
+	date_restore_expires	DATETIME,
 	date_earliest_purge		DATETIME,
 	purge_queue				ENUM('T', 'F') NOT NULL DEFAULT 'F',
+	remux_eligible			ENUM('T', 'F') NOT NULL DEFAULT 'F',
 	
 	FOREIGN KEY (plex_name) REFERENCES presets_titles(plex_name) ON DELETE RESTRICT ON UPDATE CASCADE,
 	FOREIGN KEY (nlmeans) REFERENCES ref_nlmeans_opts(nlmeans) ON DELETE RESTRICT ON UPDATE CASCADE,
@@ -453,7 +533,7 @@ CREATE TRIGGER `trg_update_files_set_date`
 BEFORE UPDATE ON `files`
 FOR EACH ROW
 BEGIN
-IF (NOT(OLD.crop <=> NEW.crop) OR NOT(OLD.vbv_maxrate <=> NEW.vbv_maxrate) OR NOT(OLD.vbv_bufsize <=> NEW.vbv_bufsize) OR NOT(OLD.crf_max <=> NEW.crf_max) OR NOT(OLD.qpmax <=> NEW.qpmax) OR NOT(OLD.decomb <=> NEW.decomb) OR NOT(OLD.nlmeans <=> NEW.nlmeans) OR NOT(OLD.nlmeans_tune <=> NEW.nlmeans_tune) OR NOT(OLD.purge_queue <=> NEW.purge_queue)) THEN SET NEW.date_settings_updated = CURRENT_TIMESTAMP;
+IF (NOT(OLD.crop <=> NEW.crop) OR NOT(OLD.vbv_maxrate <=> NEW.vbv_maxrate) OR NOT(OLD.vbv_bufsize <=> NEW.vbv_bufsize) OR NOT(OLD.crf_max <=> NEW.crf_max) OR NOT(OLD.qpmax <=> NEW.qpmax) OR NOT(OLD.decomb <=> NEW.decomb) OR NOT(OLD.nlmeans <=> NEW.nlmeans) OR NOT(OLD.nlmeans_tune <=> NEW.nlmeans_tune) OR NOT(OLD.purge_queue <=> NEW.purge_queue) OR NOT(OLD.remux_eligible <=> NEW.remux_eligible)) THEN SET NEW.date_settings_updated = CURRENT_TIMESTAMP;
 END IF;
 END;
 //
@@ -473,13 +553,14 @@ END;
 
 DELIMITER ;
 
--- when requesting a restore, set the restore available date to 12 hours after the restore was requested
+-- when requesting a restore, clear the restore available and expiry dates from any earlier restore
+-- (Restore.sh sets them again once S3 reports that the file has actually been restored)
 DELIMITER //
 CREATE TRIGGER `trg_restore_available`
 BEFORE UPDATE ON `files`
 FOR EACH ROW
 BEGIN
-IF (NOT(OLD.date_restore_requested <=> NEW.date_restore_requested)) THEN SET NEW.date_restore_available = DATE_ADD(NEW.date_restore_requested, INTERVAL 12 HOUR);
+IF (NOT(OLD.date_restore_requested <=> NEW.date_restore_requested)) THEN SET NEW.date_restore_available = NULL, NEW.date_restore_expires = NULL;
 END IF;
 END;
 //
@@ -487,23 +568,51 @@ END;
 DELIMITER ;
 
 
+
+-- Encoded renditions
+-- which renditions of each title are currently in the Plex library, and when they were encoded
+--
+-- plex_name				title the rendition was encoded from
+--
+-- rendition_name			name of the rendition in presets_renditions
+--
+-- rendition_path			location of the rendition in the Plex library
+--
+-- latest_transcode			date the rendition was last transcoded
+
+CREATE TABLE renditions (
+	plex_name				VARCHAR(256) NOT NULL,
+	rendition_name			VARCHAR(64) NOT NULL,
+	rendition_path			VARCHAR(1024) NOT NULL,
+	latest_transcode		DATETIME NOT NULL,
+
+	PRIMARY KEY (plex_name, rendition_name),
+
+	FOREIGN KEY (plex_name) REFERENCES presets_titles(plex_name) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+
 -- Task locations
 -- Certain tasks can only be performed in certain locations
 -- (e.g. we encode on remote machines since our NAS CPU is not very powerful,
 --       we can only delete on the host since we need access to the original file)
 -- Rather than coding what can be done where, this table can be adjusted for pulling appropriate tasks
 -- when we create each task queue using create_queues()
+--
+-- hybrid tasks are placed on the local host or on droplets, whichever is predicted to finish each task sooner
+-- (requires the local host to have been calibrated with "Calibrate.sh local")
 
 CREATE TABLE task_locations (
 	task					VARCHAR(32) PRIMARY KEY,
-	location				ENUM('local', 'remote') NOT NULL
+	location				ENUM('local', 'remote', 'hybrid') NOT NULL
 );
 
 INSERT INTO task_locations (task, location) VALUES
 ('archive', 'remote'),
 ('delete', 'local'),
 ('restore', 'local'),
-('encode', 'remote'),
+('encode', 'hybrid'),
+('remux', 'local'),
 ('purge', 'local');
 
 
@@ -520,9 +629,12 @@ CREATE TABLE history_queue (
 	cpus_per_task			INT,
 	hourly_cost				DECIMAL(7,5) NOT NULL,
 	num_droplets			INT,
+	regions					VARCHAR(1024),
 	queue_end				DATETIME DEFAULT NULL,
 	hours					INT,
-	estimated_cost			DECIMAL(6,2)
+	estimated_cost			DECIMAL(6,2),
+	
+	INDEX (droplet_type)
 );
 
 CREATE TRIGGER `trg_calc_cpus_per_task` BEFORE INSERT ON `history_queue` FOR EACH ROW SET NEW.cpus_per_task = (NEW.num_cpus / NEW.simultaneous_tasks);
@@ -533,6 +645,7 @@ CREATE TABLE history_task (
 	queue_start				DATETIME NOT NULL,
 	file_path				VARCHAR(1024),
 	task					VARCHAR(32),
+	location				ENUM('local', 'remote'),
 	dir_path				VARCHAR(1024),
 	plex_name				VARCHAR(256),
 	series_title			VARCHAR(256),
@@ -552,13 +665,420 @@ CREATE TABLE history_task (
 	nlmeans					VARCHAR(32),
 	nlmeans_tune			VARCHAR(32),
 	audio_language			VARCHAR(3),
+	rendition_name			VARCHAR(64),
 	task_duration			INT,
 	
+	INDEX (task, location),
+	INDEX (plex_name),
 	FOREIGN KEY (queue_start) REFERENCES history_queue(queue_start) ON DELETE RESTRICT ON UPDATE CASCADE
 );
 
 
 
+-- Calibration reference clips
+-- A fixed set of clips encoded on each candidate droplet type by Calibrate.sh,
+-- so droplet types can be chosen based on measured encoding speeds
+--
+-- clip_path				location of the clip in ${S3_BUCKET}
+--							upload each clip with s3cmd before running a calibration
+--							e.g. s3cmd -e put "1080p - grain.mkv" "s3://${S3_BUCKET}/Calibration/1080p - grain.mkv"
+--
+-- quality_title			quality settings from ref_source_quality used to encode the clip
+--
+-- encoder_tune				x264 tune option used to encode the clip
+
+CREATE TABLE ref_calibration_clips (
+	clip_path				VARCHAR(1024) PRIMARY KEY,
+	quality_title			VARCHAR(32) NOT NULL,
+	encoder_tune			VARCHAR(32) NOT NULL,
+
+	FOREIGN KEY (quality_title) REFERENCES ref_source_quality(quality_title) ON DELETE RESTRICT ON UPDATE CASCADE,
+	FOREIGN KEY (encoder_tune) REFERENCES ref_encoder_tune_opts(encoder_tune) ON DELETE RESTRICT ON UPDATE CASCADE
+);
+
+INSERT INTO ref_calibration_clips (clip_path, quality_title, encoder_tune) VALUES
+('/Calibration/SD - film.mkv', 'DVD', 'film'),
+('/Calibration/SD - grain.mkv', 'DVD', 'grain'),
+('/Calibration/SD - animation.mkv', 'DVD', 'animation'),
+('/Calibration/720p - film.mkv', 'Bluray-720p', 'film'),
+('/Calibration/720p - grain.mkv', 'Bluray-720p', 'grain'),
+('/Calibration/720p - animation.mkv', 'Bluray-720p', 'animation'),
+('/Calibration/1080p - film.mkv', 'Bluray-1080p', 'film'),
+('/Calibration/1080p - grain.mkv', 'Bluray-1080p', 'grain'),
+('/Calibration/1080p - animation.mkv', 'Bluray-1080p', 'animation'),
+('/Calibration/2160p - film.mkv', 'Bluray-2160p', 'film'),
+('/Calibration/2160p - grain.mkv', 'Bluray-2160p', 'grain'),
+('/Calibration/2160p - animation.mkv', 'Bluray-2160p', 'animation');
+
+
+
+-- Calibration history
+-- How quickly each droplet type encoded each reference clip, for each number of simultaneous tasks
+--
+-- fps						frames encoded per second by a single task
+--
+-- speed					seconds of video encoded per second by a single task
+--							(e.g. 0.5 means a 2 hour film takes 4 hours to encode)
+
+CREATE TABLE history_calibration (
+	id						INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+	calibration_start		DATETIME NOT NULL,
+	droplet_type			VARCHAR(32) NOT NULL,
+	num_cpus				INT,
+	simultaneous_tasks		INT NOT NULL,
+	hourly_cost				DECIMAL(7,5) NOT NULL,
+	clip_path				VARCHAR(1024) NOT NULL,
+	quality_title			VARCHAR(32),
+	mpeg_encoder			VARCHAR(32),
+	encoder_tune			VARCHAR(32),
+	file_duration			INT,
+	frame_count				INT,
+	task_duration			INT NOT NULL,
+	fps						DECIMAL(8,3),
+	speed					DECIMAL(8,5),
+	
+	INDEX (droplet_type, simultaneous_tasks)
+);
+
+CREATE TRIGGER `trg_calc_calibration_speed` BEFORE INSERT ON `history_calibration` FOR EACH ROW SET NEW.fps = (NEW.frame_count / NEW.task_duration), NEW.speed = (NEW.file_duration / NEW.task_duration);
+
+
+
+-- Transfer history
+-- How quickly files were transferred between S3 and droplets in each region,
+-- so droplets can be created in the regions our files transfer to and from fastest
+--
+-- region					DigitalOcean region the droplet was created in
+--
+-- direction				upload (archiving a file to S3) or download (downloading a restored file from S3)
+--
+-- megabytes_per_second		file_size / transfer_duration
+
+CREATE TABLE history_transfer (
+	id						INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+	queue_start				DATETIME NOT NULL,
+	file_path				VARCHAR(1024),
+	region					VARCHAR(32) NOT NULL,
+	droplet_type			VARCHAR(32),
+	direction				ENUM('upload', 'download') NOT NULL,
+	file_size				BIGINT NOT NULL,
+	transfer_duration		INT NOT NULL,
+	megabytes_per_second	DECIMAL(10,3),
+	
+	INDEX (region),
+	INDEX (queue_start)
+);
+
+CREATE TRIGGER `trg_calc_transfer_speed` BEFORE INSERT ON `history_transfer` FOR EACH ROW SET NEW.megabytes_per_second = (NEW.file_size / 1000000 / GREATEST(NEW.transfer_duration, 1));
+
+
+
+-- Job leases
+-- Which droplet is working on which remote task; tasks.sh leases each task before starting it,
+-- and renews the lease with a heartbeat every minute until the task finishes
+--
+-- host						IP address of the droplet holding the lease
+--
+-- date_lease_expires		when the lease expires if the droplet stops sending heartbeats,
+--							after which Watchdog.sh drains the droplet and the task is handed to another droplet
+--
+-- progress					percent of the task completed, as last reported by the droplet's agent.py
+
+CREATE TABLE job_leases (
+	file_path				VARCHAR(1024) PRIMARY KEY,
+	task					VARCHAR(32) NOT NULL,
+	host					VARCHAR(45) NOT NULL,
+	queue_start				DATETIME NOT NULL,
+	date_leased				DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	date_heartbeat			DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	date_lease_expires		DATETIME NOT NULL,
+	progress				DECIMAL(5,2),
+	
+	INDEX (host),
+	INDEX (date_lease_expires)
+);
+
+
+
+-- Host health
+-- Each droplet created for a queue, and whether it's still trusted with tasks
+--
+-- state					healthy:	receiving tasks
+--							draining:	removed from sshloginfile.txt after too many failed or expired tasks, or after it stopped responding
+--							destroyed:	destroyed by Watchdog.sh (and replaced, if there were replacements left)
+--
+-- jobs_failed				tasks that exited with an error or whose lease expired on this droplet
+
+CREATE TABLE host_health (
+	id						INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+	queue_start				DATETIME NOT NULL,
+	host					VARCHAR(45) NOT NULL,
+	droplet_number			INT NOT NULL,
+	region					VARCHAR(32),
+	state					ENUM('healthy', 'draining', 'destroyed') NOT NULL DEFAULT 'healthy',
+	jobs_completed			INT NOT NULL DEFAULT 0,
+	jobs_failed				INT NOT NULL DEFAULT 0,
+	date_added				DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	date_state_changed		DATETIME,
+	
+	UNIQUE (queue_start, host)
+);
+
+CREATE TRIGGER `trg_host_state_date` BEFORE UPDATE ON `host_health` FOR EACH ROW SET NEW.date_state_changed = IF(OLD.state <=> NEW.state, OLD.date_state_changed, CURRENT_TIMESTAMP);
+
+
+
+-- Lease history
+-- Leases that ended without their task completing, and the droplet time spent on them
+--
+-- outcome					failed:		the task exited with an error
+--							expired:	the droplet stopped sending heartbeats
+--							drained:	the droplet was drained while working on the task
+--
+-- wasted_minutes			minutes of droplet time spent on the task before it was lost
+
+CREATE TABLE history_lease (
+	id						INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+	queue_start				DATETIME NOT NULL,
+	file_path				VARCHAR(1024),
+	task					VARCHAR(32),
+	host					VARCHAR(45) NOT NULL,
+	outcome					ENUM('failed', 'expired', 'drained') NOT NULL,
+	date_leased				DATETIME NOT NULL,
+	date_released			DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	wasted_minutes			DECIMAL(8,2),
+	
+	INDEX (queue_start)
+);
+
+CREATE TRIGGER `trg_calc_wasted_minutes` BEFORE INSERT ON `history_lease` FOR EACH ROW SET NEW.wasted_minutes = (TIMESTAMPDIFF(second, NEW.date_leased, NEW.date_released) / 60);
+
+
+
+-- Task rollups
+-- Running totals of history_task for each droplet type, task, quality title, encoder, and tune,
+-- updated as each task is recorded, so reports and the cost model don't have to scan every task ever run
+--
+-- droplet_type				droplet type from the task's queue, or 'local' for tasks run on the local host
+--
+-- quality_title, mpeg_encoder, encoder_tune
+--							'' when the task doesn't have one (e.g. archive tasks have no encoder)
+--
+-- source_seconds			total duration of the videos processed
+--
+-- task_seconds				total time spent on the tasks
+--
+-- timed_task_seconds		time spent on the tasks whose video duration is known,
+--							so source_seconds / timed_task_seconds is the average speed
+
+CREATE TABLE rollup_task (
+	droplet_type			VARCHAR(32) NOT NULL,
+	task					VARCHAR(32) NOT NULL,
+	quality_title			VARCHAR(32) NOT NULL,
+	mpeg_encoder			VARCHAR(32) NOT NULL,
+	encoder_tune			VARCHAR(32) NOT NULL,
+	num_tasks				INT NOT NULL DEFAULT 0,
+	source_seconds			BIGINT NOT NULL DEFAULT 0,
+	task_seconds			BIGINT NOT NULL DEFAULT 0,
+	timed_task_seconds		BIGINT NOT NULL DEFAULT 0,
+	date_first_task			DATETIME,
+	date_last_task			DATETIME,
+	
+	PRIMARY KEY (droplet_type, task, quality_title, mpeg_encoder, encoder_tune)
+);
+
+
+
+-- Task rollup histograms
+-- How many tasks fell into each bucket of speed or task duration, for estimating percentiles from rollup_task's groups
+--
+-- metric					speed:			seconds of video processed per second (only tasks whose video duration is known)
+--							task_seconds:	time spent on the task
+--
+-- bucket					FLOOR(LOG2(value) * 8), i.e. 8 buckets for each doubling, so each bucket spans about 9%
+
+CREATE TABLE rollup_task_histogram (
+	droplet_type			VARCHAR(32) NOT NULL,
+	task					VARCHAR(32) NOT NULL,
+	quality_title			VARCHAR(32) NOT NULL,
+	mpeg_encoder			VARCHAR(32) NOT NULL,
+	encoder_tune			VARCHAR(32) NOT NULL,
+	metric					ENUM('speed', 'task_seconds') NOT NULL,
+	bucket					SMALLINT NOT NULL,
+	num_tasks				INT NOT NULL DEFAULT 0,
+	
+	PRIMARY KEY (droplet_type, task, quality_title, mpeg_encoder, encoder_tune, metric, bucket)
+);
+
+-- add each task to its rollups as it's recorded
+-- (rendition rows record the duration of the pass that encoded all of a title's renditions rather than an encode of
+-- the title itself, so they aren't counted)
+DELIMITER //
+CREATE TRIGGER `trg_rollup_task`
+AFTER INSERT ON `history_task`
+FOR EACH ROW
+BEGIN
+DECLARE rollupDropletType VARCHAR(32);
+IF (NEW.rendition_name IS NULL AND NEW.task_duration IS NOT NULL) THEN
+	SET rollupDropletType = IF(NEW.location = 'local', 'local', (SELECT droplet_type FROM history_queue WHERE queue_start = NEW.queue_start));
+	INSERT INTO rollup_task (droplet_type, task, quality_title, mpeg_encoder, encoder_tune, num_tasks, source_seconds, task_seconds, timed_task_seconds, date_first_task, date_last_task)
+	VALUES (COALESCE(rollupDropletType, ''), COALESCE(NEW.task, ''), COALESCE(NEW.quality_title, ''), COALESCE(NEW.mpeg_encoder, ''), COALESCE(NEW.encoder_tune, ''), 1, COALESCE(NEW.file_duration, 0), NEW.task_duration, IF(NEW.file_duration IS NULL, 0, NEW.task_duration), NEW.queue_start, NEW.queue_start)
+	ON DUPLICATE KEY UPDATE num_tasks = num_tasks + 1, source_seconds = source_seconds + VALUES(source_seconds), task_seconds = task_seconds + VALUES(task_seconds), timed_task_seconds = timed_task_seconds + VALUES(timed_task_seconds), date_first_task = LEAST(date_first_task, VALUES(date_first_task)), date_last_task = GREATEST(date_last_task, VALUES(date_last_task));
+	IF (NEW.task_duration > 0) THEN
+		INSERT INTO rollup_task_histogram (droplet_type, task, quality_title, mpeg_encoder, encoder_tune, metric, bucket, num_tasks)
+		VALUES (COALESCE(rollupDropletType, ''), COALESCE(NEW.task, ''), COALESCE(NEW.quality_title, ''), COALESCE(NEW.mpeg_encoder, ''), COALESCE(NEW.encoder_tune, ''), 'task_seconds', FLOOR(LOG2(NEW.task_duration) * 8), 1)
+		ON DUPLICATE KEY UPDATE num_tasks = num_tasks + 1;
+		IF (NEW.file_duration > 0) THEN
+			INSERT INTO rollup_task_histogram (droplet_type, task, quality_title, mpeg_encoder, encoder_tune, metric, bucket, num_tasks)
+			VALUES (COALESCE(rollupDropletType, ''), COALESCE(NEW.task, ''), COALESCE(NEW.quality_title, ''), COALESCE(NEW.mpeg_encoder, ''), COALESCE(NEW.encoder_tune, ''), 'speed', FLOOR(LOG2(NEW.file_duration / NEW.task_duration) * 8), 1)
+			ON DUPLICATE KEY UPDATE num_tasks = num_tasks + 1;
+		END IF;
+	END IF;
+END IF;
+END;
+//
+
+DELIMITER ;
+
+-- rebuild the rollups from the tasks still in history_task
+-- (e.g. CALL rollup_rebuild(); after upgrading a database that already has task history)
+--
+-- Tasks removed by history_compact() can't be added back, so a group whose first task is from before the latest
+-- history_compaction cutoff keeps its rollups as they are, and only the groups whose tasks are all still in history_task are rebuilt
+DELIMITER //
+CREATE PROCEDURE `rollup_rebuild`()
+BEGIN
+DECLARE compactedBefore DATETIME;
+SELECT MAX(compacted_before) INTO compactedBefore FROM history_compaction;
+DELETE FROM rollup_task_histogram WHERE (droplet_type, task, quality_title, mpeg_encoder, encoder_tune) NOT IN (SELECT droplet_type, task, quality_title, mpeg_encoder, encoder_tune FROM rollup_task WHERE date_first_task < compactedBefore);
+DELETE FROM rollup_task WHERE compactedBefore IS NULL OR date_first_task IS NULL OR date_first_task >= compactedBefore;
+INSERT INTO rollup_task (droplet_type, task, quality_title, mpeg_encoder, encoder_tune, num_tasks, source_seconds, task_seconds, timed_task_seconds, date_first_task, date_last_task)
+SELECT droplet_type, task, quality_title, mpeg_encoder, encoder_tune, COUNT(*), SUM(source_seconds), SUM(task_seconds), SUM(timed_task_seconds), MIN(queue_start), MAX(queue_start)
+FROM (
+	SELECT IF(t.location = 'local', 'local', COALESCE(q.droplet_type, '')) AS droplet_type, COALESCE(t.task, '') AS task, COALESCE(t.quality_title, '') AS quality_title, COALESCE(t.mpeg_encoder, '') AS mpeg_encoder, COALESCE(t.encoder_tune, '') AS encoder_tune, COALESCE(t.file_duration, 0) AS source_seconds, t.task_duration AS task_seconds, IF(t.file_duration IS NULL, 0, t.task_duration) AS timed_task_seconds, t.queue_start
+	FROM history_task AS t LEFT JOIN history_queue AS q ON q.queue_start = t.queue_start
+	WHERE t.rendition_name IS NULL AND t.task_duration IS NOT NULL
+) AS tasks
+WHERE (droplet_type, task, quality_title, mpeg_encoder, encoder_tune) NOT IN (SELECT droplet_type, task, quality_title, mpeg_encoder, encoder_tune FROM rollup_task)
+GROUP BY droplet_type, task, quality_title, mpeg_encoder, encoder_tune;
+INSERT INTO rollup_task_histogram (droplet_type, task, quality_title, mpeg_encoder, encoder_tune, metric, bucket, num_tasks)
+SELECT droplet_type, task, quality_title, mpeg_encoder, encoder_tune, metric, bucket, COUNT(*)
+FROM (
+	SELECT IF(t.location = 'local', 'local', COALESCE(q.droplet_type, '')) AS droplet_type, COALESCE(t.task, '') AS task, COALESCE(t.quality_title, '') AS quality_title, COALESCE(t.mpeg_encoder, '') AS mpeg_encoder, COALESCE(t.encoder_tune, '') AS encoder_tune, 'task_seconds' AS metric, FLOOR(LOG2(t.task_duration) * 8) AS bucket
+	FROM history_task AS t LEFT JOIN history_queue AS q ON q.queue_start = t.queue_start
+	WHERE t.rendition_name IS NULL AND t.task_duration > 0
+	UNION ALL
+	SELECT IF(t.location = 'local', 'local', COALESCE(q.droplet_type, '')), COALESCE(t.task, ''), COALESCE(t.quality_title, ''), COALESCE(t.mpeg_encoder, ''), COALESCE(t.encoder_tune, ''), 'speed', FLOOR(LOG2(t.file_duration / t.task_duration) * 8)
+	FROM history_task AS t LEFT JOIN history_queue AS q ON q.queue_start = t.queue_start
+	WHERE t.rendition_name IS NULL AND t.task_duration > 0 AND t.file_duration > 0
+) AS buckets
+WHERE (droplet_type, task, quality_title, mpeg_encoder, encoder_tune) NOT IN (SELECT droplet_type, task, quality_title, mpeg_encoder, encoder_tune FROM rollup_task WHERE date_first_task < compactedBefore)
+GROUP BY droplet_type, task, quality_title, mpeg_encoder, encoder_tune, metric, bucket;
+END;
+//
+
+DELIMITER ;
+
+-- History retention
+-- Raw task history is only needed for looking up individual tasks once it's been rolled up, so history_compact()
+-- (run daily from cron with ${HISTORY_RETENTION_DAYS}) removes:
+--
+--   - history_task rows older than retentionDays (they stay counted in rollup_task and rollup_task_histogram)
+--   - history_transfer, history_lease, and host_health rows older than retentionDays (v_region_throughput only uses the last 30 days)
+--   - any job_leases left behind by queues that finished more than a day ago
+--
+-- Each time it removes tasks, it records the cutoff in history_compaction, so rollup_rebuild() leaves the rollups
+-- of those tasks alone
+--
+-- compacted_before			history_task rows from queues that started before this were removed
+--
+-- tasks_removed			number of history_task rows removed
+
+CREATE TABLE history_compaction (
+	id						INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+	date_compacted			DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+	compacted_before		DATETIME NOT NULL,
+	tasks_removed			INT NOT NULL
+);
+
+DELIMITER //
+CREATE PROCEDURE `history_compact`(IN retentionDays INT)
+BEGIN
+DECLARE compactBefore DATETIME DEFAULT CURRENT_TIMESTAMP - INTERVAL retentionDays DAY;
+INSERT INTO history_compaction (compacted_before, tasks_removed) SELECT compactBefore, COUNT(*) FROM history_task WHERE queue_start < compactBefore HAVING COUNT(*) > 0;
+DELETE FROM history_task WHERE queue_start < compactBefore;
+DELETE FROM history_transfer WHERE queue_start < compactBefore;
+DELETE FROM history_lease WHERE queue_start < compactBefore;
+DELETE FROM job_leases WHERE queue_start IN (SELECT queue_start FROM history_queue WHERE queue_end < CURRENT_TIMESTAMP - INTERVAL 1 DAY);
+DELETE FROM host_health WHERE queue_start < compactBefore;
+END;
+//
+
+DELIMITER ;
+
+
+
+-- Catalog changes
+-- Titles whose library catalog entries may have changed, for catalog.py to apply to its snapshots
+-- rather than re-reading the entire library each time
+--
+-- plex_name				title that changed
+--							NULL when a change could affect every title (e.g. source quality preferences), and the whole catalog should be rebuilt
+--
+-- date_changed				date the change was made
+
+CREATE TABLE catalog_changes (
+	id						INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+	plex_name				VARCHAR(256),
+	date_changed			DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TRIGGER `trg_catalog_files_insert` AFTER INSERT ON `files` FOR EACH ROW INSERT INTO catalog_changes (plex_name) VALUES (NEW.plex_name);
+CREATE TRIGGER `trg_catalog_files_delete` AFTER DELETE ON `files` FOR EACH ROW INSERT INTO catalog_changes (plex_name) VALUES (OLD.plex_name);
+
+-- only record a change when a file moves to a different title or quality,
+-- as other updates (restores, transcodes, etc.) don't change the catalog
+DELIMITER //
+CREATE TRIGGER `trg_catalog_files_update`
+AFTER UPDATE ON `files`
+FOR EACH ROW
+BEGIN
+IF (NOT(OLD.plex_name <=> NEW.plex_name) OR NOT(OLD.quality_title <=> NEW.quality_title)) THEN INSERT INTO catalog_changes (plex_name) VALUES (OLD.plex_name), (NEW.plex_name);
+END IF;
+END;
+//
+
+DELIMITER ;
+
+-- only record a change when a title's catalog details are updated
+-- (renaming a title cascades to its files without firing their triggers, so the old name is recorded here too)
+DELIMITER //
+CREATE TRIGGER `trg_catalog_titles_update`
+AFTER UPDATE ON `presets_titles`
+FOR EACH ROW
+BEGIN
+IF (NOT(OLD.plex_name <=> NEW.plex_name) OR NOT(OLD.movie_title <=> NEW.movie_title) OR NOT(OLD.release_year <=> NEW.release_year) OR NOT(OLD.series_title <=> NEW.series_title) OR NOT(OLD.season_number <=> NEW.season_number) OR NOT(OLD.episode_number <=> NEW.episode_number) OR NOT(OLD.release_identifier <=> NEW.release_identifier)) THEN INSERT INTO catalog_changes (plex_name) VALUES (OLD.plex_name), (NEW.plex_name);
+END IF;
+END;
+//
+
+DELIMITER ;
+
+-- changing which source qualities we prefer can change the best format of any title, so rebuild the whole catalog
+DELIMITER //
+CREATE TRIGGER `trg_catalog_quality_update`
+AFTER UPDATE ON `ref_source_quality`
+FOR EACH ROW
+BEGIN
+IF (NOT(OLD.quality_title <=> NEW.quality_title) OR NOT(OLD.preference <=> NEW.preference)) THEN INSERT INTO catalog_changes (plex_name) VALUES (NULL);
+END IF;
+END;
+//
+
+DELIMITER ;
+
+
+
 -- List showing the best format for each title in the library
 
 CREATE OR REPLACE VIEW v_best_format AS
@@ -591,8 +1111,69 @@ FROM
 	
 WHERE
 	top_quality.preference = q.preference;
-	
-	
+
+
+
+-- Renditions to encode for each title
+-- (Title-level renditions, plus any series-level renditions that haven't been overridden at the title level)
+
+CREATE OR REPLACE VIEW v_renditions AS
+
+SELECT
+	title.plex_name,
+	rendition.rendition_name,
+	rendition.mpeg_encoder,
+	CASE
+		WHEN rendition.mpeg_encoder = 'x264' THEN COALESCE(rendition.encoder_tune, 'film')
+		ELSE NULL
+	END AS "encoder_tune",
+	rendition.quality,
+	rendition.max_height,
+	rendition.vbv_maxrate,
+	rendition.vbv_bufsize,
+	rendition.crf_max,
+	rendition.qpmax,
+	rendition.date_updated
+
+FROM
+	presets_titles title
+
+	JOIN presets_renditions rendition
+	ON rendition.plex_name = title.plex_name
+
+UNION ALL
+
+SELECT
+	title.plex_name,
+	rendition.rendition_name,
+	rendition.mpeg_encoder,
+	CASE
+		WHEN rendition.mpeg_encoder = 'x264' THEN COALESCE(rendition.encoder_tune, 'film')
+		ELSE NULL
+	END AS "encoder_tune",
+	rendition.quality,
+	rendition.max_height,
+	rendition.vbv_maxrate,
+	rendition.vbv_bufsize,
+	rendition.crf_max,
+	rendition.qpmax,
+	rendition.date_updated
+
+FROM
+	presets_titles title
+
+	JOIN presets_renditions rendition
+	ON rendition.series_title = title.series_title
+
+WHERE
+	NOT EXISTS (
+		SELECT 1
+		FROM presets_renditions title_rendition
+		WHERE title_rendition.plex_name = title.plex_name
+			AND title_rendition.rendition_name = rendition.rendition_name
+	);
+
+
 
 -- Processing queue
 -- 
@@ -633,14 +1214,60 @@ SELECT
 				(series_generic.date_updated > title.latest_transcode)
 				OR
 				(q.date_updated > title.latest_transcode)
+				OR
+				(renditions.date_updated > title.latest_transcode)
 				OR title.latest_transcode IS NULL
 			)
 			AND file.date_file_archived IS NOT NULL
 			AND file.date_file_deleted IS NOT NULL
-			AND (file.date_restore_requested IS NULL OR CURRENT_TIMESTAMP > DATE_ADD(file.date_restore_requested, INTERVAL 1 DAY))
+			AND (
+				file.date_restore_requested IS NULL
+				OR
+				-- the restored copy has expired (or will before we could finish downloading it)
+				CURRENT_TIMESTAMP > DATE_SUB(file.date_restore_expires, INTERVAL 1 HOUR)
+				OR
+				-- bulk restores should finish within 12 hours, so a restore still not available after 2 days has likely been lost
+				(file.date_restore_available IS NULL AND CURRENT_TIMESTAMP > DATE_ADD(file.date_restore_requested, INTERVAL 2 DAY))
+			)
 		THEN 'restore'
 		
 		
+		-- If the file would otherwise be encoded, but Import.sh found its video already meets our target profile,
+		-- then remux the video and only transcode its audio on the local host instead
+		-- (as long as it's under its quality's bitrate cap, isn't being cropped, and no other encoding settings or renditions
+		--  have been given that would need the video to be re-encoded)
+		WHEN file.file_path = best.file_path
+			AND (
+				(file.date_file_added > title.latest_transcode)
+				OR
+				(file.date_settings_updated > title.latest_transcode)
+				OR
+				(title.date_settings_updated > title.latest_transcode)
+				OR
+				(title_generic.date_updated > title.latest_transcode)
+				OR
+				(series.date_series_updated > title.latest_transcode)
+				OR
+				(series_generic.date_updated > title.latest_transcode)
+				OR
+				(q.date_updated > title.latest_transcode)
+				OR
+				(renditions.date_updated > title.latest_transcode)
+				OR title.latest_transcode IS NULL
+			)
+			AND file.date_file_deleted IS NULL
+			AND file.remux_eligible = 'T'
+			AND file.vbv_maxrate <= q.vbv_maxrate
+			AND file.crop = '0:0:0:0'
+			AND COALESCE(title.handbrake_preset, title_generic.handbrake_preset, series.handbrake_preset, series_generic.handbrake_preset) IS NULL
+			AND COALESCE(title.mpeg_encoder, title_generic.mpeg_encoder, series.mpeg_encoder, series_generic.mpeg_encoder) IS NULL
+			AND COALESCE(title.quality, title_generic.quality, series.quality, series_generic.quality) IS NULL
+			AND COALESCE(title.decomb, title_generic.decomb, series.decomb, series_generic.decomb, file.decomb) IS NULL
+			AND COALESCE(title.nlmeans, title_generic.nlmeans, series.nlmeans, series_generic.nlmeans, file.nlmeans) IS NULL
+			AND renditions.plex_name IS NULL
+		THEN 'remux'
+		
+		
 		-- If we haven't yet transcoded the file, or if we've made changes to its encoding settings
 		-- since the last time we transcoded it, then encode the file with the current encoding settings
 		WHEN file.file_path = best.file_path
@@ -658,12 +1285,14 @@ SELECT
 				(series_generic.date_updated > title.latest_transcode)
 				OR
 				(q.date_updated > title.latest_transcode)
+				OR
+				(renditions.date_updated > title.latest_transcode)
 				OR title.latest_transcode IS NULL
 			)
 			AND (		
 				file.date_file_deleted IS NULL
 				OR
-				CURRENT_TIMESTAMP BETWEEN file.date_restore_available AND DATE_ADD(file.date_restore_requested, INTERVAL 1 DAY) 
+				(file.date_restore_available IS NOT NULL AND (file.date_restore_expires IS NULL OR CURRENT_TIMESTAMP <= DATE_SUB(file.date_restore_expires, INTERVAL 1 HOUR)))
 		) THEN 'encode'
 		
 		
@@ -721,6 +1350,7 @@ SELECT
 	file.date_file_deleted,
 	file.date_restore_requested,
 	file.date_restore_available,
+	file.date_restore_expires,
 	file.date_earliest_purge,
 	file.purge_queue
 
@@ -745,6 +1375,17 @@ FROM
 	LEFT JOIN v_best_format best
 	ON best.file_path = file.file_path
 	
+	LEFT JOIN (
+		SELECT
+			plex_name,
+			MAX(date_updated) AS "date_updated"
+			
+		FROM v_renditions
+		
+		GROUP BY plex_name
+	) renditions
+	ON renditions.plex_name = file.plex_name
+	
 HAVING task IS NOT NULL;
 
 
@@ -794,4 +1435,220 @@ FROM
 WHERE
 	title.series_title IS NOT NULL
 	
-ORDER BY series_title, season_number, episode_number;
\ No newline at end of file
+ORDER BY series_title, season_number, episode_number;
+
+
+
+-- Library catalog entry for each title, exported by catalog.py
+-- (Looks up each title's best format directly rather than joining on v_best_format,
+--  so catalog.py can cheaply re-read just the titles that have changed)
+
+CREATE OR REPLACE VIEW v_catalog AS
+
+SELECT
+	title.plex_name,
+	title.movie_title,
+	title.release_year,
+	title.series_title,
+	title.season_number,
+	title.episode_number,
+	title.release_identifier,
+	(
+		SELECT file.quality_title
+		
+		FROM
+			files file
+			
+			JOIN ref_source_quality q
+			ON q.quality_title = file.quality_title
+			
+		WHERE file.plex_name = title.plex_name
+		
+		ORDER BY q.preference DESC
+		
+		LIMIT 1
+	) AS "quality_title"
+	
+FROM
+	presets_titles title
+	
+WHERE
+	EXISTS (SELECT 1 FROM files file JOIN ref_source_quality q ON q.quality_title = file.quality_title WHERE file.plex_name = title.plex_name);
+
+
+-- Calibration queue
+-- Each reference clip, in the same column order as v_queue so the clips can be passed straight to tasks.sh
+
+CREATE OR REPLACE VIEW v_calibration_queue AS
+
+SELECT
+	clip.clip_path AS "file_path",
+	'calibration' AS "task",
+	'/Calibration' AS "dir_path",
+	SUBSTRING_INDEX(SUBSTRING_INDEX(clip.clip_path, '/', -1), '.', 1) AS "plex_name",
+	NULL AS "series_title",
+	NULL AS "release_identifier",
+	NULL AS "file_duration",
+	clip.quality_title,
+	NULL AS "handbrake_preset",
+	'x264' AS "mpeg_encoder",
+	clip.encoder_tune,
+	NULL AS "crop",
+	q.quality,
+	q.vbv_maxrate,
+	q.vbv_bufsize,
+	q.crf_max,
+	q.qpmax,
+	'63' AS "decomb",
+	NULL AS "nlmeans",
+	NULL AS "nlmeans_tune",
+	NULL AS "audio_language"
+
+FROM
+	ref_calibration_clips clip
+
+	JOIN ref_source_quality q
+	ON q.quality_title = clip.quality_title
+
+ORDER BY clip.clip_path;
+
+
+
+-- Calibration results
+-- Measured transfer speed for each region, averaged across the last 30 days of transfers
+
+CREATE OR REPLACE VIEW v_region_throughput AS
+
+SELECT
+	region,
+	SUM(file_size) / 1000000 / SUM(GREATEST(transfer_duration, 1)) AS "megabytes_per_second"
+
+FROM
+	history_transfer
+
+WHERE
+	queue_start > DATE_SUB(CURRENT_TIMESTAMP, INTERVAL 30 DAY)
+
+GROUP BY region
+
+ORDER BY region;
+
+
+
+-- Measured encoding speed for each droplet type and number of simultaneous tasks, averaged across every reference clip
+--
+-- throughput				seconds of video encoded per second by the whole droplet
+--
+-- throughput_per_dollar	seconds of video encoded per dollar spent on the droplet
+
+CREATE OR REPLACE VIEW v_calibration AS
+
+SELECT
+	droplet_type,
+	simultaneous_tasks,
+	AVG(fps) AS "fps",
+	AVG(speed) AS "speed",
+	AVG(speed) * simultaneous_tasks AS "throughput",
+	AVG(speed) * simultaneous_tasks * 3600 / AVG(hourly_cost) AS "throughput_per_dollar"
+
+FROM
+	history_calibration
+
+GROUP BY droplet_type, simultaneous_tasks
+
+ORDER BY droplet_type, simultaneous_tasks;
+
+
+
+-- Droplet time lost to failed, expired, and drained tasks in each queue, along with the droplets that were drained
+
+CREATE OR REPLACE VIEW v_wasted_minutes AS
+
+SELECT
+	queue.queue_start,
+	queue.droplet_type,
+	COUNT(lease.id) AS "lost_tasks",
+	COALESCE(SUM(lease.wasted_minutes), 0) AS "wasted_minutes",
+	(SELECT COUNT(*) FROM host_health AS host WHERE host.queue_start = queue.queue_start AND host.state != 'healthy') AS "drained_droplets"
+
+FROM
+	history_queue AS queue
+	LEFT JOIN history_lease AS lease ON lease.queue_start = queue.queue_start
+
+GROUP BY queue.queue_start, queue.droplet_type
+
+ORDER BY queue.queue_start;
+
+
+
+-- Estimated percentiles for each droplet type, task, quality title, encoder, and tune, from the task rollup histograms
+-- (each percentile is the midpoint of the first bucket that at least that share of tasks fall into or below)
+
+CREATE OR REPLACE VIEW v_task_percentiles AS
+
+SELECT
+	droplet_type,
+	task,
+	quality_title,
+	mpeg_encoder,
+	encoder_tune,
+	MIN(IF(metric = 'speed' AND cumulative_tasks >= 0.5 * total_tasks, POW(2, (bucket + 0.5) / 8), NULL)) AS "speed_p50",
+	MIN(IF(metric = 'speed' AND cumulative_tasks >= 0.9 * total_tasks, POW(2, (bucket + 0.5) / 8), NULL)) AS "speed_p90",
+	MIN(IF(metric = 'task_seconds' AND cumulative_tasks >= 0.5 * total_tasks, POW(2, (bucket + 0.5) / 8), NULL)) AS "task_seconds_p50",
+	MIN(IF(metric = 'task_seconds' AND cumulative_tasks >= 0.9 * total_tasks, POW(2, (bucket + 0.5) / 8), NULL)) AS "task_seconds_p90"
+
+FROM (
+	SELECT
+		droplet_type,
+		task,
+		quality_title,
+		mpeg_encoder,
+		encoder_tune,
+		metric,
+		bucket,
+		SUM(num_tasks) OVER (PARTITION BY droplet_type, task, quality_title, mpeg_encoder, encoder_tune, metric ORDER BY bucket) AS "cumulative_tasks",
+		SUM(num_tasks) OVER (PARTITION BY droplet_type, task, quality_title, mpeg_encoder, encoder_tune, metric) AS "total_tasks"
+	FROM
+		rollup_task_histogram
+) AS buckets
+
+GROUP BY droplet_type, task, quality_title, mpeg_encoder, encoder_tune;
+
+
+
+
+-- Task throughput for each droplet type, task, quality title, encoder, and tune, from the task rollups
+--
+-- speed					seconds of video processed per second by a single task, on average
+--
+-- speed_p50, speed_p90		median and 90th percentile speed
+--
+-- task_seconds_p50, task_seconds_p90
+--							median and 90th percentile time spent on each task
+--
+-- (percentiles are estimated from rollup_task_histogram, so they're accurate to within about 9%)
+
+CREATE OR REPLACE VIEW v_task_throughput AS
+
+SELECT
+	rollup.droplet_type,
+	rollup.task,
+	rollup.quality_title,
+	rollup.mpeg_encoder,
+	rollup.encoder_tune,
+	rollup.num_tasks,
+	rollup.source_seconds,
+	rollup.task_seconds,
+	rollup.source_seconds / NULLIF(rollup.timed_task_seconds, 0) AS "speed",
+	percentiles.speed_p50,
+	percentiles.speed_p90,
+	percentiles.task_seconds_p50,
+	percentiles.task_seconds_p90,
+	rollup.date_first_task,
+	rollup.date_last_task
+
+FROM
+	rollup_task AS rollup
+	LEFT JOIN v_task_percentiles AS percentiles ON (percentiles.droplet_type = rollup.droplet_type AND percentiles.task = rollup.task AND percentiles.quality_title = rollup.quality_title AND percentiles.mpeg_encoder = rollup.mpeg_encoder AND percentiles.encoder_tune = rollup.encoder_tune)
+
+ORDER BY rollup.droplet_type, rollup.task, rollup.quality_title, rollup.mpeg_encoder, rollup.encoder_tune;
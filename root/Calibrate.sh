@@ -0,0 +1,202 @@
+#!/bin/bash
+
+PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin
+
+# Calibrate.sh encodes a fixed set of reference clips (ref_calibration_clips) on each candidate droplet type,
+# with each number of simultaneous encodes we'd consider running on it, and records how quickly each clip was
+# encoded in history_calibration. Queue.sh then chooses droplet types based on those measurements.
+#
+# Run it manually (e.g. docker exec fitzflix bash /Calibrate.sh) after uploading the reference clips to ${S3_BUCKET}.
+# Set ${DO_CALIBRATION_CANDIDATES} to a comma-separated list of droplet slugs to only calibrate those droplet types.
+#
+# Run "Calibrate.sh local" to instead encode the reference clips on the local host, with ${LOCAL_ENCODES} simultaneous
+# encodes; Queue.sh uses that measurement to decide which encodes to run locally when encodes are set to "hybrid".
+
+
+configure_s3cmd () {
+
+	# Configure .s3cfg if it hasn't yet already been configured
+	if [ ! -f /root/.s3cfg ]
+	then
+
+		# There doesn't appear to be any way to set the gpg_passphrase variable on the command line, and building the .s3cfg file per
+		# https://stackoverflow.com/questions/38622898/configuring-s3cmd-non-interactively-through-bash-script?rq=1#comment64712342_38629201 and then
+		# using sed to replace the gpg_passphrase line with one containing our passphrase seems to give a permissions error,
+		# so instead we have to fake our way through the interactive configuration process.
+
+		echo -e "${S3_ACCESS_KEY}\n${S3_SECRET_KEY}\n\n\n\n${S3_GPG_PASSPHRASE}\n\n\n\nN\nY\n" | s3cmd --configure
+
+	fi
+
+}
+
+
+submit_ssh_key () {
+
+	# Create the ssh key if one doesn't already exist
+	if [ ! -f /root/.ssh/id_rsa ]
+	then
+
+		mkdir -p /root/.ssh/ &&
+
+		ssh-keygen -t rsa -b 4096 -a 100 -N '' -f /root/.ssh/id_rsa &&
+
+		# Set the key's permissions
+
+		chmod -R 700 /root/.ssh &&
+		chmod 644 /root/.ssh/id_rsa.pub &&
+		chmod 600 /root/.ssh/id_rsa
+
+	fi
+
+	# Get the existing key's fingerprint and key value
+	current_fingerprint=$(ssh-keygen -E md5 -lf /root/.ssh/id_rsa.pub | cut -f2 -d \ | cut -c 5-) &&
+	current_key=$(cat /root/.ssh/id_rsa.pub) &&
+
+	# Check DigitalOcean for our current key fingerprint and get its key_id, or submit our key if it's not already there
+	python3 /fitzflix.py keycheck --apikey=${DO_API_KEY} --fingerprint="${current_fingerprint}" --sshkey="${current_key}"
+
+}
+
+
+# ========================================================================================
+# ========================================================================================
+
+# Use the dropletSpecs.txt file as a lock, the same as Queue.sh does
+# (Both scripts create droplets with the same names, and destroy all droplets with the "fitzflix-transcoder" tag)
+
+if [[ -f /dropletSpecs.txt ]]
+then
+	echo "A queue or calibration is already running!"
+	exit 1
+fi
+
+touch /dropletSpecs.txt &&
+
+
+# =====
+# Start the calibration
+
+configure_s3cmd &&
+
+calibrationStart=$(date +%s) &&
+
+
+# =====
+# Calibrate the local host
+
+if [[ "${1}" == "local" ]]
+then
+
+	echo "Calibrating the local host..." &&
+
+	# Export the reference clips in the same format as our other queues, so they can be passed to tasks.sh
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT * FROM v_calibration_queue;" -B --skip-column-names > /queue_calibration_clips.tsv &&
+
+	calibrationSubject=$(echo "Subject: Fitzflix `date +\"%Y-%m-%d %H:%M:%S %z\"` Calibration") &&
+
+	# tasks.sh reads the specifications for this calibration run from the last line of dropletSpecs.txt
+	# (the local host doesn't cost anything extra to run, and there aren't any droplets)
+	echo -e "${calibrationStart}\tlocal\t$(nproc)\t${LOCAL_ENCODES:=1}\t0\t0" > /dropletSpecs.txt &&
+
+	# Download each clip before encoding, so several copies of a clip aren't downloading at once
+	cut -f1,3 /queue_calibration_clips.tsv | while IFS=$'\t' read -r clipPath dirPath ; do mkdir -p /Originals"${dirPath}" && s3cmd get --force "s3://${S3_BUCKET}${clipPath}" /Originals"${clipPath}" ; done &&
+
+	# Run ${LOCAL_ENCODES} copies of each clip at the same time, the same number of encodes Queue.sh runs locally
+	awk -F '\t' -v OFS='\t' -v copies="${LOCAL_ENCODES}" '{ name = $4 ; for (i = 1 ; i <= copies ; i++) { $4 = name " (" i ")" ; print } }' /queue_calibration_clips.tsv > /queue_calibration.tsv &&
+
+	TASK_LOCATION=local /usr/local/bin/parallel --no-notice -a /queue_calibration.tsv --colsep '\t' --jobs ${LOCAL_ENCODES} /mnt/storage/tasks.sh
+
+	# Remove the clips and their encodes, so they don't end up in our library
+	# (v_calibration_queue puts every clip in /Calibration)
+	rm -rf /Originals/Calibration /Plex/Calibration
+	cut -f4 /queue_calibration.tsv | while read -r plexName ; do rm -rf "/Renditions/${plexName}" ; done
+
+	# Send an email with the calibration results
+	cat /recipient.txt <(echo "${calibrationSubject}") <(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT * FROM v_calibration WHERE droplet_type = 'local';") | /usr/sbin/sendmail -t
+
+	# Release the lock
+	rm /dropletSpecs.txt /queue_calibration_clips.tsv /queue_calibration.tsv
+
+	exit
+
+fi &&
+
+
+# =====
+# Calibrate droplets
+
+# List the droplet types and simultaneous encodes to calibrate
+if [[ -z "${DO_CALIBRATION_CANDIDATES}" ]]
+then
+	python3 /fitzflix.py calibrate --apikey=${DO_API_KEY} --region=${DO_REGION:="nyc3"} --cpu=${DO_MIN_CPU:=1} --ram=${DO_MIN_RAM:=1} | sed -n '/^Droplet Type\t/,$p' | tail -n +2 > /calibrationPlan.tsv
+else
+	python3 /fitzflix.py calibrate --apikey=${DO_API_KEY} --candidates=${DO_CALIBRATION_CANDIDATES} --region=${DO_REGION:="nyc3"} --cpu=${DO_MIN_CPU:=1} --ram=${DO_MIN_RAM:=1} | sed -n '/^Droplet Type\t/,$p' | tail -n +2 > /calibrationPlan.tsv
+fi &&
+
+# Export the reference clips in the same format as our other queues, so they can be passed to tasks.sh
+mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT * FROM v_calibration_queue;" -B --skip-column-names > /queue_calibration_clips.tsv &&
+
+calibrationSubject=$(echo "Subject: Fitzflix `date +\"%Y-%m-%d %H:%M:%S %z\"` Calibration") &&
+cat /recipient.txt <(echo "${calibrationSubject}") <(cat /calibrationPlan.tsv) | /usr/sbin/sendmail -t &&
+
+# Double-check that we didn't leave any droplets running earlier
+python3 /fitzflix.py delete --apikey=${DO_API_KEY}
+
+# Submit SSH key fingerprint to DigitalOcean
+submit_ssh_key &&
+
+# Get our SSH key fingerprint so we can add our SSH key to our calibration droplets for passwordless login
+current_fingerprint=$(ssh-keygen -E md5 -lf /root/.ssh/id_rsa.pub | cut -f2 -d \ | cut -c 5-) &&
+
+# Prevent asking for each host's SSH key by temporarily disabling StrictHostKeyChecking
+touch /root/.ssh/config &&
+cp /root/.ssh/config /root/.ssh/config.backup &&
+(echo "Host *" ; echo "StrictHostKeyChecking no") >> /root/.ssh/config &&
+
+
+# Calibrate one droplet type at a time
+for dropletType in $(cut -f1 /calibrationPlan.tsv | uniq)
+do
+
+	# Create a single droplet with enough block storage for the largest number of simultaneous encodes we'll try on it,
+	# in the most preferred region from ${DO_REGION} that it's available in
+	maxSimultaneous=$(awk -F '\t' -v dropletType="${dropletType}" '$1 == dropletType { print $5 }' /calibrationPlan.tsv | sort -n | tail -n1) &&
+	dropletRegion=$(awk -F '\t' -v dropletType="${dropletType}" '$1 == dropletType { print $6 }' /calibrationPlan.tsv | head -n1) &&
+
+	echo "Calibrating ${dropletType}..." &&
+
+	python3 /fitzflix.py create --apikey=${DO_API_KEY} --id=1 --size=${dropletType} --fingerprint=${current_fingerprint} --simultaneous=${maxSimultaneous} --region=${dropletRegion} | tail -n1 | ( read dropletIP dropletRegion ; [ -z "${dropletIP}" ] && exit 1 ; parallelStatus="1" ; while [ ${parallelStatus} -eq 1 ] ; do ssh -q ${dropletIP} [[ ! -f /usr/local/bin/parallel ]] && sleep 5 || parallelStatus="0" ; done && echo ${dropletIP} > /sshloginfile.txt ; ) &&
+
+	# Encode the reference clips with each number of simultaneous encodes
+	# (The first run is always with a single encode, which downloads each clip to the droplet one at a time
+	#  before it's encoded, so later runs don't have several copies of a clip downloading at once)
+	awk -F '\t' -v dropletType="${dropletType}" '$1 == dropletType' /calibrationPlan.tsv | while IFS=$'\t' read -r slug numCPUs ram hourlyCost simultaneousEncodes region
+	do
+
+		# tasks.sh reads the droplet specifications for this calibration run from the last line of dropletSpecs.txt
+		echo -e "${calibrationStart}\t${dropletType}\t${numCPUs}\t${simultaneousEncodes}\t${hourlyCost}\t1" > /dropletSpecs.txt &&
+
+		# Run ${simultaneousEncodes} copies of each clip at the same time, so each encode is measured while competing
+		# with as many other encodes as it would during a queue (each copy gets its own Plex name so their outputs don't collide)
+		awk -F '\t' -v OFS='\t' -v copies="${simultaneousEncodes}" '{ name = $4 ; for (i = 1 ; i <= copies ; i++) { $4 = name " (" i ")" ; print } }' /queue_calibration_clips.tsv > /queue_calibration.tsv &&
+
+		/usr/local/bin/parallel --no-notice -a /queue_calibration.tsv --colsep '\t' --use-cpus-instead-of-cores --jobs ${simultaneousEncodes} --env DEFAULT_HANDBRAKE_PRESET --env MYSQL_DB --env MYSQL_HOST --env MYSQL_PASSWORD --env MYSQL_PORT --env MYSQL_USER --env NATIVE_LANGUAGE --env S3_ACCESS_KEY --env S3_BUCKET --env S3_GPG_PASSPHRASE --env S3_SECRET_KEY --sshloginfile /sshloginfile.txt --workdir /mnt/storage --basefile /mnt/storage/tasks.sh --basefile /mnt/storage/dropletSpecs.txt --cleanup /mnt/storage/tasks.sh
+
+	done
+
+	# Destroy the calibration droplet before moving on to the next droplet type
+	python3 /fitzflix.py delete --apikey=${DO_API_KEY} &&
+
+	rm /sshloginfile.txt
+
+done
+
+# Re-enable StrictHostKeyChecking
+mv /root/.ssh/config.backup /root/.ssh/config
+
+# Send an email with the calibration results
+cat /recipient.txt <(echo "${calibrationSubject}") <(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT * FROM v_calibration;") | /usr/sbin/sendmail -t
+
+# Release the lock
+rm /dropletSpecs.txt /calibrationPlan.tsv /queue_calibration_clips.tsv /queue_calibration.tsv
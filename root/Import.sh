@@ -311,6 +311,48 @@ else
 fi
 
 
+# Determine if the source's video already meets our target profile, in which case it can be copied into an .m4v
+# with only its audio transcoded, instead of being re-encoded on a droplet (e.g. web-sourced H.264 at a sensible bitrate)
+#
+# The video has to be 8-bit 4:2:0 H.264 (Baseline, Main or High profile, up to level 4.2) at no more than 1920x1080, and not interlaced.
+# Any subtitles have to be text, which can be kept as soft subtitles, and if the audio isn't in ${NATIVE_LANGUAGE}
+# there can't be any subtitles at all, since HandBrake would otherwise burn the ${NATIVE_LANGUAGE} subtitles into the video.
+# (v_queue only remuxes an eligible file if it's also under its quality's bitrate cap and no other encoding settings apply to it)
+
+videoCount=$(mediainfo --Output="General;%VideoCount%" "${OUTPUTDIR}/${ORIGINALFILENAME}")
+subtitleCount=$(mediainfo --Output="General;%TextCount%" "${OUTPUTDIR}/${ORIGINALFILENAME}")
+videoFormat=$(mediainfo --Output="Video;%Format%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | head -n1)
+videoProfile=$(mediainfo --Output="Video;%Format_Profile%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | head -n1)
+videoLevel=$(mediainfo --Output="Video;%Format_Level%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | head -n1)
+videoBitDepth=$(mediainfo --Output="Video;%BitDepth%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | head -n1)
+videoChroma=$(mediainfo --Output="Video;%ChromaSubsampling%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | head -n1)
+videoWidth=$(mediainfo --Output="Video;%Width%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | head -n1)
+videoHeight=$(mediainfo --Output="Video;%Height%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | head -n1)
+videoScanType=$(mediainfo --Output="Video;%ScanType%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | head -n1)
+audioLanguage=$(mediainfo --Output="Audio;%Language/String3%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | head -n1)
+nonTextSubtitles=$(mediainfo --Output="Text;%Format%\n" "${OUTPUTDIR}/${ORIGINALFILENAME}" | grep -v "^$" | grep -cvxE "UTF-8|SubRip|Timed Text")
+
+# Older versions of mediainfo report the level as part of the profile (e.g. High@L4.1)
+if [[ -z ${videoLevel} ]]
+then
+	videoLevel=$(echo "${videoProfile}" | grep -oP "(?<=@L)[0-9.]+")
+fi
+
+videoProfile=${videoProfile%%@*}
+
+if [[ "${videoCount}" == "1" ]] && [[ "${videoFormat}" == "AVC" ]] && [[ "${videoProfile}" =~ ^(Constrained\ Baseline|Baseline|Main|High)$ ]] && [[ ! -z ${videoLevel} ]] && awk -v level="${videoLevel}" 'BEGIN { exit !(level + 0 <= 4.2) }' && [[ "${videoBitDepth}" == "8" ]] && [[ "${videoChroma}" == "4:2:0" ]] && [[ ${videoWidth:-9999} -le 1920 ]] && [[ ${videoHeight:-9999} -le 1080 ]] && [[ "${videoScanType}" != "Interlaced" ]] && [[ "${videoScanType}" != "MBAFF" ]] && [[ ${nonTextSubtitles} -eq 0 ]] && ( [[ ${subtitleCount:-0} -eq 0 ]] || [[ "${audioLanguage}" == "${NATIVE_LANGUAGE:=eng}" ]] )
+then
+
+	echo "Video already meets the target profile, so it will be remuxed instead of transcoded" &&
+	remux_eligible="T"
+	
+else
+
+	remux_eligible="F"
+	
+fi
+
+
 	
 
 
@@ -364,7 +406,7 @@ then
 	
 	# Add the file to the database
 	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO presets_titles (plex_name, movie_title, release_year, release_identifier) VALUES ('${escaped_plex_name}', '${escaped_movie_title}', '${escaped_release_year}', ${escaped_release_identifier});"
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO files (file_path, dir_path, base_name, plex_name, quality_title, crop, vbv_maxrate, file_duration) VALUES ('${escaped_file_path}', '${escaped_dir_path}', '${escaped_base_name}', '${escaped_plex_name}', '${escaped_quality_title}', ${crop}, ${vbv_maxrate}, ${file_duration});"
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO files (file_path, dir_path, base_name, plex_name, quality_title, crop, vbv_maxrate, file_duration, remux_eligible) VALUES ('${escaped_file_path}', '${escaped_dir_path}', '${escaped_base_name}', '${escaped_plex_name}', '${escaped_quality_title}', ${crop}, ${vbv_maxrate}, ${file_duration}, '${remux_eligible}');"
 	
 	cat /recipient.txt <(echo "Subject: Fitzflix Import") <(echo "${file_path}") | /usr/sbin/sendmail -t
 	
@@ -431,7 +473,7 @@ then
 	# Add the file to the database
 	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO presets_series (series_title) VALUES ('${escaped_series_title}');"
 	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO presets_titles (plex_name, series_title, season_number, episode_number, release_identifier) VALUES ('${escaped_plex_name}', '${escaped_series_title}', '${escaped_season_number}', '${escaped_episode_number}', ${escaped_release_identifier});"
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO files (file_path, dir_path, base_name, plex_name, quality_title, crop, vbv_maxrate, file_duration) VALUES ('${escaped_file_path}', '${escaped_dir_path}', '${escaped_base_name}', '${escaped_plex_name}', '${escaped_quality_title}', ${crop}, ${vbv_maxrate}, ${file_duration});"
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO files (file_path, dir_path, base_name, plex_name, quality_title, crop, vbv_maxrate, file_duration, remux_eligible) VALUES ('${escaped_file_path}', '${escaped_dir_path}', '${escaped_base_name}', '${escaped_plex_name}', '${escaped_quality_title}', ${crop}, ${vbv_maxrate}, ${file_duration}, '${remux_eligible}');"
 
 	cat /recipient.txt <(echo "Subject: Fitzflix Import") <(echo "${file_path}") | /usr/sbin/sendmail -t
 	
@@ -86,9 +86,55 @@ create_queues () {
 	#			needs a --return variable to return the transcoded video to our library
 	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT * FROM V_QUEUE WHERE task = 'encode';" -B --skip-column-names > /queue_encode.tsv &&
 	
+	# Files restored from Glacier storage become available a few at a time as Restore.sh sees them thaw,
+	# so unless we already have droplets running, hold back their encodes until there's a batch of them
+	# worth creating droplets for
+	restoredEncodes=$(awk -F '\t' '$25 != "NULL"' /queue_encode.tsv | wc -l) &&
+	
+	if [[ ${restoredEncodes} -gt 0 ]] && [[ ! -f /sshloginfile.txt ]]
+	then
+	
+		# Other remote tasks will need droplets created anyway
+		otherRemoteTasks=$(( $(wc -l < /queue_archive.tsv) + $(awk -F '\t' '$25 == "NULL"' /queue_encode.tsv | wc -l) )) &&
+		
+		# Restores that haven't yet thawed, which we could be waiting on to fill the batch
+		pendingRestores=$(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT COUNT(*) FROM files WHERE date_file_deleted IS NOT NULL AND date_restore_requested IS NOT NULL AND date_restore_available IS NULL;" -B --skip-column-names) &&
+		
+		# Restored copies that will expire within the next 12 hours, which shouldn't be kept waiting
+		expiringRestores=$(awk -F '\t' -v cutoff="$(date -d '+12 hours' '+%Y-%m-%d %H:%M:%S')" '$25 != "NULL" && $28 != "NULL" && $28 < cutoff' /queue_encode.tsv | wc -l) &&
+		
+		if [[ ${otherRemoteTasks} -eq 0 ]] && [[ ${pendingRestores} -gt 0 ]] && [[ ${expiringRestores} -eq 0 ]] && [[ ${restoredEncodes} -lt ${RESTORE_BATCH_SIZE:=10} ]]
+		then
+			echo "Waiting for more restored files (${restoredEncodes} of ${RESTORE_BATCH_SIZE} available, ${pendingRestores} pending)..." &&
+			awk -F '\t' '$25 == "NULL"' /queue_encode.tsv > /queue_encode_held.tsv &&
+			mv /queue_encode_held.tsv /queue_encode.tsv
+		fi
+	
+	fi &&
+	
+	# Export the measured throughput of each droplet type we've calibrated with Calibrate.sh
+	# (along with the local host's, if it's been calibrated with "Calibrate.sh local")
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT droplet_type, simultaneous_tasks, fps, speed, throughput, throughput_per_dollar FROM v_calibration;" -B --skip-column-names > /calibration.tsv &&
+	
+	# hybrid:	if encodes are set to "hybrid" in task_locations, move each encode the local host would finish
+	#			before a droplet could into its own queue, which we encode locally alongside the droplets
+	encodeLocation=$(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT location FROM task_locations WHERE task = 'encode';" -B --skip-column-names) &&
+	
+	if [[ "${encodeLocation}" == "hybrid" ]] && [[ $(wc -l < /queue_encode.tsv) -gt 0 ]]
+	then
+		python3 /fitzflix.py place --calibration=/calibration.tsv --encodequeue=/queue_encode.tsv --localqueue=/queue_encode_local.tsv --localslots=${LOCAL_ENCODES:=1} --boottime=${DO_BOOT_SECONDS:=600} --maxdroplets=${DO_MAX_DROPLETS:=5}
+	else
+		> /queue_encode_local.tsv
+	fi &&
+	
+	# remux:	files whose video Import.sh found already meets our target profile only need their audio transcoded,
+	#			which the local host can do in a few minutes, so they're never counted toward the droplets we create
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT * FROM V_QUEUE WHERE task = 'remux';" -B --skip-column-names > /queue_remux.tsv &&
+	
 	# local:	items that can ONLY be done on a local machine, or simple tasks that don't need much CPU that can be done anywhere (so we prefer to process on the local machine - no need to spin up a droplet)
-	#			e.g. we can only delete files on the host by the host, we can request files to be restored from Glacier from any machine as it's just a webservice call, etc.
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT * FROM V_QUEUE WHERE task NOT IN ('archive', 'encode');" -B --skip-column-names > /queue_local.tsv &&
+	#			e.g. we can only delete files on the host by the host, etc.
+	#			(restore requests are submitted in batches by Restore.sh instead)
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT * FROM V_QUEUE WHERE task NOT IN ('archive', 'encode', 'remux', 'restore');" -B --skip-column-names > /queue_local.tsv &&
 	
 	# Return the number of tasks we are able to perform on remote machines
 	# We'll use this number to determine how many droplets to create
@@ -100,6 +146,30 @@ create_queues () {
 }
 
 
+move_renditions () {
+
+	# Move any renditions in ${1}'s queue to their primary versions' directories in the Plex library
+	awk -F '\t' '{printf ("%s\t%s\n", $3, $4) }' "${1}" | while IFS=$'\t' read -r dirPath plexName ; do if [[ -d "/Renditions/${plexName}" ]] ; then find "/Renditions/${plexName}" -type f -exec mv {} "/Plex${dirPath}/" \; ; rmdir "/Renditions/${plexName}" ; fi ; done
+	
+}
+
+
+remove_renditions () {
+
+	# Remove the files of any renditions that have been deleted from presets_renditions (or no longer apply to their title),
+	# since nothing re-encodes a title just because one of its renditions was removed
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT rendition.rendition_path FROM renditions rendition LEFT JOIN v_renditions current ON current.plex_name = rendition.plex_name AND current.rendition_name = rendition.rendition_name WHERE current.plex_name IS NULL;" -B --skip-column-names | while read -r renditionPath
+	do
+		echo "Removing ${renditionPath}..." &&
+		rm -f "/Plex${renditionPath}" &&
+		escapedRenditionPath=$(printf %q "${renditionPath}") &&
+		mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "DELETE FROM renditions WHERE rendition_path = '${escapedRenditionPath}';" ||
+		echo "Couldn't remove ${renditionPath}."
+	done
+	
+}
+
+
 submit_ssh_key () {
 
 	# Create the ssh key if one doesn't already exist
@@ -149,17 +219,33 @@ configure_s3cmd &&
 # Configure Postfix if it hasn't yet been configured
 configure_postfix &&
 
+# Clean up renditions that have been deleted since the last queue
+remove_renditions &&
+
 # Determine how many remote-capable tasks we have in queue
 numRemoteTasks=$(create_queues | tail -n1) &&
 
 # Exit if we don't have any items in any queue
-if [[ $(($(wc -l < /queue_archive.tsv) + $(wc -l < /queue_encode.tsv) + $(wc -l < /queue_local.tsv) )) -eq 0 ]]
+if [[ $(($(wc -l < /queue_archive.tsv) + $(wc -l < /queue_encode.tsv) + $(wc -l < /queue_encode_local.tsv) + $(wc -l < /queue_remux.tsv) + $(wc -l < /queue_local.tsv) )) -eq 0 ]]
 then
 	exit
 fi &&
 
-# Choose a particular droplet type based on the number of remote tasks to complete
-python3 /fitzflix.py choose --apikey=${DO_API_KEY} --remotetasks=${numRemoteTasks} --maxdroplets=${DO_MAX_DROPLETS:=5} --region=${DO_REGION:="nyc3"} --cpu=${DO_MIN_CPU:=1} --ram=${DO_MIN_RAM:=1} | tee /dropletSpecs.txt &&
+# Total the seconds of video we have to encode
+# (files without a known duration are counted as the average duration of those that have one)
+remoteSeconds=$(awk -F '\t' '$7 != "NULL" { total += $7 ; counted++ } $7 == "NULL" { uncounted++ } END { if (counted > 0) { total += uncounted * (total / counted) } ; printf ("%d\n", total) }' /queue_encode.tsv) &&
+
+# Export the measured transfer speed of each region we've created droplets in
+mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT region, megabytes_per_second FROM v_region_throughput;" -B --skip-column-names > /throughput.tsv &&
+
+# Total the size of the files we have to transfer for remote tasks
+# (files we've deleted locally and will be downloaded from S3 are counted as the average size of those we still have)
+remoteBytes=$(cut -f1 /queue_archive.tsv /queue_encode.tsv | while read -r filePath ; do if [[ -f "/Originals${filePath}" ]] ; then stat -c %s "/Originals${filePath}" ; else echo "NULL" ; fi ; done | awk '$1 != "NULL" { total += $1 ; counted++ } $1 == "NULL" { uncounted++ } END { if (counted > 0) { total += uncounted * (total / counted) } ; printf ("%d\n", total) }') &&
+
+# Choose a particular droplet type based on the number of remote tasks to complete,
+# using the measured throughput of each droplet type if we've calibrated them,
+# and spreading the droplets across the regions in ${DO_REGION} our files transfer to and from fastest
+python3 /fitzflix.py choose --apikey=${DO_API_KEY} --remotetasks=${numRemoteTasks} --remoteseconds=${remoteSeconds} --remotebytes=${remoteBytes} --calibration=/calibration.tsv --throughput=/throughput.tsv --maxdroplets=${DO_MAX_DROPLETS:=5} --regiondroplets=${DO_MAX_DROPLETS_PER_REGION:=0} --region=${DO_REGION:="nyc3"} --cpu=${DO_MIN_CPU:=1} --ram=${DO_MIN_RAM:=1} | tee /dropletSpecs.txt &&
 
 # Send an email with the number and type of droplets that were created
 queueSubject=$(echo "Subject: Fitzflix `date +\"%Y-%m-%d %H:%M:%S %z\"` Queue") &&
@@ -171,6 +257,8 @@ numCPUs=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f3) &&
 simultaneousEncodes=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f4) &&
 hourlyCost=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f5) &&
 numDroplets=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f6) &&
+dropletRegions=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f7) &&
+fallbackRegions=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f8) &&
 
 escapedQueueStart=$(printf %q "${queueStart}") &&
 escapedDropletType=$(printf %q "${dropletType}") &&
@@ -178,9 +266,10 @@ escapedNumCPUs=$(printf %q "${numCPUs}") &&
 escapedSimultaneousEncodes=$(printf %q "${simultaneousEncodes}") &&
 escapedHourlyCost=$(printf %q "${hourlyCost}") &&
 escapedNumDroplets=$(printf %q "${numDroplets}") &&
+escapedDropletRegions=$(printf %q "${dropletRegions}") &&
 
 # Start the queue history
-mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_queue (queue_start, droplet_type, num_cpus, simultaneous_tasks, hourly_cost, num_droplets) VALUES (FROM_UNIXTIME('${escapedQueueStart}'), '${escapedDropletType}', '${escapedNumCPUs}', '${escapedSimultaneousEncodes}', '${escapedHourlyCost}', '${escapedNumDroplets}');" &&
+mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_queue (queue_start, droplet_type, num_cpus, simultaneous_tasks, hourly_cost, num_droplets, regions) VALUES (FROM_UNIXTIME('${escapedQueueStart}'), '${escapedDropletType}', '${escapedNumCPUs}', '${escapedSimultaneousEncodes}', '${escapedHourlyCost}', '${escapedNumDroplets}', '${escapedDropletRegions}');" &&
 
 
 # Create droplets if we have at least one remote task in queue
@@ -194,7 +283,7 @@ then
 	python3 /fitzflix.py delete --apikey=${DO_API_KEY} &&
 
 	# Delete our list of remote nodes
-	rm /sshloginfile.txt
+	rm /sshloginfile.txt /dropletHosts.tsv
 
 	# Re-enable StrictHostKeyChecking
 	mv /root/.ssh/config.backup /root/.ssh/config
@@ -207,13 +296,24 @@ then
 	
 	# Prevent asking for each host's SSH key by temporarily disabling StrictHostKeyChecking
 	# (We'll re-enable it when we destroy the droplets we just created)
+	# and drop any SSH session whose droplet stops responding for 2 minutes, so parallel can retry its task on another droplet
 	touch /root/.ssh/config &&
 	cp /root/.ssh/config /root/.ssh/config.backup &&
-	(echo "Host *" ; echo "StrictHostKeyChecking no") >> /root/.ssh/config &&
+	(echo "Host *" ; echo "StrictHostKeyChecking no" ; echo "ServerAliveInterval 30" ; echo "ServerAliveCountMax 4") >> /root/.ssh/config &&
+	
+	# When agent.py hands out tasks, every SSH session and file transfer to a droplet shares a single connection to it,
+	# so only the first has to authenticate (GNU parallel opens a session per task, which would soon run into sshd's MaxSessions limit)
+	if [[ "${REMOTE_DISPATCH:=agent}" == "agent" ]]
+	then
+		(echo "ControlMaster auto" ; echo "ControlPath /root/.ssh/fitzflix-%r@%h:%p" ; echo "ControlPersist 10m") >> /root/.ssh/config
+	fi &&
 	
 	
 	# Create ${numDroplets} of ${dropletType}, each with 100GB of attached storage per ${simultaneousEncodes}.
 	# e.g. 5 droplets of c-4 (High CPU, 4 CPU / 6 GB RAM) type, with 2 simultaneous encodes (meaning 200 GB of attached block storage) per droplet
+	# Each droplet is created in its own region from the comma-separated ${dropletRegions} list (linked to each droplet's ID with :::+),
+	# or in the first of ${fallbackRegions} (fastest transfers first) it can be created in if its own region fails;
+	# we record the region it was actually created in
 	
 	# Store each droplet's IP address in sshloginfile.txt
 	# (We create them using parallel so we can create them all at once, rather than waiting 1+ min for each droplet to create in sequence)
@@ -226,21 +326,58 @@ then
 	# but this script is meant to run on a headless NAS with as little manual intervention as possible!
 	# See also: https://www.gnu.org/licenses/gpl-faq.html#RequireCitation
 	
-	parallel --no-notice -j0 'python3 /fitzflix.py create --apikey={1} --id={2} --size={3} --fingerprint={4} --simultaneous={5} --region={6} | tail -n1 | ( read dropletIP ; parallelStatus="1" ; while [ ${parallelStatus} -eq 1 ] ; do ssh -q ${dropletIP} [[ ! -f /usr/local/bin/parallel ]] && sleep 5 || parallelStatus="0" ; done && echo ${dropletIP} | tee -a /sshloginfile.txt ; )' ::: ${DO_API_KEY} ::: $(seq 1 ${numDroplets}) ::: ${dropletType} ::: ${current_fingerprint} ::: ${simultaneousEncodes} ::: ${DO_REGION:="nyc3"}
+	parallel --no-notice -j0 'python3 /fitzflix.py create --apikey={1} --id={2} --region={3} --size={4} --fingerprint={5} --simultaneous={6} --fallback={7} | tail -n1 | ( read dropletIP dropletRegion ; [ -z "${dropletIP}" ] && exit ; parallelStatus="1" ; while [ ${parallelStatus} -eq 1 ] ; do ssh -q ${dropletIP} [[ ! -f /usr/local/bin/parallel ]] && sleep 5 || parallelStatus="0" ; done && echo -e "${dropletIP#root@}\t{2}\t${dropletRegion}" >> /dropletHosts.tsv && echo ${dropletIP} | tee -a /sshloginfile.txt ; )' ::: ${DO_API_KEY} ::: $(seq 1 ${numDroplets}) :::+ $(echo ${dropletRegions} | tr ',' ' ') ::: ${dropletType} ::: ${current_fingerprint} ::: ${simultaneousEncodes} ::: ${fallbackRegions}
+	
+	# Start tracking the health of each droplet that was created, for Watchdog.sh
+	# (Watchdog.sh also replaces any droplets that failed to be created)
+	awk -F '\t' -v queueStart="${escapedQueueStart}" '{ printf ("INSERT INTO host_health (queue_start, host, droplet_number, region) VALUES (FROM_UNIXTIME('\''%s'\''), '\''%s'\'', '\''%s'\'', '\''%s'\'');\n", queueStart, $1, $2, $3) }' /dropletHosts.tsv | mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"}
 
 fi &&
 
 
 # Keep processing tasks until we have nothing left in any queue
-while [[ $(($(wc -l < /queue_archive.tsv) + $(wc -l < /queue_encode.tsv) + $(wc -l < /queue_local.tsv) )) -gt 0 ]]
+while [[ $(($(wc -l < /queue_archive.tsv) + $(wc -l < /queue_encode.tsv) + $(wc -l < /queue_encode_local.tsv) + $(wc -l < /queue_remux.tsv) + $(wc -l < /queue_local.tsv) )) -gt 0 ]]
 do
 
+	# hybrid:	encodes placed on the local host run in the background while the droplets work through the other queues
+	#			(we wait for them to finish before exporting the next set of queues, and never start them again while they're still running)
+	if [[ $(wc -l < /queue_encode_local.tsv) -gt 0 ]] && ! kill -0 ${localEncodePID:-} 2> /dev/null
+	then
+		echo "Encoding files locally..." &&
+		(
+			TASK_LOCATION=local /usr/local/bin/parallel --no-notice -a /queue_encode_local.tsv --colsep '\t' --jobs ${LOCAL_ENCODES:=1} /mnt/storage/tasks.sh &&
+			move_renditions /queue_encode_local.tsv &&
+			cat /recipient.txt <(echo "${queueSubject}") <(awk -F '\t' '{printf ("%s\t%s\n", $2, $1) }' /queue_encode_local.tsv) | /usr/sbin/sendmail -t
+		) &
+		localEncodePID=$!
+	fi
+	
+	# remux:	remuxes run in the background on the local host too, alongside any local encodes
+	#			(and likewise are never started again while they're still running)
+	if [[ $(wc -l < /queue_remux.tsv) -gt 0 ]] && ! kill -0 ${remuxPID:-} 2> /dev/null
+	then
+		echo "Remuxing files locally..." &&
+		(
+			TASK_LOCATION=local /usr/local/bin/parallel --no-notice -a /queue_remux.tsv --colsep '\t' --jobs ${LOCAL_REMUXES:=2} /mnt/storage/tasks.sh &&
+			cat /recipient.txt <(echo "${queueSubject}") <(awk -F '\t' '{printf ("%s\t%s\n", $2, $1) }' /queue_remux.tsv) | /usr/sbin/sendmail -t
+		) &
+		remuxPID=$!
+	fi
+
 	# archive:	can be done on local and remote machines (preferably remote, due to the overhead needed to encrypt each file before uploading to S3)
 	#         	this parallel command doesn't need a --return variable since there's nothing to be returned from the remote host
+	#
+	#			remote tasks are handed to the agent.py running on each droplet over a single SSH connection, which copies the
+	#			next task's file over while the current one runs (set ${REMOTE_DISPATCH} to "parallel" to start a GNU parallel SSH session per task instead)
 	if [[ $(wc -l < /queue_archive.tsv) -gt 0 ]]
 	then
 		echo "Archiving files..." &&
-		/usr/local/bin/parallel --no-notice -a /queue_archive.tsv --colsep '\t' --use-cpus-instead-of-cores --jobs ${simultaneousEncodes} --env DEFAULT_HANDBRAKE_PRESET --env MYSQL_DB --env MYSQL_HOST --env MYSQL_PASSWORD --env MYSQL_PORT --env MYSQL_USER --env NATIVE_LANGUAGE --env S3_ACCESS_KEY --env S3_BUCKET --env S3_GPG_PASSPHRASE --env S3_SECRET_KEY --sshloginfile /sshloginfile.txt --workdir /mnt/storage --basefile /mnt/storage/tasks.sh --basefile /mnt/storage/dropletSpecs.txt --transferfile /mnt/storage/Originals{1} --cleanup /mnt/storage/tasks.sh &&
+		if [[ "${REMOTE_DISPATCH:=agent}" == "agent" ]]
+		then
+			python3 /agent.py dispatch --queue=/queue_archive.tsv --sshloginfile=/sshloginfile.txt --jobs=${simultaneousEncodes} --retries=${TASK_RETRIES:=3}
+		else
+			/usr/local/bin/parallel --no-notice -a /queue_archive.tsv --colsep '\t' --use-cpus-instead-of-cores --jobs ${simultaneousEncodes} --retries ${TASK_RETRIES:=3} --env DEFAULT_HANDBRAKE_PRESET --env MYSQL_DB --env MYSQL_HOST --env MYSQL_PASSWORD --env MYSQL_PORT --env MYSQL_USER --env NATIVE_LANGUAGE --env S3_ACCESS_KEY --env S3_BUCKET --env S3_GPG_PASSPHRASE --env S3_SECRET_KEY --sshloginfile /sshloginfile.txt --workdir /mnt/storage --basefile /mnt/storage/tasks.sh --basefile /mnt/storage/dropletSpecs.txt --transferfile /mnt/storage/Originals{1} --cleanup /mnt/storage/tasks.sh
+		fi &&
 		cat /recipient.txt <(echo "${queueSubject}") <(awk -F '\t' '{printf ("%s\t%s\n", $2, $1) }' /queue_archive.tsv) | /usr/sbin/sendmail -t
 	fi &&
 	
@@ -249,23 +386,45 @@ do
 	if [[ $(wc -l < /queue_encode.tsv) -gt 0 ]]
 	then
 		echo "Encoding files..." &&
-		/usr/local/bin/parallel --no-notice -a /queue_encode.tsv --colsep '\t' --use-cpus-instead-of-cores --jobs ${simultaneousEncodes} --env DEFAULT_HANDBRAKE_PRESET --env MYSQL_DB --env MYSQL_HOST --env MYSQL_PASSWORD --env MYSQL_PORT --env MYSQL_USER --env NATIVE_LANGUAGE --env S3_ACCESS_KEY --env S3_BUCKET --env S3_GPG_PASSPHRASE --env S3_SECRET_KEY --sshloginfile /sshloginfile.txt --workdir /mnt/storage --basefile /mnt/storage/tasks.sh --basefile /mnt/storage/dropletSpecs.txt --transferfile /mnt/storage/Originals{1} --return /mnt/storage/Plex"{3}/{4}.m4v" --cleanup /mnt/storage/tasks.sh &&
+		if [[ "${REMOTE_DISPATCH:=agent}" == "agent" ]]
+		then
+			python3 /agent.py dispatch --queue=/queue_encode.tsv --sshloginfile=/sshloginfile.txt --jobs=${simultaneousEncodes} --retries=${TASK_RETRIES:=3} --return
+		else
+			/usr/local/bin/parallel --no-notice -a /queue_encode.tsv --colsep '\t' --use-cpus-instead-of-cores --jobs ${simultaneousEncodes} --retries ${TASK_RETRIES:=3} --env DEFAULT_HANDBRAKE_PRESET --env MYSQL_DB --env MYSQL_HOST --env MYSQL_PASSWORD --env MYSQL_PORT --env MYSQL_USER --env NATIVE_LANGUAGE --env S3_ACCESS_KEY --env S3_BUCKET --env S3_GPG_PASSPHRASE --env S3_SECRET_KEY --sshloginfile /sshloginfile.txt --workdir /mnt/storage --basefile /mnt/storage/tasks.sh --basefile /mnt/storage/dropletSpecs.txt --transferfile /mnt/storage/Originals{1} --return /mnt/storage/Plex"{3}/{4}.m4v" --return /mnt/storage/Renditions/"{4}" --cleanup /mnt/storage/tasks.sh
+		fi &&
+		
+		# Move any renditions that were returned alongside their primary versions in the Plex library
+		move_renditions /queue_encode.tsv &&
+		
 		cat /recipient.txt <(echo "${queueSubject}") <(awk -F '\t' '{printf ("%s\t%s\n", $2, $1) }' /queue_encode.tsv) | /usr/sbin/sendmail -t
 	fi &&
 	
 	# local:	items that can ONLY be done on a local machine, or simple tasks that don't need much CPU that can be done anywhere (so we prefer to process on the local machine - no need to spin up a droplet)
-	#			e.g. we can only delete files on the host by the host, we can request files to be restored from Glacier from any machine as it's just a webservice call, etc.
+	#			e.g. we can only delete files on the host by the host, etc.
 	if [[ $(wc -l < /queue_local.tsv) -gt 0 ]]
 	then
 		echo "Processing local tasks..." &&
-		/usr/local/bin/parallel --no-notice -a /queue_local.tsv --colsep '\t' --jobs 0 /mnt/storage/tasks.sh &&
+		TASK_LOCATION=local /usr/local/bin/parallel --no-notice -a /queue_local.tsv --colsep '\t' --jobs 0 /mnt/storage/tasks.sh &&
 		cat /recipient.txt <(echo "${queueSubject}") <(awk -F '\t' '{printf ("%s\t%s\n", $2, $1) }' /queue_local.tsv) | /usr/sbin/sendmail -t
-	fi &&
+	fi
+	
+	# Wait for any local encodes and remuxes to finish, even if one of the phases above failed,
+	# so we never export the next set of queues (or start the same local encodes again) while they're still running
+	wait
 	
 	create_queues
 	
 done &&
 
+# Wait for Watchdog.sh to finish replacing any droplets, and keep it from starting again while we destroy them
+# (a lock more than 30 minutes old was left behind by a Watchdog.sh run that was killed, so don't wait for it)
+while [[ -f /watchdogLock.txt ]] && [[ -z $(find /watchdogLock.txt -mmin +30) ]]
+do
+	sleep 10
+done &&
+
+touch /watchdogLock.txt &&
+
 # Destroy all droplets with the "fitzflix-transcoder" tag
 python3 /fitzflix.py delete --apikey=${DO_API_KEY} &&
 
@@ -280,8 +439,14 @@ queueDuration=$(echo "((${queueDuration} / 60) + 59) / 60" | bc) &&
 # Estimate queue cost
 estimatedCost=$(echo "${hourlyCost} * ${queueDuration} * ${numDroplets}" | bc) &&
 
+# Release any leases left behind by the destroyed droplets
+mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "DELETE FROM job_leases WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}');" &&
+
+# Total the droplet time lost to tasks that failed or were taken from unhealthy droplets
+wastedMinutes=$(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT wasted_minutes, lost_tasks, drained_droplets FROM v_wasted_minutes WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}');" -B --skip-column-names) &&
+
 # Send an email when all droplets have been destroyed
-cat /recipient.txt <(echo "${queueSubject}") <(echo "Estimated cost: \$`printf \"%.02f\n\" ${estimatedCost}`") | /usr/sbin/sendmail -t &&
+cat /recipient.txt <(echo "${queueSubject}") <(echo "Estimated cost: \$`printf \"%.02f\n\" ${estimatedCost}`") <(echo "${wastedMinutes}" | awk -F '\t' '$2 > 0 { printf ("Droplet minutes lost to %d failed tasks: %.0f (%d droplets drained)\n", $2, $1, $3) }') | /usr/sbin/sendmail -t &&
 
 # Delete our list of remote nodes
 rm /dropletSpecs.txt &&
@@ -294,9 +459,12 @@ if [[ ${numRemoteTasks} -gt 0 ]]
 then
 	
 	# Delete the list of nodes we could log in to
-	rm /sshloginfile.txt &&
+	rm /sshloginfile.txt /dropletHosts.tsv &&
 	
 	# Re-enable StrictHostKeyChecking
 	mv /root/.ssh/config.backup /root/.ssh/config
 	
-fi
\ No newline at end of file
+fi
+
+# Let Watchdog.sh watch the next queue
+rm -f /watchdogLock.txt
\ No newline at end of file
@@ -0,0 +1,74 @@
+#!/bin/bash
+
+PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin
+
+# Restore.sh requests every file v_queue has marked "restore" from Glacier storage in a single batch,
+# and then checks each file we're still waiting on to see if S3 has actually finished restoring it.
+#
+# Files are marked as available as soon as S3 reports they've been restored, so Queue.sh can encode them
+# right away rather than waiting for a fixed amount of time after they were requested.
+
+
+# ========================================================================================
+# ========================================================================================
+
+# Use the restoreLock.txt file as a lock
+# If it exists, then an earlier restore check is still running
+# (a lock more than an hour old was left behind by a run that was killed, so it's taken over)
+
+if [[ -f /restoreLock.txt ]] && [[ -z $(find /restoreLock.txt -mmin +60) ]]
+then
+	exit
+fi
+
+touch /restoreLock.txt
+
+# Release the lock however this run ends
+trap 'rm -f /restoreLock.txt' EXIT
+
+
+# =====
+# Request restores
+
+# Export the files that need to be restored
+mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT file_path FROM v_queue WHERE task = 'restore';" -B --skip-column-names > /restore_request.txt
+
+if [[ $(wc -l < /restore_request.txt) -gt 0 ]]
+then
+
+	echo "Requesting $(wc -l < /restore_request.txt) files be restored..." &&
+
+	# Submit all of the restore requests at once, using the "bulk" restore priority as it's the cheapest
+	# See https://aws.amazon.com/glacier/pricing/ for Glacier request pricing
+	python3 /fitzflix.py restore --accesskey=${S3_ACCESS_KEY} --secretkey=${S3_SECRET_KEY} --bucket=${S3_BUCKET} --files=/restore_request.txt --days=${S3_RESTORE_DAYS:=3} | sed -n '/^File Path\t/,$p' | tail -n +2 > /restore_status.tsv &&
+
+	# Update the database to indicate which restores have been requested
+	# (files that had already been restored will be picked up when we check for thawed files below)
+	awk -F '\t' '$2 == "requested" || $2 == "available" { gsub(/\\/, "\\\\\\\\", $1) ; gsub(/'\''/, "\\'\''", $1) ; printf ("UPDATE files SET date_restore_requested = CURRENT_TIMESTAMP WHERE file_path = '\''%s'\'';\n", $1) }' /restore_status.tsv | mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"}
+
+fi
+
+
+# =====
+# Check for thawed files
+
+# Export the files we've requested but haven't yet seen become available
+mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT file_path FROM files WHERE date_file_deleted IS NOT NULL AND date_restore_requested IS NOT NULL AND date_restore_available IS NULL;" -B --skip-column-names > /restore_pending.txt
+
+if [[ $(wc -l < /restore_pending.txt) -gt 0 ]]
+then
+
+	echo "Checking $(wc -l < /restore_pending.txt) pending restores..." &&
+
+	python3 /fitzflix.py thaw --accesskey=${S3_ACCESS_KEY} --secretkey=${S3_SECRET_KEY} --bucket=${S3_BUCKET} --files=/restore_pending.txt | sed -n '/^File Path\t/,$p' | tail -n +2 > /restore_status.tsv &&
+
+	# Mark each thawed file as available (along with when its restored copy expires), so it can be encoded in the next queue,
+	# and clear the request for any restore S3 no longer knows about, so v_queue will request it again
+	awk -F '\t' '{ gsub(/\\/, "\\\\\\\\", $1) ; gsub(/'\''/, "\\'\''", $1) } $2 == "available" && $3 == "NULL" { printf ("UPDATE files SET date_restore_available = CURRENT_TIMESTAMP, date_restore_expires = NULL WHERE file_path = '\''%s'\'';\n", $1) } $2 == "available" && $3 != "NULL" { printf ("UPDATE files SET date_restore_available = CURRENT_TIMESTAMP, date_restore_expires = FROM_UNIXTIME(%s) WHERE file_path = '\''%s'\'';\n", $3, $1) } $2 == "expired" { printf ("UPDATE files SET date_restore_requested = NULL WHERE file_path = '\''%s'\'';\n", $1) }' /restore_status.tsv | mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} &&
+
+	echo "$(awk -F '\t' '$2 == "available"' /restore_status.tsv | wc -l) files are now available for download."
+
+fi
+
+# Release the lock
+rm -f /restore_request.txt /restore_pending.txt /restore_status.tsv /restoreLock.txt
@@ -0,0 +1,170 @@
+#!/bin/bash
+
+PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin
+
+# Watchdog.sh keeps an eye on a queue's droplets while the queue is running. Each remote task is leased to the
+# droplet working on it (see tasks.sh), and the droplet renews its lease with a heartbeat every minute.
+#
+# Each run, Watchdog.sh:
+#
+#   - expires leases whose droplet has stopped sending heartbeats
+#   - drains droplets that held an expired lease, failed ${HOST_MAX_FAILURES} tasks, or no longer respond over SSH,
+#     by removing them from sshloginfile.txt (agent.py and GNU parallel both re-read it as tasks are handed out) and ending their
+#     SSH sessions, so their tasks are retried on the remaining droplets right away
+#   - destroys drained droplets, and creates replacements so the queue keeps the number of droplets it started with
+
+
+# ========================================================================================
+# ========================================================================================
+
+# Only watch queues that have droplets running
+
+if [[ ! -f /sshloginfile.txt ]] || [[ ! -f /dropletSpecs.txt ]]
+then
+	exit
+fi
+
+# Use the watchdogLock.txt file as a lock
+# If it exists, then an earlier check is still running (or the queue is destroying its droplets)
+# (a lock more than 30 minutes old was left behind by a run that was killed, so it's taken over)
+
+if [[ -f /watchdogLock.txt ]] && [[ -z $(find /watchdogLock.txt -mmin +30) ]]
+then
+	exit
+fi
+
+touch /watchdogLock.txt
+
+# Release the lock however this run ends
+trap 'rm -f /watchdogLock.txt' EXIT
+
+queueStart=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f1)
+dropletType=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f2)
+simultaneousEncodes=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f4)
+numDroplets=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f6)
+
+escapedQueueStart=$(printf %q "${queueStart}")
+
+# Queue.sh adds each droplet to host_health once they've all been created, so there's nothing to watch until then
+numHosts=$(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT COUNT(*) FROM host_health WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}');" -B --skip-column-names)
+
+if [[ -z "${numHosts}" ]] || [[ ${numHosts} -eq 0 ]]
+then
+	exit
+fi
+
+
+# =====
+# Expire leases
+
+# Record each expired lease as lost, drain the droplet that held it, and release the lease so the task can be handed to another droplet
+mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SET @now = CURRENT_TIMESTAMP; INSERT INTO history_lease (queue_start, file_path, task, host, outcome, date_leased) SELECT queue_start, file_path, task, host, 'expired', date_leased FROM job_leases WHERE date_lease_expires < @now; UPDATE host_health SET jobs_failed = jobs_failed + (SELECT COUNT(*) FROM job_leases WHERE job_leases.host = host_health.host AND date_lease_expires < @now), state = 'draining' WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}') AND state = 'healthy' AND host IN (SELECT host FROM job_leases WHERE date_lease_expires < @now); DELETE FROM job_leases WHERE date_lease_expires < @now;"
+
+
+# =====
+# Check each droplet's health
+
+# Drain droplets that have failed too many tasks
+mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "UPDATE host_health SET state = 'draining' WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}') AND state = 'healthy' AND jobs_failed >= ${HOST_MAX_FAILURES:=2};"
+
+# Drain droplets that no longer respond over SSH
+for host in $(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT host FROM host_health WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}') AND state = 'healthy';" -B --skip-column-names)
+do
+
+	if ! ssh -q -o BatchMode=yes -o ConnectTimeout=30 root@${host} true
+	then
+		echo "${host} isn't responding." &&
+		mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "UPDATE host_health SET state = 'draining' WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}') AND host = '${host}';"
+	fi
+
+done
+
+
+# =====
+# Drain unhealthy droplets
+
+for host in $(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT host FROM host_health WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}') AND state = 'draining';" -B --skip-column-names)
+do
+
+	echo "Draining ${host}..."
+
+	# Stop handing tasks to the droplet
+	grep -v -x -F "root@${host}" /sshloginfile.txt > /sshloginfile.tmp
+	mv /sshloginfile.tmp /sshloginfile.txt
+
+	# Record the tasks it was still working on as lost, and release their leases so they can be handed to another droplet
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_lease (queue_start, file_path, task, host, outcome, date_leased) SELECT queue_start, file_path, task, host, 'drained', date_leased FROM job_leases WHERE host = '${host}'; DELETE FROM job_leases WHERE host = '${host}';"
+
+	# End our SSH sessions and file transfers with the droplet (including its shared SSH connection), so its tasks are retried on another droplet
+	pkill -f "root@${host//./\\.}([ :]|$)"
+
+	# Destroy the droplet and its block storage
+	python3 /fitzflix.py destroy --apikey=${DO_API_KEY} --host=${host} &&
+
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "UPDATE host_health SET state = 'destroyed' WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}') AND host = '${host}';"
+
+done
+
+
+# =====
+# Replace destroyed droplets
+
+# Keep the queue at the number of droplets it started with (including any that failed to be created), as long as there are
+# still remote tasks to process, up to ${HOST_MAX_REPLACEMENTS} replacements per queue
+healthyDroplets=$(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT COUNT(*) FROM host_health WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}') AND state = 'healthy';" -B --skip-column-names)
+replacementDroplets=$(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT COUNT(*) FROM host_health WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}') AND droplet_number > ${numDroplets};" -B --skip-column-names)
+remoteTasks=$(( $(wc -l < /queue_archive.tsv) + $(wc -l < /queue_encode.tsv) ))
+
+if [[ ${healthyDroplets} -lt ${numDroplets} ]] && [[ ${replacementDroplets} -lt ${HOST_MAX_REPLACEMENTS:=${numDroplets}} ]] && [[ ${remoteTasks} -gt 0 ]]
+then
+
+	# Give the replacement the next droplet number, so its droplet and block storage names don't collide with the others,
+	# and create it in the same region as the droplet it replaces (or the queue's first region)
+	dropletNumber=$(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT GREATEST(COALESCE(MAX(droplet_number), 0), ${numDroplets}) + 1 FROM host_health WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}');" -B --skip-column-names) &&
+	dropletRegion=$(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT region FROM host_health WHERE queue_start = FROM_UNIXTIME('${escapedQueueStart}') AND state = 'destroyed' AND region IS NOT NULL ORDER BY date_state_changed DESC LIMIT 1;" -B --skip-column-names) &&
+
+	if [[ -z "${dropletRegion}" ]]
+	then
+		dropletRegion=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f7 | cut -d ',' -f1)
+	fi &&
+
+	fallbackRegions=$(tail -n1 /dropletSpecs.txt | tr -s '\t' | cut -f8) &&
+
+	echo "Replacing a droplet with ${dropletType} #${dropletNumber} in ${dropletRegion}..." &&
+
+	current_fingerprint=$(ssh-keygen -E md5 -lf /root/.ssh/id_rsa.pub | cut -f2 -d \ | cut -c 5-) &&
+
+	# Give the replacement 10 minutes to finish setting itself up before handing it tasks; if it still isn't ready,
+	# destroy it and record it as destroyed, so it counts towards ${HOST_MAX_REPLACEMENTS} and the next run tries again
+	# (if it can't be created in ${dropletRegion}, it's created in the first of ${fallbackRegions} that it can be)
+	python3 /fitzflix.py create --apikey=${DO_API_KEY} --id=${dropletNumber} --region=${dropletRegion} --fallback=${fallbackRegions} --size=${dropletType} --fingerprint=${current_fingerprint} --simultaneous=${simultaneousEncodes} | tail -n1 | (
+
+		read dropletIP dropletRegion
+
+		if [ -z "${dropletIP}" ]
+		then
+			echo "Couldn't create ${dropletType} #${dropletNumber} in any region."
+			exit
+		fi
+
+		parallelStatus="1"
+		readyAttempts="0"
+
+		while [ ${parallelStatus} -eq 1 ] && [ ${readyAttempts} -lt 120 ]
+		do
+			ssh -q -o ConnectTimeout=5 ${dropletIP} [[ ! -f /usr/local/bin/parallel ]] && sleep 5 && readyAttempts=$(( readyAttempts + 1 )) || parallelStatus="0"
+		done
+
+		if [ ${parallelStatus} -eq 0 ]
+		then
+			echo ${dropletIP} >> /sshloginfile.txt &&
+			mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO host_health (queue_start, host, droplet_number, region) VALUES (FROM_UNIXTIME('${escapedQueueStart}'), '${dropletIP#root@}', '${dropletNumber}', '${dropletRegion}');"
+		else
+			echo "${dropletIP#root@} wasn't ready after 10 minutes." &&
+			python3 /fitzflix.py destroy --apikey=${DO_API_KEY} --host=${dropletIP#root@} ;
+			mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO host_health (queue_start, host, droplet_number, region, state) VALUES (FROM_UNIXTIME('${escapedQueueStart}'), '${dropletIP#root@}', '${dropletNumber}', '${dropletRegion}', 'destroyed');"
+		fi
+
+	)
+
+fi
@@ -0,0 +1,745 @@
+"""Fitzflix agent
+
+Usage:
+  agent.py dispatch --queue=FILE --sshloginfile=FILE [--jobs=NUM] [--retries=NUM] [--return]
+  agent.py serve [--slots=NUM]
+
+Options:
+  -h, --help          Show this help.
+  --jobs=NUM          Number of tasks each droplet performs at the same time. [default: 1]
+  --queue=FILE        Queue of remote tasks exported from v_queue.
+  --retries=NUM       Number of times to try each task before giving up on it. [default: 3]
+  --return            Return each task's transcoded video and renditions to the local host.
+  --slots=NUM         Number of tasks to perform at the same time. [default: 1]
+  --sshloginfile=FILE  Droplets to hand tasks to, one user@host per line; re-read as droplets are added or drained.
+
+"""
+
+import collections, json, os, pymysql, queue, re, shlex, signal, subprocess, sys, threading, time, urllib.request
+from docopt import docopt
+
+STORAGE = "/mnt/storage"
+
+# Copied to each droplet once, when we first connect to it
+BASEFILES = ["/mnt/storage/agent.py", "/mnt/storage/dropletSpecs.txt", "/mnt/storage/tasks.sh"]
+
+# Passed to the agent once over its channel, rather than exported to every task's SSH session
+ENVIRONMENT = ["DEFAULT_HANDBRAKE_PRESET", "MYSQL_DB", "MYSQL_HOST", "MYSQL_PASSWORD", "MYSQL_PORT", "MYSQL_USER", "NATIVE_LANGUAGE", "S3_ACCESS_KEY", "S3_BUCKET", "S3_GPG_PASSPHRASE", "S3_SECRET_KEY"]
+
+# How often the agent reports each task's progress, in seconds
+PROGRESSINTERVAL = 15
+
+# How often the agent renews the leases of the tasks it's running, and how long each renewal lasts, in seconds
+# (the same as tasks.sh's heartbeat and lease_length)
+HEARTBEATINTERVAL = 60
+LEASELENGTH = 300
+
+# How often the dispatcher re-reads the sshloginfile, in seconds
+HOSTINTERVAL = 10
+
+# How long the dispatcher waits without any droplets before giving up on the tasks it has left, in seconds
+# (Watchdog.sh can take several minutes to replace a droplet)
+HOSTTIMEOUT = 1800
+
+
+# agent_connect()
+#
+# Input: environment to read the database settings from
+# Returns: connection to the Fitzflix database, or None if it can't be reached
+#
+# Connects using the same environment variables as the rest of our scripts
+def agent_connect(env=os.environ):
+
+	try:
+
+		return pymysql.connect(
+			host = env.get('MYSQL_PORT_3306_TCP_ADDR', env.get('MYSQL_HOST')),
+			port = int(env.get('MYSQL_PORT_3306_TCP_PORT', env.get('MYSQL_PORT', 3306))),
+			user = env.get('MYSQL_USER'),
+			password = env.get('MYSQL_PASSWORD'),
+			db = env.get('MYSQL_DB', "fitzflix_db"),
+			charset = "utf8mb4",
+			autocommit = True
+		)
+
+	except pymysql.err.MySQLError as err:
+
+		print("Couldn't connect to the database, so task progress and heartbeats won't be recorded: {}".format(err))
+
+		return None
+
+
+# agent_dispatch()
+#
+# Input: queue file exported from v_queue, sshloginfile, tasks per droplet, tries per task, whether to return transcoded files
+# Returns: number of tasks that failed
+#
+# Hands each task in the queue to the agent on one of the droplets in the sshloginfile, keeping a single SSH channel open to each
+# droplet (multiplexed with its file transfers through the ControlMaster set up by Queue.sh) instead of opening a session per task.
+# Droplets added to the sshloginfile are picked up as it's re-read, and droplets removed from it (by Watchdog.sh) aren't given any
+# more tasks; a task that fails, or whose droplet is lost, is tried again, preferably on a droplet that hasn't tried it yet
+def agent_dispatch(queueFile, loginFile, slots=1, retries=3, returnFiles=False):
+
+	with open(queueFile) as f:
+
+		lines = [line.rstrip('\n') for line in f if line.strip()]
+
+	state = {
+		'pending': collections.deque({'id': i, 'args': line.split('\t'), 'attempts': 0, 'hosts': []} for i, line in enumerate(lines)),
+		'assigned': 0,
+		'failed': 0,
+		'hosts': {},
+		'condition': threading.Condition(),
+		'db': agent_connect(),
+		'dbLock': threading.Lock(),
+		'loginFile': loginFile,
+		'retries': retries
+	}
+
+	lastHostSeen = time.time()
+
+	while True:
+
+		with state['condition']:
+
+			if len(state['pending']) == 0 and state['assigned'] == 0:
+
+				break
+
+		try:
+
+			with open(loginFile) as f:
+
+				hosts = [line.strip() for line in f if line.strip()]
+
+		except OSError:
+
+			hosts = []
+
+		with state['condition']:
+
+			# Stop handing tasks to any droplet that's no longer listed
+			for host in state['hosts']:
+
+				if host not in hosts:
+
+					state['hosts'][host]['draining'] = True
+
+			for host in hosts:
+
+				# (a droplet that ran out of tasks is reconnected to if a task fails and is put back in the queue)
+				if host not in state['hosts'] or not state['hosts'][host]['thread'].is_alive() and not state['hosts'][host]['draining'] and len(state['pending']) > 0:
+
+					state['hosts'][host] = {'draining': False}
+					state['hosts'][host]['thread'] = threading.Thread(target=agent_host, args=(host, state, slots, returnFiles), daemon=True)
+					state['hosts'][host]['thread'].start()
+
+			if any(info['thread'].is_alive() for info in state['hosts'].values()):
+
+				lastHostSeen = time.time()
+
+			elif time.time() - lastHostSeen > HOSTTIMEOUT:
+
+				print("No droplets have been available for {} minutes, giving up on {} tasks.".format(HOSTTIMEOUT // 60, len(state['pending'])))
+
+				state['failed'] = state['failed'] + len(state['pending'])
+				state['pending'].clear()
+
+				break
+
+			state['condition'].wait(HOSTINTERVAL)
+
+	for info in state['hosts'].values():
+
+		info['thread'].join()
+
+	if state['db'] is not None:
+
+		state['db'].close()
+
+	return state['failed']
+
+
+# agent_drained()
+#
+# Input: dispatcher state, droplet
+# Returns: True if Watchdog.sh has drained the droplet, False if not
+#
+# Watchdog.sh removes a droplet from sshloginfile.txt just before ending our SSH sessions with it,
+# so check the file itself rather than waiting for agent_dispatch() to notice it's gone
+def agent_drained(state, host):
+
+	with state['condition']:
+
+		if state['hosts'][host]['draining']:
+
+			return True
+
+	try:
+
+		with open(state['loginFile']) as f:
+
+			return host not in [line.strip() for line in f if line.strip()]
+
+	except OSError:
+
+		return False
+
+
+# agent_finish()
+#
+# Input: dispatcher state, task, droplet it was run on, exit status (or None if it never got a fair try)
+# Returns: none
+#
+# Records a task as finished, or puts it back in the queue to be tried again if it failed and has tries left
+def agent_finish(state, job, host, status):
+
+	with state['condition']:
+
+		state['assigned'] = state['assigned'] - 1
+
+		if status is None:
+
+			# The task was prefetched but never started, or was lost when Watchdog.sh drained its droplet,
+			# so it doesn't count as a try
+			state['pending'].appendleft(job)
+
+		elif status != 0:
+
+			job['attempts'] = job['attempts'] + 1
+			job['hosts'].append(host)
+
+			if job['attempts'] < state['retries']:
+
+				print("{}\t{} failed on {} (try {} of {}), trying again...".format(job['args'][1], job['args'][0], host, job['attempts'], state['retries']))
+				state['pending'].appendleft(job)
+
+			else:
+
+				print("{}\t{} failed on {} after {} tries.".format(job['args'][1], job['args'][0], host, job['attempts']))
+				state['failed'] = state['failed'] + 1
+
+		state['condition'].notify_all()
+
+		sys.stdout.flush()
+
+
+# agent_heartbeat()
+#
+# Input: database connection, this droplet's public IP address, tasks being run (process: file path), event set when the agent stops
+# Returns: none
+#
+# Renews the lease of every task the agent is running every HEARTBEATINTERVAL seconds over the agent's one database connection,
+# instead of each tasks.sh starting a mysql client every minute to renew its own lease
+def agent_heartbeat(db, host, children, stopped):
+
+	while not stopped.wait(HEARTBEATINTERVAL):
+
+		filePaths = list(children.values())
+
+		if len(filePaths) == 0:
+
+			continue
+
+		try:
+
+			db.ping(reconnect=True)
+
+			with db.cursor() as cursor:
+
+				cursor.execute("UPDATE job_leases SET date_heartbeat = CURRENT_TIMESTAMP, date_lease_expires = CURRENT_TIMESTAMP + INTERVAL %s SECOND WHERE file_path IN ({}) AND host = %s".format(", ".join(["%s"] * len(filePaths))), [LEASELENGTH] + filePaths + [host])
+
+		except pymysql.err.MySQLError as err:
+
+			print("Couldn't renew leases: {}".format(err))
+
+
+# agent_host()
+#
+# Input: droplet, dispatcher state, tasks to run at the same time, whether to return transcoded files
+# Returns: none
+#
+# Copies our scripts to the droplet, starts its agent, and keeps it busy with tasks from the queue until there are none left
+# or the droplet is drained. While all of the droplet's slots are busy, the next task's original file is copied to it
+# in the background, so it can start as soon as a slot is free
+def agent_host(host, state, slots, returnFiles):
+
+	print("Connecting to {}...".format(host))
+
+	if subprocess.call(["ssh", host, "mkdir -p {}".format(STORAGE)]) != 0 or subprocess.call(["rsync", "-a"] + [path for path in BASEFILES if os.path.isfile(path)] + ["{}:{}/".format(host, STORAGE)]) != 0:
+
+		print("Couldn't copy our scripts to {}.".format(host))
+
+		return
+
+	agent = subprocess.Popen(["ssh", host, "cd {} && python3 agent.py serve --slots={}".format(STORAGE, slots)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+
+	messages = queue.Queue()
+
+	def read():
+
+		for line in agent.stdout:
+
+			try:
+
+				messages.put(json.loads(line))
+
+			except ValueError:
+
+				print("{}: {}".format(host, line.rstrip()))
+
+		messages.put(None)
+
+	threading.Thread(target=read, daemon=True).start()
+
+	def send(message):
+
+		agent.stdin.write(json.dumps(message) + "\n")
+		agent.stdin.flush()
+
+	running = {}
+	prefetch = None
+	connected = True
+
+	try:
+
+		send({'type': 'env', 'env': {name: os.environ[name] for name in ENVIRONMENT if name in os.environ}})
+
+		while True:
+
+			# Fill any free slots, starting with the task we've already copied over
+			while len(running) < slots and not state['hosts'][host]['draining']:
+
+				if prefetch is not None:
+
+					job, pushed = prefetch
+					prefetch = None
+					pushed.join()
+
+				else:
+
+					job = agent_take(state, host)
+
+					if job is None:
+
+						break
+
+					agent_push(host, job)
+
+				if job['pushed'] != 0:
+
+					print("Couldn't copy {} to {}.".format(job['args'][0], host))
+					agent_finish(state, job, host, job['pushed'])
+
+					continue
+
+				running[job['id']] = job
+				send({'type': 'job', 'id': job['id'], 'args': job['args']})
+
+			# Copy the next task's original file while this droplet's slots are busy
+			if prefetch is None and len(running) >= slots and not state['hosts'][host]['draining']:
+
+				job = agent_take(state, host)
+
+				if job is not None:
+
+					pushed = threading.Thread(target=agent_push, args=(host, job), daemon=True)
+					pushed.start()
+					prefetch = (job, pushed)
+
+			if len(running) == 0:
+
+				break
+
+			try:
+
+				message = messages.get(timeout=HOSTINTERVAL)
+
+			except queue.Empty:
+
+				continue
+
+			if message is None:
+
+				connected = False
+
+				print("Lost the connection to {}.".format(host))
+
+				break
+
+			if message['type'] == 'progress':
+
+				job = running.get(message['id'])
+
+				if job is not None:
+
+					print("{}\t{}\t{}: {:.2f}%".format(job['args'][1], job['args'][0], host, message['percent']))
+					agent_record(state, job, host, message['percent'])
+
+			elif message['type'] == 'done':
+
+				job = running.pop(message['id'], None)
+
+				if job is None:
+
+					continue
+
+				sys.stdout.write(message['output'])
+
+				status = message['status']
+
+				if status == 0 and returnFiles:
+
+					status = agent_pull(host, job)
+
+				agent_remove(host, job, returnFiles)
+
+				print("{}\t{}\t{}: finished in {} seconds with exit status {}".format(job['args'][1], job['args'][0], host, message['seconds'], status))
+
+				# (a task that failed because Watchdog.sh drained its droplet and ended its SSH sessions isn't the task's fault)
+				if status != 0 and agent_drained(state, host):
+
+					status = None
+
+				agent_finish(state, job, host, status)
+
+	except OSError:
+
+		connected = False
+
+		print("Lost the connection to {}.".format(host))
+
+	# Hand back whatever this droplet didn't finish
+	# (only counting it as a try if the droplet wasn't drained by Watchdog.sh)
+	drained = len(running) > 0 and agent_drained(state, host)
+
+	for job in running.values():
+
+		agent_finish(state, job, host, None if drained else 1)
+
+	if prefetch is not None:
+
+		prefetch[1].join()
+		agent_finish(state, prefetch[0], host, None)
+
+	try:
+
+		if connected:
+
+			send({'type': 'shutdown'})
+
+		agent.stdin.close()
+
+	except OSError:
+
+		pass
+
+	agent.wait()
+
+
+# agent_progress()
+#
+# Input: path to a task's log file, duration of the video in seconds
+# Returns: percent of the task completed, or None if it can't be determined
+#
+# HandBrake logs its progress as a percentage, while ffmpeg logs the timestamp it has encoded up to
+def agent_progress(logPath, duration):
+
+	try:
+
+		with open(logPath, 'rb') as f:
+
+			f.seek(0, os.SEEK_END)
+			f.seek(max(f.tell() - 8192, 0))
+
+			log = f.read().decode('utf-8', 'replace')
+
+	except OSError:
+
+		return None
+
+	percents = re.findall(r"(\d+\.\d+) %", log)
+
+	if len(percents) > 0:
+
+		return float(percents[-1])
+
+	times = re.findall(r"time=(\d+):(\d+):(\d+(?:\.\d+)?)", log)
+
+	if len(times) > 0 and duration > 0:
+
+		hours, minutes, seconds = times[-1]
+
+		return min((int(hours) * 3600 + int(minutes) * 60 + float(seconds)) / duration * 100, 100)
+
+	return None
+
+
+# agent_pull()
+#
+# Input: droplet, task
+# Returns: exit status of the transfer
+#
+# Returns the transcoded video and any renditions from the droplet to the local host
+def agent_pull(host, job):
+
+	dirPath = job['args'][2]
+	plexName = job['args'][3]
+
+	os.makedirs("{}/Plex{}".format(STORAGE, dirPath), exist_ok=True)
+	os.makedirs("{}/Renditions".format(STORAGE), exist_ok=True)
+
+	status = subprocess.call(["rsync", "-a", "-s", "{}:{}/Plex{}/{}.m4v".format(host, STORAGE, dirPath, plexName), "{}/Plex{}/".format(STORAGE, dirPath)])
+
+	if status == 0:
+
+		# (titles without renditions don't have a Renditions directory)
+		status = subprocess.call(["rsync", "-a", "-s", "--ignore-missing-args", "{}:{}/Renditions/{}".format(host, STORAGE, plexName), "{}/Renditions/".format(STORAGE)])
+
+	return status
+
+
+# agent_push()
+#
+# Input: droplet, task
+# Returns: none
+#
+# Copies the task's original file to the droplet, if we still have it, and records the transfer's exit status in the task
+# (tasks.sh downloads it from S3 instead if we've already deleted it locally)
+def agent_push(host, job):
+
+	filePath = "{}/Originals{}".format(STORAGE, job['args'][0])
+
+	if not os.path.isfile(filePath):
+
+		job['pushed'] = 0
+
+		return
+
+	job['pushed'] = subprocess.call(["ssh", host, "mkdir -p {}".format(shlex.quote(os.path.dirname(filePath)))]) or subprocess.call(["rsync", "-a", "-s", filePath, "{}:{}".format(host, filePath)])
+
+
+# agent_record()
+#
+# Input: dispatcher state, task, droplet it's running on, percent completed
+# Returns: none
+#
+# Records the task's progress against its lease, over the dispatcher's one database connection
+# (only if the lease is still this droplet's, the same as agent_heartbeat())
+def agent_record(state, job, host, percent):
+
+	if state['db'] is None:
+
+		return
+
+	with state['dbLock']:
+
+		try:
+
+			state['db'].ping(reconnect=True)
+
+			with state['db'].cursor() as cursor:
+
+				# Leases are held by the droplet's own IP address, without the user in sshloginfile.txt
+				cursor.execute("UPDATE job_leases SET progress = %s WHERE file_path = %s AND host = %s", (round(percent, 2), job['args'][0], host.split('@')[-1]))
+
+		except pymysql.err.MySQLError as err:
+
+			print("Couldn't record progress: {}".format(err))
+
+
+# agent_remove()
+#
+# Input: droplet, task, whether its transcoded files were returned
+# Returns: none
+#
+# Removes the task's files from the droplet once it's finished with them, so its block storage doesn't fill up
+def agent_remove(host, job, returnFiles):
+
+	paths = ["{}/Originals{}".format(STORAGE, job['args'][0])]
+
+	if returnFiles:
+
+		paths.append("{}/Plex{}/{}.m4v".format(STORAGE, job['args'][2], job['args'][3]))
+		paths.append("{}/Renditions/{}".format(STORAGE, job['args'][3]))
+
+	subprocess.call(["ssh", host, "rm -rf -- {}".format(" ".join(shlex.quote(path) for path in paths))])
+
+
+# agent_run()
+#
+# Input: task message from the dispatcher, environment to run it with, function to send messages back to the dispatcher,
+#        tasks being run (process: file path)
+# Returns: none
+#
+# Runs tasks.sh for the task, reporting its progress every PROGRESSINTERVAL seconds, and its exit status and output once it finishes
+def agent_run(message, env, send, children):
+
+	args = message['args']
+
+	outputPath = "{}/agent-{}.out".format(STORAGE, message['id'])
+	logPath = "{}/{}.log".format(STORAGE, args[3])
+	duration = int(args[6]) if len(args) > 6 and args[6].isdigit() else 0
+
+	taskStart = time.time()
+
+	with open(outputPath, 'w') as output:
+
+		task = subprocess.Popen(["/bin/bash", "{}/tasks.sh".format(STORAGE)] + args, cwd=STORAGE, env=env, stdout=output, stderr=subprocess.STDOUT, start_new_session=True)
+
+	children[task] = args[0]
+
+	lastPercent = None
+
+	while True:
+
+		try:
+
+			task.wait(timeout=PROGRESSINTERVAL)
+
+			break
+
+		except subprocess.TimeoutExpired:
+
+			percent = agent_progress(logPath, duration)
+
+			if percent is not None and percent != lastPercent:
+
+				send({'type': 'progress', 'id': message['id'], 'percent': percent})
+
+				lastPercent = percent
+
+	children.pop(task, None)
+
+	with open(outputPath) as output:
+
+		text = output.read()
+
+	os.remove(outputPath)
+
+	send({'type': 'done', 'id': message['id'], 'status': task.returncode, 'seconds': int(time.time() - taskStart), 'output': text})
+
+
+# agent_serve()
+#
+# Input: number of tasks to perform at the same time
+# Returns: none
+#
+# Runs on each droplet, reading messages from the dispatcher on stdin and writing replies to stdout, one JSON object per line.
+# Once it has the database settings, it keeps one connection open for renewing its tasks' leases
+def agent_serve(slots=1):
+
+	env = dict(os.environ)
+	children = {}
+	lock = threading.Lock()
+	db = None
+	stopped = threading.Event()
+	shutdown = False
+
+	def send(message):
+
+		with lock:
+
+			sys.stdout.write(json.dumps(message) + "\n")
+			sys.stdout.flush()
+
+	for line in sys.stdin:
+
+		message = json.loads(line)
+
+		if message['type'] == 'env':
+
+			env.update(message['env'])
+
+			# Use the same address tasks.sh leases tasks under
+			try:
+
+				host = urllib.request.urlopen("http://169.254.169.254/metadata/v1/interfaces/public/0/ipv4/address", timeout=2).read().decode().strip()
+
+			except OSError:
+
+				host = ""
+
+			if db is None and host != "":
+
+				db = agent_connect(env)
+
+				# Tell tasks.sh not to start its own heartbeat
+				if db is not None:
+
+					env['LEASE_HEARTBEAT'] = "agent"
+					threading.Thread(target=agent_heartbeat, args=(db, host, children, stopped), daemon=True).start()
+
+		elif message['type'] == 'job':
+
+			threading.Thread(target=agent_run, args=(message, env, send, children), daemon=True).start()
+
+		elif message['type'] == 'shutdown':
+
+			shutdown = True
+
+			break
+
+	stopped.set()
+
+	if db is not None:
+
+		db.close()
+
+	if shutdown:
+
+		return
+
+	# The dispatcher went away without shutting us down, so stop any tasks it can no longer collect
+	# (each task runs in its own process group, so HandBrake, ffmpeg, and s3cmd are stopped along with tasks.sh,
+	# and each tasks.sh releases its lease as it's stopped)
+	for task in list(children):
+
+		try:
+
+			os.killpg(task.pid, signal.SIGTERM)
+
+		except OSError:
+
+			pass
+
+
+# agent_take()
+#
+# Input: dispatcher state, droplet
+# Returns: next task for the droplet, or None if there aren't any
+#
+# Prefers a task that hasn't already failed on this droplet
+def agent_take(state, host):
+
+	with state['condition']:
+
+		if len(state['pending']) == 0:
+
+			return None
+
+		job = next((job for job in state['pending'] if host not in job['hosts']), state['pending'][0])
+
+		state['pending'].remove(job)
+		state['assigned'] = state['assigned'] + 1
+
+		return job
+
+
+if __name__ == "__main__":
+
+	# Get command line arguments
+	arguments = docopt(__doc__, version="Fitzflix 1.0.2")
+
+	# Hand the queue's tasks to the agents on our droplets
+	if arguments['dispatch']:
+
+		failed = agent_dispatch(arguments['--queue'], arguments['--sshloginfile'], int(arguments['--jobs']), int(arguments['--retries']), arguments['--return'])
+
+		# Exit with the number of failed tasks, like GNU parallel
+		sys.exit(min(failed, 101))
+
+	# Run the tasks we're handed on this droplet
+	elif arguments['serve']:
+
+		agent_serve(int(arguments['--slots']))
@@ -0,0 +1,446 @@
+"""Fitzflix catalog
+
+Usage:
+  catalog.py export [--output=DIR] [--full]
+  catalog.py serve [--output=DIR] [--port=NUM]
+
+Options:
+  -h, --help          Show this help.
+  --full              Rebuild the whole catalog rather than only applying changes.
+  --output=DIR        Directory the catalog snapshots are written to. [default: /Catalog]
+  --port=NUM          Port to serve the catalog snapshots on. [default: 8080]
+
+"""
+
+import datetime, fcntl, json, os, pymysql, shutil, socketserver, sqlite3, sys, threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+from docopt import docopt
+
+# Columns of each catalog entry, in the order they're selected from v_catalog
+COLUMNS = ["plex_name", "movie_title", "release_year", "series_title", "season_number", "episode_number", "release_identifier", "quality_title"]
+
+MOVIECOLUMNS = ["plex_name", "movie_title", "release_year", "release_identifier", "quality_title"]
+TVCOLUMNS = ["plex_name", "series_title", "season_number", "episode_number", "release_identifier", "quality_title"]
+
+SQLITENAME = "catalog.sqlite"
+JSONNAME = "catalog.json"
+
+# Applied changes are kept in catalog_changes for this long before being removed
+CHANGERETENTION = 1
+
+
+# catalog_apply()
+#
+# Input: SQLite snapshot, catalog entries read from v_catalog, Plex names those entries were read for, catalog version
+# Returns: number of entries that were added, updated, or removed
+#
+# Updates the snapshot with the given entries, marking only those that actually changed with the new version,
+# and records any of the Plex names that no longer have an entry as removed
+def catalog_apply(db, rows, plexNames, version):
+
+	changed = 0
+
+	current = {}
+
+	for i in range(0, len(plexNames), 500):
+
+		chunk = plexNames[i:i + 500]
+
+		for row in db.execute("SELECT {} FROM titles WHERE plex_name IN ({})".format(", ".join(COLUMNS), ", ".join("?" * len(chunk))), chunk):
+
+			current[row[0]] = tuple(row)
+
+	for row in rows:
+
+		if current.pop(row[0], None) != row:
+
+			db.execute("INSERT OR REPLACE INTO titles ({}, version) VALUES ({}, ?)".format(", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))), row + (version,))
+			db.execute("DELETE FROM removed WHERE plex_name = ?", (row[0],))
+
+			changed = changed + 1
+
+	# Anything left over no longer has a catalog entry
+	for plexName in current:
+
+		db.execute("DELETE FROM titles WHERE plex_name = ?", (plexName,))
+		db.execute("INSERT OR REPLACE INTO removed (plex_name, version) VALUES (?, ?)", (plexName, version))
+
+		changed = changed + 1
+
+	return changed
+
+
+# catalog_connect()
+#
+# Input: none
+# Returns: connection to the Fitzflix database
+#
+# Connects using the same environment variables as the rest of our scripts
+def catalog_connect():
+
+	return pymysql.connect(
+		host = os.environ.get('MYSQL_PORT_3306_TCP_ADDR', os.environ.get('MYSQL_HOST')),
+		port = int(os.environ.get('MYSQL_PORT_3306_TCP_PORT', os.environ.get('MYSQL_PORT', 3306))),
+		user = os.environ.get('MYSQL_USER'),
+		password = os.environ.get('MYSQL_PASSWORD'),
+		db = os.environ.get('MYSQL_DB', "fitzflix_db"),
+		charset = "utf8mb4"
+	)
+
+
+# catalog_export()
+#
+# Input: directory to write the snapshots to, whether to rebuild the whole catalog
+# Returns: none
+#
+# Brings the SQLite snapshot up to date with the latest catalog_changes, re-reading only the titles that have
+# changed since the last export (or the whole library if the snapshot is new, or a change affects every title),
+# and then rewrites the JSON snapshot from it.
+#
+# Changes are matched by id against the ones already applied, rather than only applying ids above the last one we saw,
+# since a transaction can commit a change after another transaction has committed a later id
+def catalog_export(outputDir, full=False):
+
+	os.makedirs(outputDir, exist_ok=True)
+
+	# Only run one export at a time
+	lock = open(os.path.join(outputDir, "catalog.lock"), "w")
+
+	try:
+		fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+	except OSError:
+
+		print("A catalog export is already running!")
+
+		sys.exit()
+
+	# Update a copy of the SQLite snapshot and then replace the snapshot with it, the same as the JSON snapshot,
+	# so the server never reads a partially-updated snapshot
+	sqlitePath = os.path.join(outputDir, SQLITENAME)
+
+	if os.path.isfile(sqlitePath):
+
+		shutil.copyfile(sqlitePath, sqlitePath + ".tmp")
+
+	elif os.path.isfile(sqlitePath + ".tmp"):
+
+		os.remove(sqlitePath + ".tmp")
+
+	db = sqlite3.connect(sqlitePath + ".tmp")
+
+	db.execute("CREATE TABLE IF NOT EXISTS titles (plex_name TEXT PRIMARY KEY, movie_title TEXT, release_year INTEGER, series_title TEXT, season_number INTEGER, episode_number INTEGER, release_identifier TEXT, quality_title TEXT, version INTEGER NOT NULL)")
+	db.execute("CREATE TABLE IF NOT EXISTS removed (plex_name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+	db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+	db.execute("CREATE TABLE IF NOT EXISTS applied (id INTEGER PRIMARY KEY)")
+	db.execute("CREATE INDEX IF NOT EXISTS idx_titles_version ON titles (version)")
+	db.execute("CREATE INDEX IF NOT EXISTS idx_removed_version ON removed (version)")
+
+	row = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+
+	currentVersion = None if row is None else int(row[0])
+
+	mysql = catalog_connect()
+
+	cursor = mysql.cursor()
+
+	cursor.execute("SELECT id, plex_name FROM catalog_changes")
+
+	changes = cursor.fetchall()
+
+	applied = set([row[0] for row in db.execute("SELECT id FROM applied")])
+
+	pending = [row for row in changes if row[0] not in applied]
+
+	if not full and currentVersion is not None and len(pending) == 0 and os.path.isfile(os.path.join(outputDir, JSONNAME)):
+
+		print("Catalog is up to date at version {}.".format(currentVersion))
+
+		db.close()
+		os.remove(sqlitePath + ".tmp")
+
+		return
+
+	# The new version is the latest change's id, unless a change with an earlier id has only just been committed,
+	# in which case it's still one more than the last version so clients pick the change up
+	latestVersion = max([row[0] for row in changes] + [0 if currentVersion is None else currentVersion + 1])
+
+	if not full and currentVersion is not None:
+
+		plexNames = list(set([row[1] for row in pending]))
+
+		# A NULL Plex name means the change could affect any title
+		full = None in plexNames
+
+	else:
+
+		full = True
+
+	if full:
+
+		print("Rebuilding catalog...")
+
+		cursor.execute("SELECT {} FROM v_catalog".format(", ".join(COLUMNS)))
+
+		rows = [tuple(row) for row in cursor.fetchall()]
+
+		# Compare against every title we already have, so titles no longer in the library are removed
+		plexNames = list(set([row[0] for row in rows]) | set([row[0] for row in db.execute("SELECT plex_name FROM titles")]))
+
+	else:
+
+		print("Applying changes to {} titles...".format(len(plexNames)))
+
+		rows = []
+
+		for i in range(0, len(plexNames), 500):
+
+			chunk = plexNames[i:i + 500]
+
+			cursor.execute("SELECT {} FROM v_catalog WHERE plex_name IN ({})".format(", ".join(COLUMNS), ", ".join(["%s"] * len(chunk))), chunk)
+
+			rows.extend([tuple(row) for row in cursor.fetchall()])
+
+	changed = catalog_apply(db, rows, plexNames, latestVersion)
+
+	db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(latestVersion),))
+
+	# Every change we read has now been applied
+	db.execute("DELETE FROM applied")
+	db.executemany("INSERT INTO applied (id) VALUES (?)", [(row[0],) for row in changes])
+	db.commit()
+
+	os.replace(sqlitePath + ".tmp", sqlitePath)
+
+	print("{} catalog entries changed; catalog is now at version {}.".format(changed, latestVersion))
+
+	catalog_write_json(db, outputDir, latestVersion)
+
+	db.close()
+
+	# Remove changes we've applied once they're old enough that nothing else should still need them
+	# (only the ones we've read, so a change that's still being committed isn't removed before it's applied)
+	ids = [row[0] for row in changes]
+
+	for i in range(0, len(ids), 500):
+
+		chunk = ids[i:i + 500]
+
+		cursor.execute("DELETE FROM catalog_changes WHERE id IN ({}) AND date_changed < DATE_SUB(CURRENT_TIMESTAMP, INTERVAL %s DAY)".format(", ".join(["%s"] * len(chunk))), chunk + [CHANGERETENTION])
+
+	mysql.commit()
+	mysql.close()
+
+
+# catalog_rows()
+#
+# Input: SQLite cursor, list of columns
+# Returns: list of dictionaries, one per row
+def catalog_rows(cursor, columns):
+
+	return [dict(zip(columns, row)) for row in cursor]
+
+
+# catalog_write_json()
+#
+# Input: SQLite snapshot, output directory, catalog version
+# Returns: none
+#
+# Writes the whole catalog as a JSON snapshot, with movies and TV episodes listed in the same order
+# as v_library_movie and v_library_tv
+def catalog_write_json(db, outputDir, version):
+
+	catalog = {
+		"version": version,
+		"generated": datetime.datetime.now().isoformat(),
+		"movies": catalog_rows(db.execute("SELECT {} FROM titles WHERE movie_title IS NOT NULL ORDER BY movie_title, release_year, release_identifier".format(", ".join(MOVIECOLUMNS))), MOVIECOLUMNS),
+		"tv": catalog_rows(db.execute("SELECT {} FROM titles WHERE series_title IS NOT NULL ORDER BY series_title, season_number, episode_number".format(", ".join(TVCOLUMNS))), TVCOLUMNS)
+	}
+
+	# Write to a temporary file first, so the server never reads a partially-written snapshot
+	jsonPath = os.path.join(outputDir, JSONNAME)
+
+	with open(jsonPath + ".tmp", "w") as f:
+
+		json.dump(catalog, f, separators=(",", ":"))
+
+	os.replace(jsonPath + ".tmp", jsonPath)
+
+
+class CatalogServer(socketserver.ThreadingMixIn, HTTPServer):
+
+	daemon_threads = True
+
+
+# CatalogHandler
+#
+# Serves the catalog snapshots:
+#
+#   /catalog.json				the whole catalog
+#   /catalog.sqlite				the SQLite snapshot the JSON catalog is written from
+#   /changes.json?since=VERSION	only the entries added, updated, or removed since an earlier catalog version
+#
+# Every response has an ETag based on the version of the snapshot it was built from, so clients that send it back
+# in If-None-Match get a 304 Not Modified until the catalog changes. The JSON catalog is kept in memory and only re-read
+# when a new snapshot has been exported, so responses don't slow down as the library grows.
+class CatalogHandler(BaseHTTPRequestHandler):
+
+	outputDir = "/Catalog"
+
+	cache = {"mtime": None, "version": None, "body": None}
+
+	# Each request is handled in its own thread, so the cache is only read or replaced while holding this lock
+	cacheLock = threading.Lock()
+
+	def do_GET(self):
+
+		url = urlparse(self.path)
+
+		jsonPath = os.path.join(self.outputDir, JSONNAME)
+
+		if not os.path.isfile(jsonPath):
+
+			self.send_error(503, "Catalog hasn't been exported yet")
+
+			return
+
+		# Re-read the JSON snapshot only if it's been replaced since we last read it
+		mtime = os.stat(jsonPath).st_mtime
+
+		with self.cacheLock:
+
+			if self.cache["mtime"] != mtime:
+
+				with open(jsonPath, "rb") as f:
+
+					body = f.read()
+
+				self.cache.update({"mtime": mtime, "version": json.loads(body.decode("utf-8"))["version"], "body": body})
+
+			# Keep the version and body from the same snapshot, even if another request replaces the cache
+			version = self.cache["version"]
+			body = self.cache["body"]
+
+		if url.path == "/catalog.json":
+
+			self.send_body('"{}"'.format(version), "application/json", lambda: body)
+
+		elif url.path == "/catalog.sqlite":
+
+			f, db, sqliteVersion = self.snapshot()
+
+			try:
+				self.send_body('"{}-sqlite"'.format(sqliteVersion), "application/x-sqlite3", lambda: f.read())
+
+			finally:
+				f.close()
+				db.close()
+
+		elif url.path == "/changes.json":
+
+			try:
+				since = int(parse_qs(url.query).get("since", ["0"])[0])
+
+			except ValueError:
+
+				self.send_error(400, "since must be a catalog version number")
+
+				return
+
+			f, db, sqliteVersion = self.snapshot()
+
+			try:
+				self.send_body('"{}-since-{}"'.format(sqliteVersion, since), "application/json", lambda: self.changes(db, sqliteVersion, since))
+
+			finally:
+				f.close()
+				db.close()
+
+		else:
+
+			self.send_error(404)
+
+	def changes(self, db, version, since):
+
+		changes = {
+			"version": version,
+			"since": since,
+			"titles": catalog_rows(db.execute("SELECT {}, version FROM titles WHERE version > ? ORDER BY version".format(", ".join(COLUMNS)), (since,)), COLUMNS + ["version"]),
+			"removed": catalog_rows(db.execute("SELECT plex_name, version FROM removed WHERE version > ? ORDER BY version", (since,)), ["plex_name", "version"])
+		}
+
+		return json.dumps(changes, separators=(",", ":")).encode("utf-8")
+
+	# Opens the SQLite snapshot both as a file and as a database, along with its version, making sure both are the same
+	# snapshot: if an export replaces it in between, the path no longer leads to the file we opened, so we try again
+	def snapshot(self):
+
+		sqlitePath = os.path.join(self.outputDir, SQLITENAME)
+
+		while True:
+
+			f = open(sqlitePath, "rb")
+			db = sqlite3.connect("file:{}?mode=ro".format(sqlitePath), uri=True)
+
+			version = int(db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0])
+
+			if os.fstat(f.fileno()).st_ino == os.stat(sqlitePath).st_ino:
+
+				return f, db, version
+
+			f.close()
+			db.close()
+
+	def send_body(self, etag, contentType, body):
+
+		# The client already has this version, so there's no need to build or send the body
+		if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+
+			self.send_response(304)
+			self.send_header("ETag", etag)
+			self.end_headers()
+
+			return
+
+		body = body()
+
+		self.send_response(200)
+		self.send_header("Content-Type", contentType)
+		self.send_header("Content-Length", str(len(body)))
+		self.send_header("ETag", etag)
+		self.send_header("Cache-Control", "no-cache")
+		self.end_headers()
+
+		self.wfile.write(body)
+
+
+# catalog_serve()
+#
+# Input: directory the snapshots are written to, port to listen on
+# Returns: none
+def catalog_serve(outputDir, port=8080):
+
+	CatalogHandler.outputDir = outputDir
+
+	server = CatalogServer(("", port), CatalogHandler)
+
+	print("Serving catalog from {} on port {}...".format(outputDir, port))
+
+	server.serve_forever()
+
+
+if __name__ == "__main__":
+
+	# Get command line arguments
+	arguments = docopt(__doc__, version="Fitzflix 1.0.2")
+
+	# Bring the catalog snapshots up to date
+	if arguments['export']:
+
+		catalog_export(arguments['--output'], arguments['--full'])
+
+	# Serve the catalog snapshots
+	elif arguments['serve']:
+
+		catalog_serve(arguments['--output'], int(arguments['--port']))
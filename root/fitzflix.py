@@ -1,28 +1,56 @@
 """Fitzflix
 
 Usage:
-  fitzflix.py choose --apikey=TOKEN [--remotetasks=NUM] [--maxdroplets=NUM] [--region=REGION] [--cpu=NUM] [--ram=NUM]
-  fitzflix.py create --apikey=TOKEN --id=ID --size=SIZE --fingerprint=ID... [--simultaneous=NUM] [--region=REGION]
+  fitzflix.py calibrate --apikey=TOKEN [--candidates=SIZES] [--region=REGION] [--cpu=NUM] [--ram=NUM] [--cache=FILE] [--cachettl=SECONDS]
+  fitzflix.py choose --apikey=TOKEN [--remotetasks=NUM] [--remoteseconds=NUM] [--remotebytes=NUM] [--calibration=FILE] [--throughput=FILE] [--maxdroplets=NUM] [--regiondroplets=NUM] [--region=REGION] [--cpu=NUM] [--ram=NUM] [--cache=FILE] [--cachettl=SECONDS]
+  fitzflix.py create --apikey=TOKEN --id=ID --size=SIZE --fingerprint=ID... [--simultaneous=NUM] [--region=REGION] [--fallback=REGIONS]
   fitzflix.py delete --apikey=TOKEN [--orphans-only]
+  fitzflix.py destroy --apikey=TOKEN --host=IP
   fitzflix.py keycheck --apikey=TOKEN --fingerprint=ID --sshkey=KEY
+  fitzflix.py place --calibration=FILE --encodequeue=FILE --localqueue=FILE [--localslots=NUM] [--boottime=SECONDS] [--maxdroplets=NUM]
+  fitzflix.py sizes --apikey=TOKEN [--cache=FILE]
+  fitzflix.py restore --accesskey=KEY --secretkey=KEY --bucket=BUCKET --files=FILE [--days=NUM] [--threads=NUM]
+  fitzflix.py thaw --accesskey=KEY --secretkey=KEY --bucket=BUCKET --files=FILE [--threads=NUM]
 
 Options:
   -h, --help          Show this help.
+  --accesskey=KEY     S3 access key.
+  --boottime=SECONDS  Estimated number of seconds before a new droplet is ready to start encoding. [default: 600]
+  --bucket=BUCKET     S3 bucket the archived files are stored in.
+  --cache=FILE        Cached list of droplet types and the regions they're available in. [default: /sizesCache.json]
+  --cachettl=SECONDS  Number of seconds before the cached droplet types are fetched again. [default: 3600]
+  --calibration=FILE  Measured droplet type throughputs exported from v_calibration.
+  --candidates=SIZES  Comma-separated list of DigitalOcean droplet slugs to calibrate.
   --cpu=NUM           Minimum number of CPUs required per encoder task. [default: 1]
+  --days=NUM          Number of days a restored file stays available for download. [default: 3]
+  --encodequeue=FILE  Encode queue exported from v_queue; encodes placed on the local host are removed from it.
+  --fallback=REGIONS  Comma-separated list of regions to try in order if the droplet can't be created in --region.
+  --files=FILE        File containing one archived file path per line.
   --fingerprint=ID    SSH public key fingerprint.
+  --host=IP           IP address of the droplet to destroy.
   --id=NUM            ID of droplet being created.
+  --localqueue=FILE   File to write the encodes placed on the local host to.
+  --localslots=NUM    Number of encodes to run on the local host at the same time. [default: 1]
   --maxdroplets=NUM   Maximum number of droplets to run. [default: 5]
   --orphans-only      Find and delete only unattached block storage volumes.
   --ram=NUM           Minimum required number of gigabytes of RAM per droplet. [default: 1]
-  --region=REGION     Region where this droplet should be created. [default: nyc3]
+  --region=REGION     Region where this droplet should be created.
+                      (calibrate and choose accept a comma-separated list of regions, in order of preference) [default: nyc3]
+  --regiondroplets=NUM  Maximum number of droplets to create in each region, or 0 to spread them evenly across the regions. [default: 0]
+  --secretkey=KEY     S3 secret key.
   --simultaneous=NUM  Number of tasks to perform in parallel. [default: 1]
   --size=SIZE         DigitalOcean droplet slug identifier.
   --sshkey=KEY        SSH public key string.
+  --threads=NUM       Number of S3 requests to make at the same time. [default: 16]
+  --throughput=FILE   Measured transfer throughput of each region exported from v_region_throughput.
+  --remotebytes=NUM   Total bytes of files to transfer for remote tasks. [default: 0]
+  --remoteseconds=NUM  Total seconds of video to encode in remote tasks. [default: 0]
   --remotetasks=NUM   Total number of remote tasks to perform. [default: 0]
 
 """
 
-import datetime, json, math, os, pprint, requests, sys, time
+import boto3, botocore, calendar, datetime, email.utils, json, math, os, pprint, re, requests, sys, time
+from concurrent.futures import ThreadPoolExecutor
 from operator import itemgetter
 from docopt import docopt
 
@@ -40,10 +68,112 @@ STORAGENAME = "fitzflix-storage"
 DROPLETNAME = "fitzflix-transcoder"
 
 
-def droplet_choose(token, numTasks=0, maxDroplets=5, region="nyc3", minCPU=1, minRAM=1):
+# calibration_load()
+#
+# Input: path to a file exported from v_calibration
+# Returns: dictionary of droplet type slugs, each with a list of (simultaneous encodes, throughput) tuples
+#
+# Reads the measured throughput of each droplet type for each number of simultaneous encodes
+# (throughput is the number of seconds of video the whole droplet encodes per second)
+def calibration_load(calibrationFile):
+
+	calibration = {}
+	
+	if calibrationFile is None or not os.path.isfile(calibrationFile):
+	
+		return calibration
+		
+	with open(calibrationFile) as f:
+	
+		for line in f:
+		
+			# droplet_type, simultaneous_tasks, fps, speed, throughput, throughput_per_dollar
+			columns = line.rstrip('\n').split('\t')
+			
+			if len(columns) < 6 or columns[4] == "NULL" or float(columns[4]) <= 0:
+			
+				continue
+				
+			calibration.setdefault(columns[0], []).append((int(columns[1]), float(columns[4])))
+			
+	return calibration
+
+
+# droplet_calibrate()
+#
+# Input: optional list of droplet type slugs to calibrate
+# Returns: none
+#
+# Prints each droplet type to calibrate and each number of simultaneous encodes to calibrate it with,
+# along with the most preferred region it's available in, for Calibrate.sh to encode our reference clips on
+def droplet_calibrate(token, candidates=None, regions=["nyc3"], minCPU=1, minRAM=1, cacheFile="/sizesCache.json", cacheTTL=3600):
+
+	sizes = sizes_load(token, cacheFile, cacheTTL)['sizes']
+		
+	print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}".format("Droplet Type", "CPUs", "RAM", "Hourly Cost", "Simultaneous", "Region"))
+	
+	for droplet in sizes:
+	
+		if candidates is not None and droplet['slug'] not in candidates:
+		
+			continue
+			
+		availableRegions = [region for region in regions if region in droplet['regions']]
+	
+		# Only calibrate those droplet types we'd be able to choose
+		if droplet['available'] == True and len(availableRegions) > 0 and droplet['vcpus'] >= minCPU and droplet['memory'] >= (minRAM * 1024):
+		
+			maxSimultaneous = math.floor(droplet['vcpus'] / minCPU)
+			
+			# Try 1, 2, 4, 8... simultaneous encodes, up to one encode per minCPU CPUs
+			simultaneousOptions = [2 ** i for i in range(0, maxSimultaneous.bit_length()) if 2 ** i < maxSimultaneous]
+			simultaneousOptions.append(maxSimultaneous)
+			
+			for simultaneousEncodes in simultaneousOptions:
+			
+				# Check to be sure we have at least the minimum requested RAM per encoder task
+				if int(droplet['memory'] / simultaneousEncodes) < (minRAM * 1024):
+				
+					continue
+					
+				# Include the cost of the block storage we attach for this many simultaneous encodes,
+				# the same as we do when choosing a droplet type
+				hourlyCost = droplet['price_hourly'] + (0.015 * simultaneousEncodes)
+				
+				print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}".format(droplet['slug'], droplet['vcpus'], droplet['memory'], hourlyCost, simultaneousEncodes, availableRegions[0]))
+
+
+def droplet_choose(token, numTasks=0, maxDroplets=5, regions=["nyc3"], minCPU=1, minRAM=1, calibrationFile=None, remoteSeconds=0, throughputFile=None, remoteBytes=0, regionDroplets=0, cacheFile="/sizesCache.json", cacheTTL=3600):
 
 	if numTasks > 0:
 
+		# Load any measured droplet type throughputs from previous calibrations
+		# (the local host's own calibration is only used for placing hybrid encodes, so it isn't a droplet type we can choose)
+		calibration = calibration_load(calibrationFile)
+		calibration.pop('local', None)
+		
+		# Load the droplet types and the regions they're available in from our cache, rather than asking DigitalOcean every time
+		cache = sizes_load(token, cacheFile, cacheTTL)
+		
+		# Estimate how many hours of droplet time it would take to transfer our files in each region,
+		# based on the transfer speeds we've measured there
+		# (regions we haven't measured yet are assumed to be as fast as the average of those we have)
+		throughput = throughput_load(throughputFile)
+		
+		transferHours = {}
+		
+		for region in regions:
+		
+			if remoteBytes > 0 and len(throughput) > 0:
+			
+				megabytesPerSecond = throughput.get(region, sum(throughput.values()) / len(throughput))
+				
+				transferHours[region] = remoteBytes / (megabytesPerSecond * 1000000 * 3600)
+				
+			else:
+			
+				transferHours[region] = 0
+
 		# Count how many droplets currently exist, and subtract that number from the max number of droplets we can create
 	
 		try:
@@ -58,9 +188,10 @@ def droplet_choose(token, numTasks=0, maxDroplets=5, region="nyc3", minCPU=1, mi
 		
 		numExistingDroplets = response.json()['meta']['total']
 	
-		maxDroplets = maxDroplets - numExistingDroplets
+		# We also can't create more droplets than our account's droplet limit allows
+		maxDroplets = min(maxDroplets, cache['droplet_limit']) - numExistingDroplets
 		
-		if maxDroplets == 0:
+		if maxDroplets <= 0:
 		
 			print("Maximum number of droplets are currently running!")
 			
@@ -71,74 +202,114 @@ def droplet_choose(token, numTasks=0, maxDroplets=5, region="nyc3", minCPU=1, mi
 	
 		availableDroplets = []
 	
-		response = requests.get(BASEURL + "/v2/sizes", headers = {'Authorization': 'Bearer ' + token})
-
-		# print(response.url)
-		# print("HTTP status code: {}".format(response.status_code))
-		# p.pprint(response.json())
-		# print()
-	
-		for droplet in response.json()['sizes']:
+		for droplet in cache['sizes']:
+		
+			# Regions this droplet type is available in, fastest transfers first, then in our order of preference
+			availableRegions = sorted([region for region in regions if region in droplet['regions']], key=lambda region: transferHours[region])
 	
-			# Select only those droplet types that are available in our requested region
+			# Select only those droplet types that are available in at least one of our requested regions
 			# and have at least the number of CPUs and memory we want
-			if droplet['available'] == True and region in droplet['regions'] and droplet['vcpus'] >= minCPU and droplet['memory'] >= (minRAM * 1024):
+			if droplet['available'] == True and len(availableRegions) > 0 and droplet['vcpus'] >= minCPU and droplet['memory'] >= (minRAM * 1024):
 				
-				simultaneousEncodes = math.floor(droplet['vcpus'] / minCPU)
+				# If we've calibrated our droplet types and know how many seconds of video we have to encode,
+				# estimate the droplet hours from the measured throughput of each number of simultaneous
+				# encodes we calibrated on this droplet type
 				
-				# Check to be sure we have at least the minimum requested RAM per encoder task
-				# If not, move to the next droplet type
-				if int(droplet['memory'] / simultaneousEncodes) < (minRAM * 1024):
+				options = []
 				
-					continue
-					
-				# Estimate the number of possible encodes per hour
-			
-				# TODO: Improve this with statistical analysis of how different resolutions
-				# (e.g. SD / 720p / 1080p) and encoder tuning (animation / grain / film) affect
-				# encoding times
-			
-				# High-CPU droplet types can process more encodes per hour
-				#
-				# "Customers in our early access period have seen up to four times
-				#  the performance of Standard Droplet CPUs, and on average see
-				#  about 2.5 times the performance"
-				#   - https://blog.digitalocean.com/introducing-high-cpu-droplets/
-				#
-				# Let's conservatively estimate 2x performance gains
-			
-				if droplet['slug'].startswith('c-'):
-			
-					encodesPerHour = droplet['vcpus'] * 2
+				if len(calibration) > 0 and remoteSeconds > 0:
 				
+					# Don't guess at droplet types we haven't measured
+					if droplet['slug'] not in calibration:
+					
+						continue
+						
+					for simultaneousEncodes, throughput in calibration[droplet['slug']]:
+					
+						# throughput is the seconds of video the whole droplet encodes per second
+						options.append((simultaneousEncodes, remoteSeconds / (throughput * 3600)))
+						
 				else:
-			
-					encodesPerHour = droplet['vcpus']
 				
-				dropletHours = numTasks / encodesPerHour
-			
-				# Limit the number of droplets we can spin up to the max number we can use
-				if math.ceil(dropletHours) > maxDroplets:
-			
-					numDroplets = maxDroplets
+					simultaneousEncodes = math.floor(droplet['vcpus'] / minCPU)
+					
+					# Estimate the number of possible encodes per hour
 				
-				else:
-			
-					# We spin up one droplet per calculated droplethour
-					numDroplets = math.ceil(dropletHours)
+					# High-CPU droplet types can process more encodes per hour
+					#
+					# "Customers in our early access period have seen up to four times
+					#  the performance of Standard Droplet CPUs, and on average see
+					#  about 2.5 times the performance"
+					#   - https://blog.digitalocean.com/introducing-high-cpu-droplets/
+					#
+					# Let's conservatively estimate 2x performance gains
+					# (Run "fitzflix.py calibrate" to measure each droplet type's actual performance instead)
 				
-				# droplethours / number of droplets = number of hours it will take to process
-				# e.g. 10 droplethours / 10 droplets = 1 hour
-				#      10 droplethours /  5 droplets = 2 hours
-				hours = math.ceil(dropletHours / numDroplets)
-			
-				# Estimate how much it will cost to run x droplets for y hours
-				dropletCost = droplet['price_hourly']
-				storageCost = 0.015 * simultaneousEncodes
-				estimatedCost = (dropletCost + storageCost) * numDroplets * hours
-			
-				# Add a tuple with data for this droplet type to our list of available droplets	
-				availableDroplets.append((droplet['slug'], droplet['vcpus'], droplet['memory'], encodesPerHour, simultaneousEncodes, dropletCost, storageCost, dropletHours, numDroplets, hours, estimatedCost))
+					if droplet['slug'].startswith('c-'):
+				
+						encodesPerHour = droplet['vcpus'] * 2
+					
+					else:
+				
+						encodesPerHour = droplet['vcpus']
+						
+					options.append((simultaneousEncodes, numTasks / encodesPerHour))
+					
+				for simultaneousEncodes, dropletHours in options:
+				
+					# Check to be sure we have at least the minimum requested RAM per encoder task
+					# If not, move to the next option
+					if int(droplet['memory'] / simultaneousEncodes) < (minRAM * 1024):
+					
+						continue
+						
+					encodesPerHour = numTasks / dropletHours
+					
+					# Limit the number of droplets we can spin up to the max number we can use,
+					# and to the max number we can create in the regions this droplet type is available in
+					if regionDroplets > 0:
+					
+						maxRegionDroplets = min(maxDroplets, regionDroplets * len(availableRegions))
+						
+					else:
+					
+						maxRegionDroplets = maxDroplets
+				
+					numDroplets = droplet_count(dropletHours + transferHours[availableRegions[0]], maxRegionDroplets)
+					
+					# Without a limit of our own, spread the droplets evenly across the regions,
+					# so a single region running out of capacity can't hold up the whole queue
+					if regionDroplets > 0:
+					
+						regionLimit = regionDroplets
+						
+					else:
+					
+						regionLimit = math.ceil(numDroplets / len(availableRegions))
+						
+					# Fill the region with the fastest transfers first, splitting the droplets
+					# across the other regions once each region has reached its limit
+					dropletRegions = []
+					
+					for region in availableRegions:
+					
+						dropletRegions.extend([region] * min(regionLimit, numDroplets - len(dropletRegions)))
+							
+					# Each droplet also spends time transferring its share of our files
+					totalHours = dropletHours + sum([transferHours[region] for region in dropletRegions]) / numDroplets
+					
+					# droplethours / number of droplets = number of hours it will take to process
+					# e.g. 10 droplethours / 10 droplets = 1 hour
+					#      10 droplethours /  5 droplets = 2 hours
+					hours = math.ceil(totalHours / numDroplets)
+				
+					# Estimate how much it will cost to run x droplets for y hours
+					dropletCost = droplet['price_hourly']
+					storageCost = 0.015 * simultaneousEncodes
+					estimatedCost = (dropletCost + storageCost) * numDroplets * hours
+				
+					# Add a tuple with data for this droplet type to our list of available droplets	
+					availableDroplets.append((droplet['slug'], droplet['vcpus'], droplet['memory'], encodesPerHour, simultaneousEncodes, dropletCost, storageCost, dropletHours, numDroplets, hours, estimatedCost, dropletRegions, availableRegions))
 				
 		# Exit if we weren't able to find any droplets that match our needs
 		if len(availableDroplets) == 0:
@@ -175,6 +346,7 @@ def droplet_choose(token, numTasks=0, maxDroplets=5, region="nyc3", minCPU=1, mi
 		print("Number of droplets:", availableDroplets[0][8])
 	#  	print("Hours:", availableDroplets[0][9])
 	#  	print("Estimated cost:", availableDroplets[0][10])
+		print("Regions:", ", ".join(availableDroplets[0][11]))
 		print()
 	
 		queueStart = int(time.time())
@@ -183,9 +355,13 @@ def droplet_choose(token, numTasks=0, maxDroplets=5, region="nyc3", minCPU=1, mi
 		simultaneousEncodes = availableDroplets[0][4]
 		hourlyCostPerDroplet = availableDroplets[0][5] + availableDroplets[0][6]
 		numDroplets = availableDroplets[0][8]
+		dropletRegions = ",".join(availableDroplets[0][11])
+		
+		# Every region the droplet type is available in, fastest transfers first, for droplets that can't be created in their own region
+		fallbackRegions = ",".join(availableDroplets[0][12])
 	
-		print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}".format("Queue Start", "Droplet Type", "CPUs", "Simultaneous", "Hourly Cost", "Droplets", ))
-		print("{0}\t{1}\t\t{2}\t{3}\t\t{4}\t\t{5}".format(queueStart, dropletType, numCPUs, simultaneousEncodes, hourlyCostPerDroplet, numDroplets))
+		print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}".format("Queue Start", "Droplet Type", "CPUs", "Simultaneous", "Hourly Cost", "Droplets", "Regions", "Fallback Regions"))
+		print("{0}\t{1}\t\t{2}\t{3}\t\t{4}\t\t{5}\t\t{6}\t{7}".format(queueStart, dropletType, numCPUs, simultaneousEncodes, hourlyCostPerDroplet, numDroplets, dropletRegions, fallbackRegions))
 		
 	else:
 
@@ -207,13 +383,26 @@ def droplet_choose(token, numTasks=0, maxDroplets=5, region="nyc3", minCPU=1, mi
 		simultaneousEncodes = 0
 		hourlyCostPerDroplet = 0
 		numDroplets = 0
+		dropletRegions = "local"
+		fallbackRegions = "local"
 
-		print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}".format("Queue Start", "Droplet Type", "CPUs", "Simultaneous", "Hourly Cost", "Droplets", ))
-		print("{0}\t{1}\t\t{2}\t{3}\t\t{4}\t\t{5}".format(queueStart, dropletType, numCPUs, simultaneousEncodes, hourlyCostPerDroplet, numDroplets))
+		print("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\t{7}".format("Queue Start", "Droplet Type", "CPUs", "Simultaneous", "Hourly Cost", "Droplets", "Regions", "Fallback Regions"))
+		print("{0}\t{1}\t\t{2}\t{3}\t\t{4}\t\t{5}\t\t{6}\t{7}".format(queueStart, dropletType, numCPUs, simultaneousEncodes, hourlyCostPerDroplet, numDroplets, dropletRegions, fallbackRegions))
 
 	return
 
 
+# droplet_count()
+#
+# Input: estimated droplet hours of work, maximum number of droplets we can create
+# Returns: number of droplets to create
+#
+# We spin up one droplet per calculated droplethour, up to the maximum
+def droplet_count(dropletHours, maxDroplets):
+
+	return min(max(math.ceil(dropletHours), 1), maxDroplets)
+
+
 def droplet_create(token, identifier, dropletType, volumeID, sshFingerprints, region="nyc3"):
 
 	storageIdentifier = "{}-{}".format(STORAGENAME, identifier.zfill(2))
@@ -253,13 +442,15 @@ def droplet_create(token, identifier, dropletType, volumeID, sshFingerprints, re
 				add-apt-repository -y ppa:stebbins/handbrake-releases &&
 
 				apt-get -y update &&
-				apt-get -y install handbrake-cli make mariadb-client mediainfo perl python python-pip python3 python3-pip &&
+				apt-get -y install ffmpeg handbrake-cli make mariadb-client mediainfo perl python python-pip python3 python3-pip &&
 				
 				pip2 install --upgrade pip &&
 				
 				pip2 install s3cmd &&
 		
 				pip3 install --upgrade pip &&
+				
+				pip3 install docopt pymysql &&
 
 				curl -o /tmp/parallel-20171022.tar.bz2 -L http://ftpmirror.gnu.org/parallel/parallel-20171022.tar.bz2 &&
 				tar -xjf /tmp/parallel-20171022.tar.bz2 -C /tmp &&
@@ -284,11 +475,11 @@ def droplet_create(token, identifier, dropletType, volumeID, sshFingerprints, re
 			print(response.text)
 			
 			# The volume was created, but our attempt to create a droplet failed,
-			# so before we exit we attempt to destroy the volume if we can
+			# so before we give up we attempt to destroy the volume if we can
 			
 			volume_orphans(token)
 					
-			sys.exit(1)
+			return None
 		
 		print("Droplet creation:")
 		print(response.url)
@@ -313,7 +504,7 @@ def droplet_create(token, identifier, dropletType, volumeID, sshFingerprints, re
 			print()
 			
 			# The volume was created, but our attempt to check the droplet status failed,
-			# so before we exit we attempt to destroy the droplet and the volume if we can
+			# so before we give up we attempt to destroy the droplet and the volume if we can
 			
 			volume_detach(token, [dropletID])
 			
@@ -326,7 +517,7 @@ def droplet_create(token, identifier, dropletType, volumeID, sshFingerprints, re
 			print("HTTP status code: {}".format(response.status_code))
 			print()
 			
-			sys.exit(1)
+			return None
 		
 		print("Droplet creation status:")
 		print(response.url)
@@ -352,7 +543,7 @@ def droplet_create(token, identifier, dropletType, volumeID, sshFingerprints, re
 				print()
 
 				# The volume was created, but our attempt to check the droplet status failed,
-				# so before we exit we attempt to destroy the droplet and the volume if we can
+				# so before we give up we attempt to destroy the droplet and the volume if we can
 
 				volume_detach(token, [dropletID])
 			
@@ -365,7 +556,7 @@ def droplet_create(token, identifier, dropletType, volumeID, sshFingerprints, re
 				print("HTTP status code: {}".format(response.status_code))
 				print()
 
-				sys.exit(1)
+				return None
 			
 			print("HTTP status code: {}".format(response.status_code))
 			
@@ -403,6 +594,8 @@ def droplet_create(token, identifier, dropletType, volumeID, sshFingerprints, re
 		# with the existing storage volume.
 
 		volume_detach(token, [dropletID])
+		
+		volume_delete(token, [volumeID])
 	
 		print("Destroying droplet {}...".format(dropletID))
 		response = requests.delete(BASEURL + "/v2/droplets/" + dropletID, headers = {'Authorization': 'Bearer ' + token})
@@ -503,6 +696,370 @@ def droplet_delete(token):
 		sys.exit(1)
 		
 		
+# droplet_destroy()
+#
+# Input: IP address of a transcoder droplet
+# Returns: none
+#
+# Destroys a single transcoder droplet and its block storage, such as a droplet Watchdog.sh has drained,
+# while leaving the rest of the queue's droplets running
+def droplet_destroy(token, host):
+
+	# Get a list of transcoder droplets
+	try:
+		response = requests.get(BASEURL + "/v2/droplets", headers = {'Authorization': 'Bearer ' + token}, params = {'tag_name': DROPLETNAME})
+		response.raise_for_status()
+		
+	except requests.exceptions.HTTPError as err:
+	
+		print(err)
+		
+		sys.exit(1)
+		
+	droplets = [droplet for droplet in response.json()['droplets'] if host in [network['ip_address'] for network in droplet['networks']['v4']]]
+	
+	if len(droplets) == 0:
+	
+		print("No droplet with IP address {} to destroy!".format(host))
+		
+		sys.exit()
+		
+	# Detach and delete the droplet's volumes
+	volumes = volume_detach(token, droplets)
+	
+	volume_delete(token, volumes)
+	
+	for droplet in droplets:
+	
+		print("Destroying {}...".format(droplet['name']))
+		
+		response = requests.delete(BASEURL + "/v2/droplets/" + str(droplet['id']), headers = {'Authorization': 'Bearer ' + token})
+		
+		print(response.url)
+		print("HTTP status code: {}".format(response.status_code))
+		print()
+		
+		if response.status_code != 204:
+		
+			print("{} still provisioned!!".format(droplet['name']))
+			
+			sys.exit(1)
+			
+		print("{} destroyed.".format(droplet['name']))
+		
+		
+# encode_place()
+#
+# Input: calibration file, encode queue file, file to write local encodes to, number of local encode slots,
+#        estimated droplet boot time, max number of droplets
+# Returns: none
+#
+# Splits the encode queue between the local host and droplets, based on the measured speed of the local host
+# ("Calibrate.sh local") and of our fastest calibrated droplet type. Working from the shortest video up, each encode
+# is placed in the next free local slot if the local host would finish it no later than a droplet would, counting
+# the time it takes a droplet to boot; local encodes don't cost anything extra, so they win any tie.
+#
+# If any encodes still need droplets, the local slots are also kept busy for as long as those droplets are
+# expected to be running, rather than sitting idle while the droplets work through the queue.
+def encode_place(calibrationFile, encodeQueue, localQueue, localSlots=1, bootTime=600, maxDroplets=5):
+
+	calibration = calibration_load(calibrationFile)
+	
+	with open(encodeQueue) as f:
+	
+		encodes = [line for line in f if line.strip()]
+		
+	localEncodes = []
+	remoteEncodes = list(encodes)
+	
+	# Files without a known duration are counted as the average duration of those that have one
+	durations = [int(line.split('\t')[6]) for line in encodes if line.split('\t')[6] != "NULL"]
+	
+	if 'local' not in calibration:
+	
+		print("The local host hasn't been calibrated, so all encodes will be done on droplets.")
+		
+	elif len(encodes) > 0 and len(durations) == 0:
+	
+		# We can't tell how long any of them would take locally, so don't risk tying up the local host with them
+		print("None of the encodes have a known duration, so all encodes will be done on droplets.")
+		
+	elif len(encodes) > 0:
+	
+		# Seconds of video each local encode processes per second, measured with the closest number of simultaneous encodes to ours
+		simultaneousEncodes, throughput = min(calibration['local'], key=lambda option: abs(option[0] - localSlots))
+		localSpeed = throughput / simultaneousEncodes
+		
+		# Seconds of video each droplet encode, and each whole droplet, processes per second on the fastest droplet types we've calibrated
+		# (if we haven't calibrated any droplet types, assume a droplet could encode anything as soon as it boots)
+		remoteSpeeds = [throughput / simultaneousEncodes for slug in calibration if slug != 'local' for simultaneousEncodes, throughput in calibration[slug]]
+		remoteThroughputs = [throughput for slug in calibration if slug != 'local' for simultaneousEncodes, throughput in calibration[slug]]
+		
+		averageDuration = sum(durations) / len(durations)
+		
+		def duration(line):
+		
+			fileDuration = line.split('\t')[6]
+			
+			return averageDuration if fileDuration == "NULL" else int(fileDuration)
+			
+		# Seconds from now until each local slot is free
+		slots = [0] * localSlots
+		
+		remoteEncodes = []
+		
+		for line in sorted(encodes, key=duration):
+		
+			# Files we've deleted locally would have to be downloaded from S3 first, so leave those for droplets
+			if line.split('\t')[24] != "NULL":
+			
+				remoteEncodes.append(line)
+				continue
+				
+			slot = slots.index(min(slots))
+			
+			localFinish = slots[slot] + duration(line) / localSpeed
+			
+			if len(remoteSpeeds) > 0:
+			
+				remoteFinish = bootTime + duration(line) / max(remoteSpeeds)
+				
+			else:
+			
+				remoteFinish = bootTime
+				
+			if localFinish <= remoteFinish:
+			
+				slots[slot] = localFinish
+				localEncodes.append(line)
+				
+			else:
+			
+				remoteEncodes.append(line)
+				
+		# We're creating droplets anyway, so keep moving encodes to the local host as long as it would finish them
+		# before the droplets are expected to finish the rest of the queue
+		if len(remoteEncodes) > 0 and len(remoteThroughputs) > 0:
+		
+			for line in sorted(list(remoteEncodes), key=duration):
+			
+				if line.split('\t')[24] != "NULL":
+				
+					continue
+					
+				slot = slots.index(min(slots))
+				
+				# Droplets are created for whatever's left, one per droplet hour of work, the same as droplet_choose() does
+				remoteSeconds = sum([duration(remoteLine) for remoteLine in remoteEncodes]) - duration(line)
+				numDroplets = droplet_count(remoteSeconds / (max(remoteThroughputs) * 3600), maxDroplets)
+				
+				localFinish = slots[slot] + duration(line) / localSpeed
+				fleetFinish = bootTime + remoteSeconds / (max(remoteThroughputs) * numDroplets)
+				
+				if localFinish <= fleetFinish:
+				
+					slots[slot] = localFinish
+					localEncodes.append(line)
+					remoteEncodes.remove(line)
+					
+	with open(localQueue, "w") as f:
+	
+		f.writelines(localEncodes)
+		
+	# Write to a temporary file first, so the encode queue is never left partially written
+	with open(encodeQueue + ".tmp", "w") as f:
+	
+		f.writelines(remoteEncodes)
+		
+	os.replace(encodeQueue + ".tmp", encodeQueue)
+	
+	print("Local encodes: {}".format(len(localEncodes)))
+	print("Remote encodes: {}".format(len(remoteEncodes)))
+
+
+# s3_files()
+#
+# Input: path to a file containing one archived file path per line
+# Returns: list of file paths
+def s3_files(filesFile):
+
+	with open(filesFile) as f:
+	
+		return [line.rstrip('\n') for line in f if line.strip()]
+
+
+# s3_restore()
+#
+# Input: S3 credentials and bucket, list of archived file paths
+# Returns: none
+#
+# Submits a bulk restore request for every file at the same time (rather than one s3cmd call per file),
+# and prints each file's resulting status for Restore.sh:
+#
+#   requested	the restore request was accepted, or a restore was already in progress
+#   available	the file has already been restored (its restored copy's expiry has been extended)
+#   error		the restore request failed, and should be tried again later
+def s3_restore(accessKey, secretKey, bucket, filePaths, days=3, threads=16):
+
+	s3 = boto3.client('s3', aws_access_key_id = accessKey, aws_secret_access_key = secretKey)
+	
+	def restore(filePath):
+	
+		try:
+			response = s3.restore_object(Bucket = bucket, Key = filePath.lstrip('/'), RestoreRequest = {'Days': days, 'GlacierJobParameters': {'Tier': 'Bulk'}})
+			
+		except botocore.exceptions.ClientError as err:
+		
+			if err.response['Error']['Code'] == 'RestoreAlreadyInProgress':
+			
+				return (filePath, "requested")
+				
+			print(err, file=sys.stderr)
+			
+			return (filePath, "error")
+			
+		# S3 returns 202 for a new restore request, and 200 if the file has already been restored
+		if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+		
+			return (filePath, "available")
+			
+		return (filePath, "requested")
+		
+	with ThreadPoolExecutor(max_workers = threads) as executor:
+	
+		results = list(executor.map(restore, filePaths))
+		
+	print("{0}\t{1}".format("File Path", "Status"))
+	
+	for filePath, status in results:
+	
+		print("{0}\t{1}".format(filePath, status))
+
+
+# s3_thaw()
+#
+# Input: S3 credentials and bucket, list of archived file paths
+# Returns: none
+#
+# Checks each file's restore status with a HEAD request, all at the same time, and prints each file's
+# status along with when its restored copy expires (as a Unix timestamp, or NULL if it never expires):
+#
+#   pending		the restore is still in progress
+#   available	the file can be downloaded
+#   expired		no restore is in progress and the file isn't available, so it needs to be requested again
+#   error		the file couldn't be checked
+def s3_thaw(accessKey, secretKey, bucket, filePaths, threads=16):
+
+	s3 = boto3.client('s3', aws_access_key_id = accessKey, aws_secret_access_key = secretKey)
+	
+	def thaw(filePath):
+	
+		try:
+			response = s3.head_object(Bucket = bucket, Key = filePath.lstrip('/'))
+			
+		except botocore.exceptions.ClientError as err:
+		
+			print(err, file=sys.stderr)
+			
+			return (filePath, "error", "NULL")
+			
+		# Files still in standard storage (e.g. before our lifecycle rule has moved them to Glacier) can always be downloaded
+		if response.get('StorageClass') not in ('GLACIER', 'DEEP_ARCHIVE'):
+		
+			return (filePath, "available", "NULL")
+			
+		# e.g. ongoing-request="false", expiry-date="Fri, 23 Dec 2012 00:00:00 GMT"
+		restore = response.get('Restore')
+		
+		if restore is None:
+		
+			return (filePath, "expired", "NULL")
+			
+		if 'ongoing-request="true"' in restore:
+		
+			return (filePath, "pending", "NULL")
+			
+		expiry = re.search('expiry-date="([^"]+)"', restore)
+		
+		if expiry is None:
+		
+			return (filePath, "available", "NULL")
+			
+		return (filePath, "available", calendar.timegm(email.utils.parsedate(expiry.group(1))))
+		
+	with ThreadPoolExecutor(max_workers = threads) as executor:
+	
+		results = list(executor.map(thaw, filePaths))
+		
+	print("{0}\t{1}\t{2}".format("File Path", "Status", "Expires"))
+	
+	for filePath, status, expires in results:
+	
+		print("{0}\t{1}\t{2}".format(filePath, status, expires))
+		
+		
+# sizes_load()
+#
+# Input: path to the cache file, number of seconds before the cache should be refreshed
+# Returns: dictionary with the list of droplet types (and the regions each is available in), and our account's droplet limit
+#
+# Reads the droplet types from our cache, only fetching them from DigitalOcean again once the cache is older than cacheTTL seconds
+# ("fitzflix.py sizes" refreshes the cache on a schedule, so choosing a droplet type usually doesn't have to wait on DigitalOcean)
+# If DigitalOcean can't be reached, an out-of-date cache is used rather than failing outright.
+def sizes_load(token, cacheFile="/sizesCache.json", cacheTTL=3600):
+
+	cache = None
+	
+	if os.path.isfile(cacheFile):
+	
+		try:
+			with open(cacheFile) as f:
+			
+				cache = json.load(f)
+				
+		except ValueError:
+		
+			cache = None
+			
+	if cache is not None and time.time() - cache['fetched'] < cacheTTL:
+	
+		return cache
+		
+	try:
+		response = requests.get(BASEURL + "/v2/sizes", headers = {'Authorization': 'Bearer ' + token}, params = {'per_page': 200})
+		response.raise_for_status()
+		
+		sizes = response.json()['sizes']
+		
+		response = requests.get(BASEURL + "/v2/account", headers = {'Authorization': 'Bearer ' + token})
+		response.raise_for_status()
+		
+		dropletLimit = response.json()['account']['droplet_limit']
+		
+	except requests.exceptions.RequestException as err:
+	
+		print(err)
+		
+		if cache is None:
+		
+			sys.exit(1)
+			
+		print("Using droplet types cached {} minutes ago.".format(int((time.time() - cache['fetched']) / 60)))
+		
+		return cache
+		
+	cache = {'fetched': int(time.time()), 'droplet_limit': dropletLimit, 'sizes': sizes}
+	
+	# Write to a temporary file first, so a queue starting at the same time never reads a partially-written cache
+	with open("{}.{}.tmp".format(cacheFile, os.getpid()), "w") as f:
+	
+		json.dump(cache, f)
+		
+	os.replace("{}.{}.tmp".format(cacheFile, os.getpid()), cacheFile)
+	
+	return cache
+
+
 def ssh_key_check(token, current_fingerprint, current_key):
 
 	try:
@@ -570,6 +1127,34 @@ def ssh_key_check(token, current_fingerprint, current_key):
 	print(response.json()['ssh_key']['id'])
 
 
+# throughput_load()
+#
+# Input: path to a file exported from v_region_throughput
+# Returns: dictionary of regions, each with its measured transfer speed in megabytes per second
+def throughput_load(throughputFile):
+
+	throughput = {}
+	
+	if throughputFile is None or not os.path.isfile(throughputFile):
+	
+		return throughput
+		
+	with open(throughputFile) as f:
+	
+		for line in f:
+		
+			# region, megabytes_per_second
+			columns = line.rstrip('\n').split('\t')
+			
+			if len(columns) < 2 or columns[1] == "NULL" or float(columns[1]) <= 0:
+			
+				continue
+				
+			throughput[columns[0]] = float(columns[1])
+			
+	return throughput
+
+
 def volume_create(token, identifier, simultaneousEncodes=1, region="nyc3"):
 
 	storageIdentifier = "{}-{}".format(STORAGENAME, identifier.zfill(2))
@@ -595,8 +1180,8 @@ def volume_create(token, identifier, simultaneousEncodes=1, region="nyc3"):
 		print()
 		
 		# The attempt to create the volume immediately failed,
-		# so there would likely be no volume for us to destroy before we exit.
-		sys.exit(1)
+		# so there would likely be no volume for us to destroy before we give up.
+		return None
 	
 	print("Block storage creation:")
 	print(response.url)
@@ -620,11 +1205,11 @@ def volume_create(token, identifier, simultaneousEncodes=1, region="nyc3"):
 		print()
 		
 		# The volume may have been created, but our attempt to check the status failed
-		# so before we exit we attempt to destroy the volume if we can
+		# so before we give up we attempt to destroy the volume if we can
 		
 		volume_orphans(token)
 		
-		sys.exit(1)
+		return None
 	
 	print("Block storage creation status:")
 	print(response.url)
@@ -848,19 +1433,55 @@ if __name__ == "__main__":
 	
 	# Process tasks based on the command line arguments given
 	
+	# List the droplet types and simultaneous encodes to calibrate
+	if arguments['calibrate']:
+	
+		if arguments['--candidates']:
+		
+			candidates = arguments['--candidates'].split(',')
+			
+		else:
+		
+			candidates = None
+	
+		droplet_calibrate(arguments['--apikey'], candidates, arguments['--region'].split(','), int(arguments['--cpu']), int(arguments['--ram']), arguments['--cache'], int(arguments['--cachettl']))
+
 	# Choose droplet type based on number of tasks to process
-	if arguments['choose']:
+	elif arguments['choose']:
 
-		droplet_choose(arguments['--apikey'], int(arguments['--remotetasks']), int(arguments['--maxdroplets']), arguments['--region'], int(arguments['--cpu']), int(arguments['--ram']))
+		droplet_choose(arguments['--apikey'], int(arguments['--remotetasks']), int(arguments['--maxdroplets']), arguments['--region'].split(','), int(arguments['--cpu']), int(arguments['--ram']), arguments['--calibration'], int(arguments['--remoteseconds']), arguments['--throughput'], int(arguments['--remotebytes']), int(arguments['--regiondroplets']), arguments['--cache'], int(arguments['--cachettl']))
 	
 	# Create a volume, create a droplet, and attach them together
+	# (if it can't be created in its region, e.g. the region is out of capacity, try each of the fallback regions in turn)
 	elif arguments['create']:
 
-		volumeID = volume_create(arguments['--apikey'], arguments['--id'], int(arguments['--simultaneous']), arguments['--region'])
-	
-		dropletIP = droplet_create(arguments['--apikey'], arguments['--id'], arguments['--size'], volumeID, arguments['--fingerprint'], arguments['--region'])
-	
-		print("root@{}".format(dropletIP))
+		regions = [arguments['--region']]
+		
+		if arguments['--fallback']:
+		
+			regions.extend([region for region in arguments['--fallback'].split(',') if region not in regions])
+			
+		for region in regions:
+		
+			volumeID = volume_create(arguments['--apikey'], arguments['--id'], int(arguments['--simultaneous']), region)
+			
+			if volumeID is not None:
+			
+				dropletIP = droplet_create(arguments['--apikey'], arguments['--id'], arguments['--size'], volumeID, arguments['--fingerprint'], region)
+				
+				if dropletIP is not None:
+				
+					# Print the region the droplet was actually created in along with its address
+					print("root@{}\t{}".format(dropletIP, region))
+					
+					break
+					
+			print("Couldn't create {}-{} in {}.".format(DROPLETNAME, arguments['--id'].zfill(2), region))
+			print()
+			
+		else:
+		
+			sys.exit(1)
 	
 	# Delete the droplet
 	elif arguments['delete']:
@@ -878,6 +1499,33 @@ if __name__ == "__main__":
 			# Delete any active droplets
 			droplet_delete(arguments['--apikey'])
 			
+	# Destroy a single droplet
+	elif arguments['destroy']:
+	
+		droplet_destroy(arguments['--apikey'], arguments['--host'])
+		
+	# Split the encode queue between the local host and droplets
+	elif arguments['place']:
+	
+		encode_place(arguments['--calibration'], arguments['--encodequeue'], arguments['--localqueue'], int(arguments['--localslots']), int(arguments['--boottime']), int(arguments['--maxdroplets']))
+		
+	# Refresh the cached list of droplet types and the regions they're available in
+	elif arguments['sizes']:
+	
+		cache = sizes_load(arguments['--apikey'], arguments['--cache'], 0)
+		
+		print("Cached {} droplet types.".format(len(cache['sizes'])))
+		
 	elif arguments['keycheck']:
 	
-		ssh_key_check(arguments['--apikey'], arguments['--fingerprint'], arguments['--sshkey'])
\ No newline at end of file
+		ssh_key_check(arguments['--apikey'], arguments['--fingerprint'], arguments['--sshkey'])
+		
+	# Request a batch of archived files to be restored from Glacier storage
+	elif arguments['restore']:
+	
+		s3_restore(arguments['--accesskey'], arguments['--secretkey'], arguments['--bucket'], s3_files(arguments['--files']), int(arguments['--days']), int(arguments['--threads']))
+		
+	# Check which of a batch of archived files have finished being restored from Glacier storage
+	elif arguments['thaw']:
+	
+		s3_thaw(arguments['--accesskey'], arguments['--secretkey'], arguments['--bucket'], s3_files(arguments['--files']), int(arguments['--threads']))
\ No newline at end of file
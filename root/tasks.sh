@@ -18,6 +18,74 @@ fi
 }
 
 
+record_transfer () {
+
+	# record_transfer records how quickly a file was transferred between S3 and this droplet (${1} = upload / download, ${2} = seconds),
+	# so future queues can create droplets in the regions our files transfer to and from fastest
+
+	# Only droplets can look up their region from the DigitalOcean metadata service, so there's nothing to record for local tasks
+	region=$(curl -s --max-time 2 http://169.254.169.254/metadata/v1/region)
+	
+	if [[ -z "${region}" ]] || [[ ! -f /mnt/storage/Originals"${file_path}" ]]
+	then
+		return 0
+	fi
+	
+	fileSize=$(stat -c %s /mnt/storage/Originals"${file_path}") &&
+	dropletType=$(tail -n1 /mnt/storage/dropletSpecs.txt | tr -s '\t' | cut -f2) &&
+	
+	escapedRegion=$(printf %q "${region}") &&
+	escapedDropletType=$(printf %q "${dropletType}") &&
+	
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_transfer (queue_start, file_path, region, droplet_type, direction, file_size, transfer_duration) VALUES (FROM_UNIXTIME('${queueStart}'), '${escaped_file_path}', '${escapedRegion}', '${escapedDropletType}', '${1}', '${fileSize}', '${2}');"
+
+}
+
+
+acquire_lease () {
+
+	# acquire_lease leases this task to this droplet, taking over any lease that has expired or that this droplet already holds
+	# (e.g. when the task is retried on the same droplet before its last lease expired),
+	# and prints 1 if the lease was acquired or 0 if another droplet still holds it
+	# (host is updated before date_lease_expires since both are checked, and ROW_COUNT() is 1 for a new lease,
+	#  2 for a lease taken over, and 0 if another droplet's lease was left alone)
+
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_lease (queue_start, file_path, task, host, outcome, date_leased) SELECT queue_start, file_path, task, host, 'expired', date_leased FROM job_leases WHERE file_path = '${escaped_file_path}' AND date_lease_expires < CURRENT_TIMESTAMP; INSERT INTO job_leases (file_path, task, host, queue_start, date_lease_expires) VALUES ('${escaped_file_path}', '${escaped_task}', '${escaped_host}', FROM_UNIXTIME('${queueStart}'), CURRENT_TIMESTAMP + INTERVAL ${lease_length} SECOND) ON DUPLICATE KEY UPDATE task = IF(host = VALUES(host) OR date_lease_expires < CURRENT_TIMESTAMP, VALUES(task), task), queue_start = IF(host = VALUES(host) OR date_lease_expires < CURRENT_TIMESTAMP, VALUES(queue_start), queue_start), date_leased = IF(host = VALUES(host) OR date_lease_expires < CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, date_leased), date_heartbeat = IF(host = VALUES(host) OR date_lease_expires < CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, date_heartbeat), progress = IF(host = VALUES(host) OR date_lease_expires < CURRENT_TIMESTAMP, NULL, progress), host = IF(host = VALUES(host) OR date_lease_expires < CURRENT_TIMESTAMP, VALUES(host), host), date_lease_expires = IF(host = VALUES(host) OR date_lease_expires < CURRENT_TIMESTAMP, VALUES(date_lease_expires), date_lease_expires); SELECT ROW_COUNT() > 0;" -B --skip-column-names
+
+}
+
+
+heartbeat () {
+
+	# heartbeat renews this task's lease every minute for as long as tasks.sh is still running,
+	# so Watchdog.sh can tell the difference between a long task and a droplet that has stopped responding
+
+	while kill -0 ${1} 2> /dev/null
+	do
+		mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "UPDATE job_leases SET date_heartbeat = CURRENT_TIMESTAMP, date_lease_expires = CURRENT_TIMESTAMP + INTERVAL ${lease_length} SECOND WHERE file_path = '${escaped_file_path}' AND host = '${escaped_host}';"
+		sleep 60
+	done
+
+}
+
+
+release_lease () {
+
+	# release_lease releases this task's lease once the task has finished (${1} = the task's exit status),
+	# recording the droplet time spent on the task if it failed, and the result against this droplet's health
+
+	kill ${heartbeatPID} 2> /dev/null
+	
+	if [[ ${1} -eq 0 ]]
+	then
+		mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "DELETE FROM job_leases WHERE file_path = '${escaped_file_path}' AND host = '${escaped_host}'; UPDATE host_health SET jobs_completed = jobs_completed + 1 WHERE queue_start = FROM_UNIXTIME('${queueStart}') AND host = '${escaped_host}';"
+	else
+		mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_lease (queue_start, file_path, task, host, outcome, date_leased) SELECT queue_start, file_path, task, host, 'failed', date_leased FROM job_leases WHERE file_path = '${escaped_file_path}' AND host = '${escaped_host}'; DELETE FROM job_leases WHERE file_path = '${escaped_file_path}' AND host = '${escaped_host}'; UPDATE host_health SET jobs_failed = jobs_failed + 1 WHERE queue_start = FROM_UNIXTIME('${queueStart}') AND host = '${escaped_host}';"
+	fi
+
+}
+
+
 archive_video () {
 
 	# archive_video takes the original video file (typically an .mkv), encrypts it with
@@ -31,8 +99,11 @@ archive_video () {
 	task_duration=$(( taskEnd - taskStart )) &&
 	
 	# Update the database to indicate that the file has been archived
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, file_path, task, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), file_path, task, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "UPDATE files SET date_file_archived = CURRENT_TIMESTAMP WHERE file_path = '${escaped_file_path}';"
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, location, file_path, task, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), '${task_location}', file_path, task, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "UPDATE files SET date_file_archived = CURRENT_TIMESTAMP WHERE file_path = '${escaped_file_path}';" &&
+	
+	# Record how quickly the file was uploaded from this droplet's region
+	record_transfer upload "${task_duration}"
 
 }
 
@@ -53,7 +124,7 @@ delete_video() {
 	task_duration=$(( taskEnd - taskStart )) &&
 	
 	# Update the database to indicate that the file has been deleted
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, file_path, task, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), file_path, task, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, location, file_path, task, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), '${task_location}', file_path, task, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
 	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "UPDATE files SET date_file_deleted = CURRENT_TIMESTAMP WHERE file_path = '${escaped_file_path}';"
 
 }
@@ -73,14 +144,14 @@ restore_video () {
 	
 	# Issue a restore request
 	taskStart=$(date +%s) &&
-	s3cmd --restore-priority=bulk restore "s3://${S3_BUCKET}${file_path}" &&
+	s3cmd --restore-priority=bulk --restore-days=${S3_RESTORE_DAYS:=3} restore "s3://${S3_BUCKET}${file_path}" &&
 	taskEnd=$(date +%s) &&
 	
 	task_duration=$(( taskEnd - taskStart )) &&
 	
 	# Update the database to indicate that a restore has been requested
-	# A DB trigger will also update the database for when the restore should be available (bulk = 12 hours after restore request)
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, file_path, task, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), file_path, task, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
+	# (Restore.sh will mark the file as available once S3 reports that it has been restored)
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, location, file_path, task, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), '${task_location}', file_path, task, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
 	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "UPDATE files SET date_restore_requested = CURRENT_TIMESTAMP WHERE file_path = '${escaped_file_path}';"
 
 }
@@ -95,7 +166,7 @@ copy_video () {
 	cp /mnt/Storage/Originals"${file_path}" /mnt/Storage/Plex"${file_path}" &&
 	
 	# Update the database to show that the file has been copied as of now
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, location, file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), '${task_location}', file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
 	
 }
 
@@ -109,8 +180,31 @@ encode_video () {
 	
 		mkdir -p /mnt/storage/Originals"${dir_path}" &&
 		
-		s3cmd get "s3://${S3_BUCKET}${file_path}" /mnt/storage/Originals"${file_path}"
+		transferStart=$(date +%s) &&
+		s3cmd get "s3://${S3_BUCKET}${file_path}" /mnt/storage/Originals"${file_path}" &&
+		transferEnd=$(date +%s) &&
+		
+		# Record how quickly the file was downloaded to this droplet's region
+		record_transfer download "$(( transferEnd - transferStart ))"
+
+	fi &&
+
+
+	# If any renditions have been defined for this title, encode them all from a single decode pass
+	# (The primary version is still encoded by HandBrake below, so adding a rendition doesn't change it,
+	# but a title with renditions is decoded twice: once for all of its renditions, and once for its primary version)
+
+	renditions=$(mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT rendition_name, mpeg_encoder, encoder_tune, quality, max_height, vbv_maxrate, vbv_bufsize, crf_max, qpmax FROM v_renditions WHERE plex_name = '${escaped_plex_name}';" -B --skip-column-names) &&
+
+	if [[ ! -z "${renditions}" ]]
+	then
 	
+		# Create a path for the renditions to be stored
+		# (Queue.sh returns this directory from the droplet along with the transcoded file)
+		mkdir -p /mnt/storage/Renditions/"${plex_name}" &&
+		
+		encode_renditions || return 1
+		
 	fi &&
 
 
@@ -194,9 +288,26 @@ encode_video () {
 	taskEnd=$(date +%s) &&
 	
 	task_duration=$(( taskEnd - taskStart )) &&
-	
+
+	# Calibration clips aren't in v_queue, so instead we record how quickly this droplet type encoded the clip
+	if [[ "${task}" == "calibration" ]]
+	then
+
+		frame_count=$(mediainfo --Inform="Video;%FrameCount%" /mnt/storage/Originals"${file_path}") &&
+		file_duration=$(mediainfo --Inform="General;%Duration%" /mnt/storage/Originals"${file_path}") &&
+		file_duration=$(( file_duration / 1000 )) &&
+
+		dropletType=$(tail -n1 /mnt/storage/dropletSpecs.txt | tr -s '\t' | cut -f2) &&
+		numCPUs=$(tail -n1 /mnt/storage/dropletSpecs.txt | tr -s '\t' | cut -f3) &&
+		simultaneousEncodes=$(tail -n1 /mnt/storage/dropletSpecs.txt | tr -s '\t' | cut -f4) &&
+		hourlyCost=$(tail -n1 /mnt/storage/dropletSpecs.txt | tr -s '\t' | cut -f5) &&
+
+		mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_calibration (calibration_start, droplet_type, num_cpus, simultaneous_tasks, hourly_cost, clip_path, quality_title, mpeg_encoder, encoder_tune, file_duration, frame_count, task_duration) VALUES (FROM_UNIXTIME('${queueStart}'), '${dropletType}', '${numCPUs}', '${simultaneousEncodes}', '${hourlyCost}', '${escaped_file_path}', '${escaped_quality_title}', '${escaped_mpeg_encoder}', '${escaped_encoder_tune}', '${file_duration}', '${frame_count}', '${task_duration}');"
+
+	fi &&
+
 	# Update the database to show that the file has been transcoded as of now
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, handbrake_preset, mpeg_encoder, encoder_tune, crop, quality, vbv_maxrate, vbv_bufsize, crf_max, qpmax, decomb, nlmeans, nlmeans_tune, audio_language, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, handbrake_preset, mpeg_encoder, encoder_tune, crop, quality, vbv_maxrate, vbv_bufsize, crf_max, qpmax, decomb, nlmeans, nlmeans_tune, audio_language, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, location, file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, handbrake_preset, mpeg_encoder, encoder_tune, crop, quality, vbv_maxrate, vbv_bufsize, crf_max, qpmax, decomb, nlmeans, nlmeans_tune, audio_language, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), '${task_location}', file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, handbrake_preset, mpeg_encoder, encoder_tune, crop, quality, vbv_maxrate, vbv_bufsize, crf_max, qpmax, decomb, nlmeans, nlmeans_tune, audio_language, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
 	
 	if [[ "${task}" == "encode" ]]
 	then
@@ -209,6 +320,278 @@ encode_video () {
 }
 
 
+encode_renditions () {
+
+	# encode_renditions transcodes each of a title's renditions in a single ffmpeg pass:
+	# the original is decoded, cropped, deinterlaced, and denoised once, and the filtered frames are split
+	# and fed to a separate encoder for each rendition
+	#
+	# HandBrakeCLI can only write one output per run, so the renditions are encoded with ffmpeg instead;
+	# the ${handbrake_preset} isn't applied, and each rendition is scaled to a maximum of 1080 pixels high
+	# unless it specifies a different max_height. The primary version is encoded afterwards by encode_video
+	# with HandBrake as usual, so it keeps its preset, audio, subtitles, and filters
+
+
+	# Build the filter chain shared by every rendition
+
+	filters=""
+
+	# Crop values are stored as top:bottom:left:right
+	if [[ ${crop} != "NULL" ]]
+	then
+		IFS=':' read -r cropTop cropBottom cropLeft cropRight <<< "${crop}"
+		filters="${filters}crop=in_w-${cropLeft}-${cropRight}:in_h-${cropTop}-${cropBottom}:${cropLeft}:${cropTop},"
+	fi
+
+	# Only deinterlace frames that are flagged as interlaced, similar to HandBrake's selective decomb
+	filters="${filters}yadif=deint=interlaced,"
+
+	# ffmpeg's nlmeans filter isn't available in the ffmpeg packaged for our droplets,
+	# so use the hqdn3d denoiser at a roughly equivalent strength
+	if [[ ${nlmeans} == "ultralight" ]]
+	then
+		filters="${filters}hqdn3d=1:0.7:1.5:1.1,"
+	elif [[ ${nlmeans} == "light" ]]
+	then
+		filters="${filters}hqdn3d=2:1.5:3:2.25,"
+	elif [[ ${nlmeans} == "medium" ]]
+	then
+		filters="${filters}hqdn3d=4:3:6:4.5,"
+	elif [[ ${nlmeans} == "strong" ]]
+	then
+		filters="${filters}hqdn3d=7:5:7:5,"
+	fi
+
+
+	# Each rendition falls back to the title's own encoding settings for any setting left blank
+
+	outputNames=()
+	outputEncoders=()
+	outputTunes=()
+	outputQualities=()
+	outputHeights=()
+	outputMaxrates=()
+	outputBufsizes=()
+	outputCrfMaxes=()
+	outputQpmaxes=()
+
+	while IFS=$'\t' read -r rendition_name rendition_encoder rendition_tune rendition_quality rendition_height rendition_maxrate rendition_bufsize rendition_crf_max rendition_qpmax
+	do
+
+		if [[ ${rendition_quality} == "NULL" ]]
+		then
+			rendition_quality=${quality}
+		fi
+
+		if [[ ${rendition_height} == "NULL" ]]
+		then
+			rendition_height="1080"
+		fi
+
+		# A rendition's bitrate can't be higher than the title's bitrate
+		if [[ ${rendition_maxrate} == "NULL" ]] || [[ ${rendition_maxrate} -gt ${vbv_maxrate} ]]
+		then
+			rendition_maxrate=${vbv_maxrate}
+			rendition_bufsize=${vbv_bufsize}
+		fi
+
+		if [[ ${rendition_crf_max} == "NULL" ]]
+		then
+			rendition_crf_max=${crf_max}
+		fi
+
+		if [[ ${rendition_qpmax} == "NULL" ]]
+		then
+			rendition_qpmax=${qpmax}
+		fi
+
+		outputNames+=("${rendition_name}")
+		outputEncoders+=("${rendition_encoder}")
+		outputTunes+=("${rendition_tune}")
+		outputQualities+=("${rendition_quality}")
+		outputHeights+=("${rendition_height}")
+		outputMaxrates+=("${rendition_maxrate}")
+		outputBufsizes+=("${rendition_bufsize}")
+		outputCrfMaxes+=("${rendition_crf_max}")
+		outputQpmaxes+=("${rendition_qpmax}")
+
+	done <<< "${renditions}"
+
+	numOutputs=${#outputNames[@]}
+
+
+	# Split the filtered frames once per rendition, and scale each copy down to that rendition's maximum height
+	# e.g. [0:v:0]crop=...,yadif=...,split=2[v0][v1];[v0]scale=-2:'min(ih,1080)'[o0];[v1]scale=-2:'min(ih,720)'[o1]
+
+	splitLabels=""
+	scaleChains=""
+
+	for (( i=0; i<numOutputs; i++ ))
+	do
+		splitLabels="${splitLabels}[v${i}]"
+		scaleChains="${scaleChains};[v${i}]scale=-2:'min(ih,${outputHeights[$i]})'[o${i}]"
+	done
+
+	ffmpegArgs=(-hide_banner -y -i /mnt/storage/Originals"${file_path}" -filter_complex "[0:v:0]${filters}split=${numOutputs}${splitLabels}${scaleChains}")
+
+
+	# Add an encoder and an output file for each rendition
+	# (The same Don Melton-style ratecontrol settings we pass to HandBrake's --encopts are passed straight to x264 / x265)
+
+	for (( i=0; i<numOutputs; i++ ))
+	do
+
+		ratecontrol="vbv-maxrate=${outputMaxrates[$i]}:vbv-bufsize=${outputBufsizes[$i]}:crf-max=${outputCrfMaxes[$i]}:qpmax=${outputQpmaxes[$i]}"
+
+		if [[ ${outputEncoders[$i]} == "x264" ]]
+		then
+
+			if [[ ${outputTunes[$i]} == "NULL" ]]
+			then
+				outputTunes[$i]="film"
+			fi
+
+			ffmpegArgs+=(-map "[o${i}]" -c:v libx264 -tune "${outputTunes[$i]}" -crf "${outputQualities[$i]}" -x264-params "${ratecontrol}")
+
+		elif [[ ${outputEncoders[$i]} == "x265" ]]
+		then
+
+			ffmpegArgs+=(-map "[o${i}]" -c:v libx265 -crf "${outputQualities[$i]}" -x265-params "${ratecontrol}")
+
+		else
+
+			echo "Titles with renditions can only be encoded with x264 or x265, not ${outputEncoders[$i]}!"
+			return 1
+
+		fi
+
+		# Import.sh has already removed any unwanted audio languages from the original,
+		# so every remaining audio track is included as stereo AAC
+		ffmpegArgs+=(-map "0:a?" -c:a aac -strict -2 -b:a 160k -ac 2 -f mp4 -movflags +faststart)
+
+		# Renditions are returned separately from the primary version
+		# to be moved alongside it once they're back on the host
+		ffmpegArgs+=(/mnt/storage/Renditions/"${plex_name}/${plex_name} - ${outputNames[$i]}".m4v)
+
+	done
+
+
+	# Convert the renditions
+	taskStart=$(date +%s) &&
+	ffmpeg "${ffmpegArgs[@]}" >> /mnt/storage/"${plex_name}".log 2>&1 &&
+	taskEnd=$(date +%s) &&
+
+	renditions_duration=$(( taskEnd - taskStart )) &&
+
+	# Record each rendition's transcode, along with the duration of the pass that encoded them all
+	# (the rollups only count primary versions, so this doesn't skew their encoding estimates)
+	for (( i=0; i<numOutputs; i++ ))
+	do
+
+		escaped_rendition_name=$(printf %q "${outputNames[$i]}")
+		escaped_rendition_path=$(printf %q "${dir_path}/${plex_name} - ${outputNames[$i]}.m4v")
+
+		if [[ ${outputEncoders[$i]} == "x264" ]]
+		then
+			rendition_tune="'${outputTunes[$i]}'"
+		else
+			rendition_tune="NULL"
+		fi
+
+		mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, location, file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, mpeg_encoder, encoder_tune, crop, quality, vbv_maxrate, vbv_bufsize, crf_max, qpmax, decomb, nlmeans, nlmeans_tune, audio_language, rendition_name, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), '${task_location}', file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, '${outputEncoders[$i]}', ${rendition_tune}, crop, '${outputQualities[$i]}', '${outputMaxrates[$i]}', '${outputBufsizes[$i]}', '${outputCrfMaxes[$i]}', '${outputQpmaxes[$i]}', decomb, nlmeans, nlmeans_tune, audio_language, '${escaped_rendition_name}', '${renditions_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
+		mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO renditions (plex_name, rendition_name, rendition_path, latest_transcode) VALUES ('${escaped_plex_name}', '${escaped_rendition_name}', '${escaped_rendition_path}', CURRENT_TIMESTAMP) ON DUPLICATE KEY UPDATE rendition_path = VALUES(rendition_path), latest_transcode = CURRENT_TIMESTAMP;" || return 1
+
+	done
+
+}
+
+
+remux_video () {
+
+	# remux_video copies the video of a source that Import.sh found already meets our target profile
+	# (H.264 at no more than 1080p, progressive, and under its quality's bitrate cap) into an .m4v without re-encoding it,
+	# and only transcodes its audio, so it can be done on the local host in a few minutes instead of on a droplet
+	#
+	# The audio matches the Apple presets: a stereo AAC track from each audio track in ${audio_language} (or every audio track
+	# if no languages are given), plus the first of those tracks in AC-3 if it's surround (passed through if it's already AC-3)
+
+	ffmpegArgs=(-hide_banner -y -i /mnt/storage/Originals"${file_path}" -map 0:v:0 -c:v copy -c:a aac -strict -2 -b:a 160k)
+
+	# Choose the audio tracks the same way HandBrake's --audio-lang-list does for encode_video,
+	# keeping the first audio track if none of them are in ${audio_language}
+	# (mediainfo lists the audio tracks in the same order ffmpeg numbers them, with untagged tracks as "und")
+	audioCount=$(mediainfo --Output="General;%AudioCount%" /mnt/storage/Originals"${file_path}") &&
+	audioTracks=() &&
+
+	if [[ "${audio_language}" == "NULL" ]]
+	then
+		audioTracks=($(seq 0 $(( ${audioCount:-0} - 1 ))))
+	else
+		audioTrack="0"
+		while read -r trackLanguage
+		do
+			if [[ ",${audio_language}," == *",${trackLanguage:-und},"* ]]
+			then
+				audioTracks+=(${audioTrack})
+			fi
+			audioTrack=$(( audioTrack + 1 ))
+		done < <(mediainfo --Output="Audio;%Language/String3%\n" /mnt/storage/Originals"${file_path}" | head -n ${audioCount:-0})
+
+		if [[ ${#audioTracks[@]} -eq 0 ]] && [[ ${audioCount:-0} -gt 0 ]]
+		then
+			audioTracks=(0)
+		fi
+	fi &&
+
+	# Downmix only the AAC tracks to stereo, so the AC-3 track keeps its surround channels
+	# (the AC-3 track comes after every stereo track, so its output stream number is the number of tracks we kept)
+	for (( i=0; i<${#audioTracks[@]}; i++ ))
+	do
+		ffmpegArgs+=(-map 0:a:${audioTracks[$i]} -ac:a:${i} 2)
+	done &&
+
+	if [[ ${#audioTracks[@]} -gt 0 ]]
+	then
+		surroundFormat=$(mediainfo --Output="Audio;%Format%\n" /mnt/storage/Originals"${file_path}" | sed -n "$(( audioTracks[0] + 1 ))p")
+		surroundChannels=$(mediainfo --Output="Audio;%Channel(s)%\n" /mnt/storage/Originals"${file_path}" | sed -n "$(( audioTracks[0] + 1 ))p" | cut -d " " -f1)
+	fi &&
+	
+	if [[ ${surroundChannels:-0} -gt 2 ]]
+	then
+	
+		if [[ "${surroundFormat}" == "AC-3" ]]
+		then
+			ffmpegArgs+=(-map 0:a:${audioTracks[0]} -c:a:${#audioTracks[@]} copy)
+		else
+			ffmpegArgs+=(-map 0:a:${audioTracks[0]} -c:a:${#audioTracks[@]} ac3 -b:a:${#audioTracks[@]} 640k -ac:a:${#audioTracks[@]} 6)
+		fi
+	
+	fi &&
+	
+	# Import.sh only marks a file as eligible if its subtitles are text, which .m4v files can store as soft subtitles
+	ffmpegArgs+=(-map "0:s?" -c:s mov_text -f mp4 -movflags +faststart /mnt/storage/Plex"${dir_path}/${plex_name}".m4v) &&
+
+
+	# Create a path for the remuxed file to be stored
+	mkdir -p /mnt/storage/Plex"${dir_path}" &&
+
+	# Remux the video
+	taskStart=$(date +%s) &&
+	ffmpeg "${ffmpegArgs[@]}" >> /mnt/storage/"${plex_name}".log 2>&1 &&
+	taskEnd=$(date +%s) &&
+	
+	task_duration=$(( taskEnd - taskStart )) &&
+
+	# Update the database to show that the file has been transcoded as of now
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, location, file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, handbrake_preset, mpeg_encoder, encoder_tune, crop, quality, vbv_maxrate, vbv_bufsize, crf_max, qpmax, decomb, nlmeans, nlmeans_tune, audio_language, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), '${task_location}', file_path, task, dir_path, plex_name, series_title, release_identifier, file_duration, quality_title, handbrake_preset, mpeg_encoder, encoder_tune, crop, quality, vbv_maxrate, vbv_bufsize, crf_max, qpmax, decomb, nlmeans, nlmeans_tune, audio_language, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "UPDATE presets_titles SET latest_transcode = CURRENT_TIMESTAMP WHERE plex_name = '${escaped_plex_name}';" &&
+	
+	# Delete the log file
+	rm /mnt/storage/"${plex_name}".log
+
+}
+
+
 purge_video () {
 
 	# purge_video removes a file and all of its database records
@@ -229,9 +612,17 @@ purge_video () {
 		
 		# Delete the transcoded file's path
 		rmdir -p --ignore-fail-on-non-empty /mnt/storage/Plex"${dir_path}"
-		
+
 	fi
-	
+
+	# Delete any renditions of the title
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "SELECT rendition_path FROM renditions WHERE plex_name = '${escaped_plex_name}';" -B --skip-column-names | while read -r rendition_path
+	do
+		rm /mnt/storage/Plex"${rendition_path}"
+	done
+
+	rmdir -p --ignore-fail-on-non-empty /mnt/storage/Plex"${dir_path}"
+
 	# Delete the archived file from S3 storage
 	s3cmd rm "s3://${S3_BUCKET}${file_path}"
 	taskEnd=$(date +%s) &&
@@ -239,7 +630,7 @@ purge_video () {
 	task_duration=$(( taskEnd - taskStart )) &&
 	
 	# Remove the file from the database
-	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, file_path, task, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), file_path, task, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
+	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "INSERT INTO history_task (queue_start, location, file_path, task, task_duration) SELECT FROM_UNIXTIME('${queueStart}'), '${task_location}', file_path, task, '${task_duration}' FROM v_queue WHERE file_path = '${escaped_file_path}';" &&
 	mysql -h ${MYSQL_PORT_3306_TCP_ADDR:-${MYSQL_HOST}} -P ${MYSQL_PORT_3306_TCP_PORT:-${MYSQL_PORT:=3306}} -u ${MYSQL_USER} -p${MYSQL_PASSWORD} ${MYSQL_DB:="fitzflix_db"} -e "DELETE FROM files WHERE file_path = '${escaped_file_path}'; DELETE FROM presets_titles WHERE plex_name = '${escaped_plex_name}'; DELETE FROM presets_titles WHERE series_title = '${escaped_series_title}';"
 
 }
@@ -250,6 +641,15 @@ purge_video () {
 
 queueStart=$(tail -n1 /mnt/storage/dropletSpecs.txt | tr -s '\t' | cut -f1)
 
+# Was this task run on the local host or on a droplet?
+# (Queue.sh sets TASK_LOCATION=local for tasks it runs locally; it isn't passed along to droplets)
+
+task_location=${TASK_LOCATION:-remote}
+
+# How many seconds a task's lease lasts without a heartbeat before Watchdog.sh treats its droplet as unresponsive
+
+lease_length=300
+
 # Map each column in the .tsv input file to its corresponding field from the database
 
 file_path=${1}
@@ -258,8 +658,8 @@ dir_path=${3}
 plex_name=${4}
 series_title=${5}
 release_identifier=${6}
-quality_title=${7}
-file_duration=${8}
+file_duration=${7}
+quality_title=${8}
 handbrake_preset=${9}
 mpeg_encoder=${10}
 encoder_tune=${11}
@@ -283,8 +683,8 @@ escaped_dir_path=$(printf %q "${3}")
 escaped_plex_name=$(printf %q "${4}")
 escaped_series_title=$(printf %q "${5}")
 escaped_release_identifier=$(printf %q "${6}")
-escaped_quality_title=$(printf %q "${7}")
-escaped_file_duration=$(printf %q "${8}")
+escaped_file_duration=$(printf %q "${7}")
+escaped_quality_title=$(printf %q "${8}")
 escaped_handbrake_preset=$(printf %q "${9}")
 escaped_mpeg_encoder=$(printf %q "${10}")
 escaped_encoder_tune=$(printf %q "${11}")
@@ -304,6 +704,48 @@ escaped_audio_language=$(printf %q "${21}")
 configure_s3cmd
 
 
+# Lease remote tasks to this droplet while it works on them, so a task from a droplet that stops responding can be handed to another droplet
+# (calibration clips are encoded several times at once on purpose, so they aren't leased)
+
+if [[ "${task_location}" == "remote" ]] && [[ "${task}" != "calibration" ]]
+then
+
+	host=$(curl -s --max-time 2 http://169.254.169.254/metadata/v1/interfaces/public/0/ipv4/address)
+	escaped_host=$(printf %q "${host}")
+	
+	if [[ ! -z "${host}" ]]
+	then
+	
+		leased=$(acquire_lease)
+		
+		# If another droplet holds the lease, the task has already been handed to a healthy droplet,
+		# so exit with an error rather than letting Queue.sh treat the task as done and try to fetch its results
+		# (if the database couldn't be reached, carry on without a lease rather than skipping the task)
+		if [[ "${leased}" == "0" ]]
+		then
+			echo "${file_path} is already leased to another droplet."
+			exit 1
+		elif [[ "${leased}" == "1" ]]
+		then
+		
+			# agent.py renews the leases of all of its tasks over one database connection,
+			# so only start a heartbeat of our own if we weren't started by an agent that's doing so
+			if [[ "${LEASE_HEARTBEAT}" != "agent" ]]
+			then
+				heartbeat $$ &
+				heartbeatPID=$!
+			fi
+			
+			# If the task is killed (e.g. a droplet being drained), release the lease straight away
+			# rather than leaving it to expire
+			trap 'release_lease 1 ; exit 1' TERM INT HUP
+		fi
+		
+	fi
+
+fi
+
+
 # Call the appropriate function depending on the type of task for this item in queue
 
 if [[ "${task}" == "archive" ]]
@@ -326,6 +768,11 @@ then
 
 	encode_video
 	
+elif [[ "${task}" == "remux" ]]
+then
+
+	remux_video
+	
 elif [[ "${task}" == "purge" ]]
 then
 
@@ -335,4 +782,13 @@ else
 
 	exit 1
 
-fi
\ No newline at end of file
+fi
+
+taskStatus=$?
+
+if [[ "${leased}" == "1" ]]
+then
+	release_lease ${taskStatus}
+fi
+
+exit ${taskStatus}
\ No newline at end of file